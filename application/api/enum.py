@@ -1,5 +1,6 @@
 from enum import Enum, unique
 from utils.constant import BEDROCK_MODEL_IDS
+from utils.result_format import RESULT_FORMATS
 
 
 @unique
@@ -9,6 +10,7 @@ class ErrorEnum(Enum):
     INVAILD_BEDROCK_MODEL_ID = {1002: f"Invalid bedrock model id.Vaild ids:{BEDROCK_MODEL_IDS}"}
     INVAILD_SESSION_ID = {1003: f"Invalid session id."}
     PROFILE_NOT_FOUND = {1004: "Profile name not found."}
+    INVAILD_RESULT_FORMAT = {1005: f"Invalid result format. Vaild formats:{RESULT_FORMATS}"}
     UNKNOWN_ERROR = {9999: "Unknown error."}
 
     def get_code(self):
@@ -23,4 +25,9 @@ class ContentEnum(Enum):
     EXCEPTION = "exception"
     COMMON = "common"
     STATE = "state"
-    END = "end"
\ No newline at end of file
+    END = "end"
+    SQL_STREAM = "sql_stream"
+    SQL = "sql"
+    DATA_ANALYSE = "data_analyse"
+    VISUALIZATION = "visualization"
+    SUGGESTED_QUESTION = "suggested_question"
\ No newline at end of file
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import traceback
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
@@ -10,6 +11,9 @@ from nlq.business.nlq_chain import NLQChain
 from dotenv import load_dotenv
 
 from .service import ask_websocket
+from utils.metrics import get_metrics
+from utils.executor import submit
+from utils.query_control import QueryCancellation, current_cancellation
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/qa", tags=["qa"])
@@ -23,8 +27,7 @@ def option():
 
 @router.get("/get_custom_question", response_model=CustomQuestion)
 def get_custom_question(data_profile: str):
-    all_profiles = ProfileManagement.get_all_profiles_with_info()
-    comments = all_profiles[data_profile]['comments']
+    comments = ProfileManagement.get_profile_info(data_profile)['comments']
     comments_questions = []
     if len(comments.split("Examples:")) > 1:
         comments_questions_txt = comments.split("Examples:")[1]
@@ -33,6 +36,11 @@ def get_custom_question(data_profile: str):
     return custom_question
 
 
+@router.get("/metrics")
+def metrics():
+    return get_metrics()
+
+
 @router.post("/ask", response_model=Answer)
 def ask(question: Question):
     return service.ask(question)
@@ -56,15 +64,29 @@ def user_feedback(input_data: FeedBackInput):
 @router.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
+    questions = asyncio.Queue()
+    # session id, cancellation token and task of the question being answered
+    answering = {}
+    receiver = asyncio.ensure_future(receive_messages(websocket, questions, answering))
     try:
         while True:
-            data = await websocket.receive_text()
-            question_json = json.loads(data)
+            question_json = await questions.get()
+            if question_json is None or receiver.done():
+                # disconnected, the queued questions are dropped
+                break
             question = Question(**question_json)
             session_id = question.session_id
             user_id = question.user_id
+            cancellation = QueryCancellation()
+            answer_task = asyncio.ensure_future(answer_question(websocket, question, cancellation))
+            answering.update(session_id=session_id, cancellation=cancellation, task=answer_task)
+            await asyncio.wait({answer_task})
+            answering.clear()
+            if answer_task.cancelled():
+                logger.info(f"Question of session {session_id} cancelled")
+                continue
             try:
-                ask_result = await ask_websocket(websocket, question)
+                ask_result = answer_task.result()
                 logger.info(ask_result)
                 await response_websocket(websocket=websocket, session_id=session_id, content=ask_result.dict(), content_type=ContentEnum.END, user_id=user_id)
             except Exception:
@@ -73,6 +95,44 @@ async def websocket_endpoint(websocket: WebSocket):
                 await response_websocket(websocket=websocket, session_id=session_id, content=msg, content_type=ContentEnum.EXCEPTION, user_id=user_id)
     except WebSocketDisconnect:
         logger.info(f"{websocket.client.host} disconnected.")
+    finally:
+        receiver.cancel()
+        cancel_answer(answering)
+
+
+async def answer_question(websocket: WebSocket, question: Question, cancellation: QueryCancellation):
+    # the queries run for the question are cancelled with the token
+    current_cancellation.set(cancellation)
+    return await ask_websocket(websocket, question)
+
+
+async def receive_messages(websocket: WebSocket, questions: asyncio.Queue, answering: dict):
+    """
+    Read the client messages while the questions are answered one by one. Questions are queued, a cancel message
+    ({"action": "cancel", "session_id": ...}) or a disconnect cancels the question being answered and its queries.
+    """
+    try:
+        while True:
+            message = json.loads(await websocket.receive_text())
+            if message.get("action") == "cancel":
+                if answering.get("session_id") == message.get("session_id"):
+                    cancel_answer(answering)
+            else:
+                questions.put_nowait(message)
+    except WebSocketDisconnect:
+        logger.info(f"{websocket.client.host} disconnected.")
+    except Exception as e:
+        logger.error(f"Failed to read the websocket message: {e}")
+    finally:
+        cancel_answer(answering)
+        questions.put_nowait(None)
+
+
+def cancel_answer(answering: dict):
+    if answering:
+        # cancelling the queries may connect to the database, off the event loop
+        submit("default", answering["cancellation"].cancel)
+        answering["task"].cancel()
 
 
 async def response_sagemaker_sql(websocket: WebSocket, session_id: str, response: dict, current_nlq_chain: NLQChain):
@@ -1,4 +1,4 @@
-from typing import Any
+from typing import Any, Union
 from pydantic import BaseModel
 
 
@@ -20,6 +20,7 @@ class Question(BaseModel):
     context_window: int = 3
     session_id: str = "-1"
     user_id: str = "admin"
+    result_format: str = "rows"
 
 
 class Example(BaseModel):
@@ -64,6 +65,9 @@ class SQLSearchResult(BaseModel):
     sql_gen_process: str
     data_analyse: str
     sql_data_chart: list[ChartEntity]
+    truncated: bool = False
+    total_count: Union[int, None] = None
+    sql_data_columnar: Union[dict, None] = None
 
 
 class TaskSQLSearchResult(BaseModel):
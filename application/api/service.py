@@ -1,9 +1,12 @@
+import asyncio
 import json
 import os
 from typing import Union
 from dotenv import load_dotenv
 import logging
+from nlq.business.answer_cache import AnswerCacheManagement
 from nlq.business.connection import ConnectionManagement
+from nlq.business.intent_classifier import IntentClassifier, INTENT_SOURCE_LOCAL, INTENT_SOURCE_MODEL
 from nlq.business.nlq_chain import NLQChain
 from nlq.business.profile import ProfileManagement
 from nlq.business.vector_store import VectorStore
@@ -12,13 +15,19 @@ from utils.apis import get_sql_result_tool
 from utils.database import get_db_url_dialect
 from nlq.business.suggested_question import SuggestedQuestionManagement as sqm
 from utils.domain import SearchTextSqlResult
-from utils.llm import text_to_sql, get_query_intent, create_vector_embedding_with_sagemaker, \
+from utils.llm import text_to_sql, text_to_sql_stream, get_query_intent, create_vector_embedding_with_sagemaker, \
     sagemaker_to_sql, sagemaker_to_explain, knowledge_search, get_agent_cot_task, data_analyse_tool, \
     generate_suggested_question, data_visualization
 from utils.opensearch import get_retrieve_opensearch
-from utils.env_var import opensearch_info
-from utils.text_search import normal_text_search, agent_text_search
-from utils.tool import generate_log_id, get_current_time, get_generated_sql_explain, get_generated_sql
+from utils.env_var import opensearch_info, SPECULATIVE_SEARCH, WS_STREAM_SQL, EARLY_SQL_EXECUTION
+from utils.executor import run_blocking, submit, iterate_blocking
+from utils.result_format import RESULT_FORMATS, RESULT_FORMAT_ROWS, encode_result
+from utils.query_control import QUERY_STATUS_TIMEOUT, QUERY_STATUS_REJECTED, QueryCancellation
+from utils.metrics import incr, Timer
+from utils.text_search import normal_text_search, agent_text_search, normal_retrieve_async, SpeculativeSearch, \
+    get_early_sql_result
+from utils.tool import generate_log_id, get_current_time, get_generated_sql_explain, get_generated_sql, \
+    GeneratedSQLStreamParser
 from .schemas import Question, Answer, Example, Option, SQLSearchResult, AgentSearchResult, KnowledgeSearchResult, \
     TaskSQLSearchResult, ChartEntity
 from .exception_handler import BizException
@@ -32,9 +41,8 @@ load_dotenv()
 
 
 def get_option() -> Option:
-    all_profiles = ProfileManagement.get_all_profiles_with_info()
     option = Option(
-        data_profiles=all_profiles.keys(),
+        data_profiles=ProfileManagement.get_all_profiles(),
         bedrock_model_ids=BEDROCK_MODEL_IDS,
     )
     return option
@@ -43,6 +51,8 @@ def get_option() -> Option:
 def verify_parameters(question: Question):
     if question.bedrock_model_id not in BEDROCK_MODEL_IDS:
         raise BizException(ErrorEnum.INVAILD_BEDROCK_MODEL_ID)
+    if question.result_format not in RESULT_FORMATS:
+        raise BizException(ErrorEnum.INVAILD_RESULT_FORMAT)
 
 
 def get_example(current_nlq_chain: NLQChain) -> list[Example]:
@@ -62,8 +72,7 @@ def get_result_from_llm(question: Question, current_nlq_chain: NLQChain, with_re
     logger.info('try to get generated sql from LLM')
 
     entity_slot_retrieve = []
-    all_profiles = ProfileManagement.get_all_profiles_with_info()
-    database_profile = all_profiles[question.profile_name]
+    database_profile = ProfileManagement.get_profile_info(question.profile_name)
     if question.intent_ner_recognition:
         intent_response = get_query_intent(question.bedrock_model_id, question.keywords, database_profile['prompt_map'])
         intent = intent_response.get("intent", "normal_search")
@@ -80,10 +89,7 @@ def get_result_from_llm(question: Question, current_nlq_chain: NLQChain, with_re
     # Whether Retrieving Few Shots from Database
     logger.info('Sending request...')
     # fix db url is Empty
-    if database_profile['db_url'] == '':
-        conn_name = database_profile['conn_name']
-        db_url = ConnectionManagement.get_db_url_by_name(conn_name)
-        database_profile['db_url'] = db_url
+    ConnectionManagement.resolve_profile_connection(database_profile)
 
     sql_endpoint = os.getenv('SAGEMAKER_ENDPOINT_SQL', '')
     if sql_endpoint:
@@ -106,10 +112,36 @@ def get_result_from_llm(question: Question, current_nlq_chain: NLQChain, with_re
                                ner_example=entity_slot_retrieve,
                                dialect=get_db_url_dialect(database_profile['db_url']),
                                model_provider=None,
-                               with_response_stream=with_response_stream, )
+                               with_response_stream=with_response_stream,
+                               profile_key=database_profile.get('profile_key'))
     return response
 
 
+def start_speculative_search(question: Question, database_profile) -> Union[SpeculativeSearch, None]:
+    """
+    Start the speculative retrieval/SQL generation of a normal search, only when the intent has to be classified
+    """
+    if not question.intent_ner_recognition_flag or SPECULATIVE_SEARCH not in ('retrieval', 'sql'):
+        return None
+    return SpeculativeSearch(question.query, question.bedrock_model_id, database_profile, opensearch_info,
+                             question.profile_name, question.use_rag_flag, with_sql=SPECULATIVE_SEARCH == 'sql')
+
+
+def execute_agent_task(database_profile, model_type, each_task, result_format=RESULT_FORMAT_ROWS):
+    """
+    Execute the SQL of one agent sub-task, then select its chart when the query returned data
+    :return: SQL result dict, data_visualization result or None
+    """
+    each_task_res = get_sql_result_tool(database_profile, each_task["sql"], model_type, each_task["query"])
+    each_task_visualization = None
+    if each_task_res["status_code"] == 200 and len(each_task_res["data"]) > 0:
+        each_task_res["columnar"] = encode_result(each_task_res["data"], result_format)
+        each_task_visualization = data_visualization(model_type, each_task["query"], each_task_res["data"],
+                                                     database_profile['prompt_map'],
+                                                     result_format == RESULT_FORMAT_ROWS)
+    return each_task_res, each_task_visualization
+
+
 def ask(question: Question) -> Answer:
     logger.debug(question)
     verify_parameters(question)
@@ -126,6 +158,7 @@ def ask(question: Question) -> Answer:
     explain_gen_process_flag = question.explain_gen_process_flag
     gen_suggested_question_flag = question.gen_suggested_question_flag
     answer_with_insights = question.answer_with_insights
+    result_format = question.result_format
 
     reject_intent_flag = False
     search_intent_flag = False
@@ -141,10 +174,9 @@ def ask(question: Question) -> Answer:
     current_time = get_current_time()
     log_info = ""
 
-    all_profiles = ProfileManagement.get_all_profiles_with_info()
-    if selected_profile not in all_profiles:
+    database_profile = ProfileManagement.get_profile_info(selected_profile)
+    if database_profile is None:
         raise BizException(ErrorEnum.PROFILE_NOT_FOUND)
-    database_profile = all_profiles[selected_profile]
 
     current_nlq_chain = NLQChain(selected_profile)
 
@@ -162,18 +194,23 @@ def ask(question: Question) -> Answer:
 
     generate_suggested_question_list = []
 
-    if database_profile['db_url'] == '':
-        conn_name = database_profile['conn_name']
-        db_url = ConnectionManagement.get_db_url_by_name(conn_name)
-        database_profile['db_url'] = db_url
-        database_profile['db_type'] = ConnectionManagement.get_db_type_by_name(conn_name)
+    ConnectionManagement.resolve_profile_connection(database_profile)
     prompt_map = database_profile['prompt_map']
 
     entity_slot = []
+    # the entity slot of a classified normal search is logged as an example of the local intent classifier
+    logged_entity_slot = None
+    # who classified the intent, only the intents of the model are training labels of the local intent classifier
+    intent_source = None
+    # a near-duplicate of an answered question reuses its SQL and skips intent, retrieval and generation
+    cached_answer = AnswerCacheManagement.get_answer(selected_profile, search_box)
+    speculative_search = start_speculative_search(question, database_profile) if cached_answer is None else None
     # 通过标志位控制后续的逻辑
     # 主要的意图有4个, 拒绝, 查询, 思维链, 知识问答
-    if intent_ner_recognition_flag:
-        intent_response = get_query_intent(model_type, search_box, prompt_map)
+    if cached_answer is not None:
+        search_intent_flag = True
+    elif intent_ner_recognition_flag:
+        intent_response, intent_source = classify_query_intent(selected_profile, model_type, search_box, prompt_map)
         intent = intent_response.get("intent", "normal_search")
         entity_slot = intent_response.get("slot", [])
         if intent == "reject_search":
@@ -192,22 +229,38 @@ def ask(question: Question) -> Answer:
             agent_intent_flag = False
         else:
             search_intent_flag = True
+            logged_entity_slot = entity_slot
     else:
         search_intent_flag = True
 
+    if speculative_search is not None and not search_intent_flag:
+        speculative_search.discard()
+
+    # the suggested questions only depend on the question, generate them while the question is being answered
+    suggested_question_future = None
+    if gen_suggested_question_flag and (search_intent_flag or agent_intent_flag):
+        suggested_question_future = submit("llm", get_suggested_question_list, prompt_map, search_box, model_type)
+
     if reject_intent_flag:
         answer = Answer(query=search_box, query_intent="reject_search", knowledge_search_result=knowledge_search_result,
                         sql_search_result=sql_search_result, agent_search_result=agent_search_response,
                         suggested_question=[])
         LogManagement.add_log_to_database(log_id=log_id, user_id=user_id, session_id=session_id,
                                           profile_name=selected_profile, sql="", query=search_box,
-                                          intent="reject_search", log_info="", time_str=current_time)
+                                          intent="reject_search", log_info="", time_str=current_time,
+                                          intent_source=intent_source)
         return answer
+    elif search_intent_flag and cached_answer is not None:
+        normal_search_result = SearchTextSqlResult(search_query=search_box, entity_slot_retrieve=[],
+                                                   retrieve_result=[], response=cached_answer.response,
+                                                   sql=cached_answer.sql)
     elif search_intent_flag:
         normal_search_result = normal_text_search(search_box, model_type,
                                                   database_profile,
                                                   entity_slot, opensearch_info,
-                                                  selected_profile, use_rag_flag)
+                                                  selected_profile, use_rag_flag,
+                                                  speculative_search=speculative_search,
+                                                  early_execution=EARLY_SQL_EXECUTION)
     elif knowledge_search_flag:
         response = knowledge_search(search_box=search_box, model_id=model_type, prompt_map=prompt_map)
 
@@ -221,7 +274,8 @@ def ask(question: Question) -> Answer:
                                           profile_name=selected_profile, sql="", query=search_box,
                                           intent="knowledge_search",
                                           log_info=knowledge_search_result.knowledge_response,
-                                          time_str=current_time)
+                                          time_str=current_time,
+                                          intent_source=intent_source)
         return answer
 
     else:
@@ -236,12 +290,6 @@ def ask(question: Question) -> Answer:
                                                 entity_slot, opensearch_info,
                                                 selected_profile, use_rag_flag, agent_cot_task_result)
 
-    if gen_suggested_question_flag and (search_intent_flag or agent_intent_flag):
-        active_prompt = sqm.get_prompt_by_name(ACTIVE_PROMPT_NAME).prompt
-        generated_sq = generate_suggested_question(prompt_map, search_box, model_id=model_type)
-        split_strings = generated_sq.split("[generate]")
-        generate_suggested_question_list = [s.strip() for s in split_strings if s.strip()]
-
     if search_intent_flag:
         if normal_search_result.sql != "":
             current_nlq_chain.set_generated_sql(normal_search_result.sql)
@@ -252,26 +300,49 @@ def ask(question: Question) -> Answer:
         else:
             sql_search_result.sql = "-1"
 
-        search_intent_result = get_sql_result_tool(database_profile,
-                                                   current_nlq_chain.get_generated_sql())
-        if search_intent_result["status_code"] == 500:
+        if cached_answer is not None and cached_answer.data is not None:
+            search_intent_result = cached_answer.to_sql_result()
+        else:
+            if normal_search_result.sql_result_future is not None:
+                search_intent_result = normal_search_result.sql_result_future.result()
+            else:
+                search_intent_result = get_sql_result_tool(database_profile,
+                                                           current_nlq_chain.get_generated_sql(), model_type,
+                                                           search_box)
+            if cached_answer is None and search_intent_result["status_code"] == 200:
+                AnswerCacheManagement.put_answer(selected_profile, database_profile, search_box,
+                                                 search_intent_result["sql"], normal_search_result.response,
+                                                 search_intent_result["data"])
+        if search_intent_result.get("rewritten"):
+            # the generated SQL was over the cost budget, the cheaper rewrite was executed
+            sql_search_result.sql = search_intent_result["sql"].strip()
+        sql_search_result.truncated = search_intent_result.get("truncated", False)
+        sql_search_result.total_count = search_intent_result.get("total_count")
+        if search_intent_result["status_code"] == 200:
+            sql_search_result.sql_data_columnar = encode_result(search_intent_result["data"], result_format)
+        if search_intent_result.get("status") == QUERY_STATUS_TIMEOUT:
+            sql_search_result.data_analyse = "The query took too long and was stopped, please try a more specific question."
+        elif search_intent_result.get("status") == QUERY_STATUS_REJECTED:
+            sql_search_result.data_analyse = "The query is estimated too expensive to run, please try a more specific question."
+        elif search_intent_result["status_code"] == 500:
             sql_search_result.data_analyse = "The query results are temporarily unavailable, please switch to debugging webpage to try the same query and check the log file for more information."
         else:
             if search_intent_result["data"] is not None and len(search_intent_result["data"]) > 0:
+                # the insights and the chart selection are independent, run them concurrently
+                data_analyse_future = None
                 if answer_with_insights:
                     search_intent_result["data"] = search_intent_result["data"].fillna("")
-                    search_intent_analyse_result = data_analyse_tool(model_type, prompt_map, search_box,
-                                                                     search_intent_result["data"].to_json(
-                                                                         orient='records', force_ascii=False), "query")
-
-                    sql_search_result.data_analyse = search_intent_analyse_result
-
-                model_select_type, show_select_data, select_chart_type, show_chart_data = data_visualization(model_type,
-                                                                                                             search_box,
-                                                                                                             search_intent_result[
-                                                                                                                 "data"],
-                                                                                                             database_profile[
-                                                                                                                 'prompt_map'])
+                    data_analyse_future = submit("llm", data_analyse_tool, model_type, prompt_map, search_box,
+                                                 search_intent_result["data"].to_json(orient='records',
+                                                                                      force_ascii=False), "query")
+                data_visualization_future = submit("llm", data_visualization, model_type, search_box,
+                                                   search_intent_result["data"], database_profile['prompt_map'],
+                                                   result_format == RESULT_FORMAT_ROWS)
+                if data_analyse_future is not None:
+                    sql_search_result.data_analyse = data_analyse_future.result()
+
+                model_select_type, show_select_data, select_chart_type, show_chart_data = \
+                    data_visualization_future.result()
 
                 if select_chart_type != "-1":
                     sql_chart_data = ChartEntity(chart_type="", chart_data=[])
@@ -282,41 +353,45 @@ def ask(question: Question) -> Answer:
                 sql_search_result.sql_data = show_select_data
                 sql_search_result.data_show_type = model_select_type
 
+        if suggested_question_future is not None:
+            generate_suggested_question_list = suggested_question_future.result()
+
         log_info = str(search_intent_result["error_info"]) + ";" + sql_search_result.data_analyse
         LogManagement.add_log_to_database(log_id=log_id, user_id=user_id, session_id=session_id,
                                           profile_name=selected_profile, sql=sql_search_result.sql,
                                           query=search_box,
                                           intent="normal_search",
                                           log_info=log_info,
-                                          time_str=current_time)
+                                          time_str=current_time,
+                                          entity_slot=logged_entity_slot,
+                                          status=search_intent_result.get("status"),
+                                          intent_source=intent_source)
         answer = Answer(query=search_box, query_intent="normal_search", knowledge_search_result=knowledge_search_result,
                         sql_search_result=sql_search_result, agent_search_result=agent_search_response,
                         suggested_question=generate_suggested_question_list)
         return answer
     else:
         sub_search_task = []
+        agent_task_futures = [submit("agent", execute_agent_task, database_profile, model_type, each_task,
+                                     result_format)
+                              for each_task in agent_search_result]
         for i in range(len(agent_search_result)):
-            each_task_res = get_sql_result_tool(database_profile, agent_search_result[i]["sql"])
+            each_task_res, each_task_visualization = agent_task_futures[i].result()
             if each_task_res["status_code"] == 200 and len(each_task_res["data"]) > 0:
                 agent_search_result[i]["data_result"] = each_task_res["data"].to_json(
                     orient='records')
                 filter_deep_dive_sql_result.append(agent_search_result[i])
-                each_task_sql_res = [list(each_task_res["data"].columns)] + each_task_res["data"].values.tolist()
 
-                model_select_type, show_select_data, select_chart_type, show_chart_data = data_visualization(model_type,
-                                                                                                             agent_search_result[
-                                                                                                                 i][
-                                                                                                                 "query"],
-                                                                                                             each_task_res[
-                                                                                                                 "data"],
-                                                                                                             database_profile[
-                                                                                                                 'prompt_map'])
+                model_select_type, show_select_data, select_chart_type, show_chart_data = each_task_visualization
 
                 each_task_sql_response = get_generated_sql_explain(agent_search_result[i]["response"])
                 sub_task_sql_result = SQLSearchResult(sql_data=show_select_data, sql=each_task_res["sql"],
                                                       data_show_type=model_select_type,
                                                       sql_gen_process=each_task_sql_response,
-                                                      data_analyse="", sql_data_chart=[])
+                                                      data_analyse="", sql_data_chart=[],
+                                                      truncated=each_task_res.get("truncated", False),
+                                                      total_count=each_task_res.get("total_count"),
+                                                      sql_data_columnar=each_task_res.get("columnar"))
                 if select_chart_type != "-1":
                     sub_sql_chart_data = ChartEntity(chart_type="", chart_data=[])
                     sub_sql_chart_data.chart_type = select_chart_type
@@ -337,7 +412,9 @@ def ask(question: Question) -> Answer:
                                               query=search_box + "; The sub task is " + agent_search_result[i]["query"],
                                               intent="agent_search",
                                               log_info=log_info,
-                                              time_str=current_time)
+                                              time_str=current_time,
+                                              status=each_task_res.get("status"),
+                                              intent_source=intent_source)
         agent_data_analyse_result = data_analyse_tool(model_type, prompt_map, search_box,
                                                       json.dumps(filter_deep_dive_sql_result, ensure_ascii=False),
                                                       "agent")
@@ -345,6 +422,8 @@ def ask(question: Question) -> Answer:
         logger.info(agent_data_analyse_result)
         agent_search_response.agent_summary = agent_data_analyse_result
         agent_search_response.agent_sql_search_result = agent_sql_search_result
+        if suggested_question_future is not None:
+            generate_suggested_question_list = suggested_question_future.result()
 
         answer = Answer(query=search_box, query_intent="agent_search", knowledge_search_result=knowledge_search_result,
                         sql_search_result=sql_search_result, agent_search_result=agent_search_response,
@@ -367,6 +446,7 @@ async def ask_websocket(websocket: WebSocket, question: Question):
     explain_gen_process_flag = question.explain_gen_process_flag
     gen_suggested_question_flag = question.gen_suggested_question_flag
     answer_with_insights = question.answer_with_insights
+    result_format = question.result_format
 
     reject_intent_flag = False
     search_intent_flag = False
@@ -382,8 +462,7 @@ async def ask_websocket(websocket: WebSocket, question: Question):
     current_time = get_current_time()
     log_info = ""
 
-    all_profiles = ProfileManagement.get_all_profiles_with_info()
-    database_profile = all_profiles[selected_profile]
+    database_profile = await run_blocking("default", ProfileManagement.get_profile_info, selected_profile)
 
     current_nlq_chain = NLQChain(selected_profile)
 
@@ -401,18 +480,24 @@ async def ask_websocket(websocket: WebSocket, question: Question):
 
     generate_suggested_question_list = []
 
-    if database_profile['db_url'] == '':
-        conn_name = database_profile['conn_name']
-        db_url = ConnectionManagement.get_db_url_by_name(conn_name)
-        database_profile['db_url'] = db_url
-        database_profile['db_type'] = ConnectionManagement.get_db_type_by_name(conn_name)
+    await run_blocking("default", ConnectionManagement.resolve_profile_connection, database_profile)
     prompt_map = database_profile['prompt_map']
 
     entity_slot = []
-
-    if intent_ner_recognition_flag:
+    # the entity slot of a classified normal search is logged as an example of the local intent classifier
+    logged_entity_slot = None
+    # who classified the intent, only the intents of the model are training labels of the local intent classifier
+    intent_source = None
+    # a near-duplicate of an answered question reuses its SQL and skips intent, retrieval and generation
+    cached_answer = await run_blocking("retrieval", AnswerCacheManagement.get_answer, selected_profile, search_box)
+    speculative_search = start_speculative_search(question, database_profile) if cached_answer is None else None
+
+    if cached_answer is not None:
+        search_intent_flag = True
+    elif intent_ner_recognition_flag:
         await response_websocket(websocket, session_id, "Query Intent Analyse", ContentEnum.STATE, "start", user_id)
-        intent_response = get_query_intent(model_type, search_box, prompt_map)
+        intent_response, intent_source = await run_blocking("llm", classify_query_intent, selected_profile,
+                                                            model_type, search_box, prompt_map)
         await response_websocket(websocket, session_id, "Query Intent Analyse", ContentEnum.STATE, "end", user_id)
         intent = intent_response.get("intent", "normal_search")
         entity_slot = intent_response.get("slot", [])
@@ -432,24 +517,41 @@ async def ask_websocket(websocket: WebSocket, question: Question):
             agent_intent_flag = False
         else:
             search_intent_flag = True
+            logged_entity_slot = entity_slot
     else:
         search_intent_flag = True
 
+    if speculative_search is not None and not search_intent_flag:
+        speculative_search.discard()
+
+    # the suggested questions only depend on the question, generate them while the question is being answered
+    suggested_question_task = None
+    if gen_suggested_question_flag and (search_intent_flag or agent_intent_flag):
+        suggested_question_task = asyncio.ensure_future(
+            run_blocking("llm", get_suggested_question_list, prompt_map, search_box, model_type))
+
     if reject_intent_flag:
         answer = Answer(query=search_box, query_intent="reject_search", knowledge_search_result=knowledge_search_result,
                         sql_search_result=sql_search_result, agent_search_result=agent_search_response,
                         suggested_question=[])
-        LogManagement.add_log_to_database(log_id=log_id, user_id=user_id, session_id=session_id,
-                                          profile_name=selected_profile, sql="", query=search_box,
-                                          intent="reject_search", log_info="", time_str=current_time)
+        await run_blocking("default", LogManagement.add_log_to_database, log_id=log_id, user_id=user_id,
+                           session_id=session_id, profile_name=selected_profile, sql="", query=search_box,
+                           intent="reject_search", log_info="", time_str=current_time,
+                           intent_source=intent_source)
         return answer
+    elif search_intent_flag and cached_answer is not None:
+        normal_search_result = SearchTextSqlResult(search_query=search_box, entity_slot_retrieve=[],
+                                                   retrieve_result=[], response=cached_answer.response,
+                                                   sql=cached_answer.sql)
     elif search_intent_flag:
         normal_search_result = await normal_text_search_websocket(websocket, session_id, search_box, model_type,
                                                                   database_profile,
                                                                   entity_slot, opensearch_info,
-                                                                  selected_profile, use_rag_flag, user_id)
+                                                                  selected_profile, use_rag_flag, user_id,
+                                                                  speculative_search=speculative_search)
     elif knowledge_search_flag:
-        response = knowledge_search(search_box=search_box, model_id=model_type, prompt_map=prompt_map)
+        response = await run_blocking("llm", knowledge_search, search_box=search_box, model_id=model_type,
+                                      prompt_map=prompt_map)
 
         knowledge_search_result.knowledge_response = response
         answer = Answer(query=search_box, query_intent="knowledge_search",
@@ -457,31 +559,25 @@ async def ask_websocket(websocket: WebSocket, question: Question):
                         sql_search_result=sql_search_result, agent_search_result=agent_search_response,
                         suggested_question=[])
 
-        LogManagement.add_log_to_database(log_id=log_id, user_id=user_id, session_id=session_id,
-                                          profile_name=selected_profile, sql="", query=search_box,
-                                          intent="knowledge_search",
-                                          log_info=knowledge_search_result.knowledge_response,
-                                          time_str=current_time)
+        await run_blocking("default", LogManagement.add_log_to_database, log_id=log_id, user_id=user_id,
+                           session_id=session_id, profile_name=selected_profile, sql="", query=search_box,
+                           intent="knowledge_search",
+                           log_info=knowledge_search_result.knowledge_response,
+                           time_str=current_time,
+                           intent_source=intent_source)
         return answer
 
     else:
-        agent_cot_retrieve = get_retrieve_opensearch(opensearch_info, search_box, "agent",
-                                                     selected_profile, 2, 0.5)
-        agent_cot_task_result = get_agent_cot_task(model_type, prompt_map, search_box,
+        agent_cot_retrieve = await run_blocking("retrieval", get_retrieve_opensearch, opensearch_info, search_box,
+                                                "agent", selected_profile, 2, 0.5)
+        agent_cot_task_result = await run_blocking("llm", get_agent_cot_task, model_type, prompt_map, search_box,
                                                    database_profile['tables_info'],
                                                    agent_cot_retrieve)
 
-        agent_search_result = agent_text_search(search_box, model_type,
-                                                database_profile,
-                                                entity_slot, opensearch_info,
-                                                selected_profile, use_rag_flag, agent_cot_task_result)
-
-    if gen_suggested_question_flag and (search_intent_flag or agent_intent_flag):
-        active_prompt = sqm.get_prompt_by_name(ACTIVE_PROMPT_NAME).prompt
-        generated_sq = generate_suggested_question(prompt_map, search_box, model_id=model_type)
-        split_strings = generated_sq.split("[generate]")
-        generate_suggested_question_list = [s.strip() for s in split_strings if s.strip()]
-
+        agent_search_result = await run_blocking("default", agent_text_search, search_box, model_type,
+                                                 database_profile,
+                                                 entity_slot, opensearch_info,
+                                                 selected_profile, use_rag_flag, agent_cot_task_result)
 
     if search_intent_flag:
         if normal_search_result.sql != "":
@@ -495,79 +591,113 @@ async def ask_websocket(websocket: WebSocket, question: Question):
 
         await response_websocket(websocket, session_id, "Database SQL Execution", ContentEnum.STATE, "start", user_id)
 
-        search_intent_result = get_sql_result_tool(database_profile,
-                                                   current_nlq_chain.get_generated_sql())
+        if cached_answer is not None and cached_answer.data is not None:
+            search_intent_result = cached_answer.to_sql_result()
+        else:
+            if normal_search_result.sql_result_future is not None:
+                search_intent_result = await normal_search_result.sql_result_future
+            else:
+                search_intent_result = await run_blocking("database", get_sql_result_tool, database_profile,
+                                                          current_nlq_chain.get_generated_sql(), model_type,
+                                                          search_box)
+            if cached_answer is None and search_intent_result["status_code"] == 200:
+                await run_blocking("default", AnswerCacheManagement.put_answer, selected_profile, database_profile,
+                                   search_box, search_intent_result["sql"], normal_search_result.response,
+                                   search_intent_result["data"])
 
         await response_websocket(websocket, session_id, "Database SQL Execution", ContentEnum.STATE, "end", user_id)
 
-        if search_intent_result["status_code"] == 500:
+        # the insights, the chart selection and the suggested questions are independent, each one is pushed to
+        # the client as soon as it is ready
+        post_processing_tasks = {}
+        if suggested_question_task is not None:
+            post_processing_tasks[suggested_question_task] = ContentEnum.SUGGESTED_QUESTION
+        if search_intent_result.get("rewritten"):
+            # the generated SQL was over the cost budget, the cheaper rewrite was executed
+            sql_search_result.sql = search_intent_result["sql"].strip()
+        sql_search_result.truncated = search_intent_result.get("truncated", False)
+        sql_search_result.total_count = search_intent_result.get("total_count")
+        if search_intent_result["status_code"] == 200:
+            sql_search_result.sql_data_columnar = await run_blocking("default", encode_result,
+                                                                     search_intent_result["data"], result_format)
+        if search_intent_result.get("status") == QUERY_STATUS_TIMEOUT:
+            sql_search_result.data_analyse = "The query took too long and was stopped, please try a more specific question."
+        elif search_intent_result.get("status") == QUERY_STATUS_REJECTED:
+            sql_search_result.data_analyse = "The query is estimated too expensive to run, please try a more specific question."
+        elif search_intent_result["status_code"] == 500:
             sql_search_result.data_analyse = "The query results are temporarily unavailable, please switch to debugging webpage to try the same query and check the log file for more information."
-        else:
-            if search_intent_result["data"] is not None and len(search_intent_result["data"]) > 0:
-                search_intent_result["data"] = search_intent_result["data"].fillna("")
-                if answer_with_insights:
-                    await response_websocket(websocket, session_id, "Generating Data Insights", ContentEnum.STATE,
-                                             "start", user_id)
-                    search_intent_analyse_result = data_analyse_tool(model_type, prompt_map, search_box,
-                                                                     search_intent_result["data"].to_json(
-                                                                         orient='records', force_ascii=False), "query")
-
-                    await response_websocket(websocket, session_id, "Generating Data Insights", ContentEnum.STATE,
-                                             "end", user_id)
-
-                    sql_search_result.data_analyse = search_intent_analyse_result
-
-                model_select_type, show_select_data, select_chart_type, show_chart_data = data_visualization(model_type,
-                                                                                                             search_box,
-                                                                                                             search_intent_result[
-                                                                                                                 "data"],
-                                                                                                             database_profile[
-                                                                                                                 'prompt_map'])
-
-                if select_chart_type != "-1":
-                    sql_chart_data = ChartEntity(chart_type="", chart_data=[])
-                    sql_chart_data.chart_type = select_chart_type
-                    sql_chart_data.chart_data = show_chart_data
-                    sql_search_result.sql_data_chart = [sql_chart_data]
-
-                sql_search_result.sql_data = show_select_data
-                sql_search_result.data_show_type = model_select_type
+        elif search_intent_result["data"] is not None and len(search_intent_result["data"]) > 0:
+            search_intent_result["data"] = search_intent_result["data"].fillna("")
+            if answer_with_insights:
+                await response_websocket(websocket, session_id, "Generating Data Insights", ContentEnum.STATE,
+                                         "start", user_id)
+                data_analyse_task = asyncio.ensure_future(
+                    run_blocking("llm", data_analyse_tool, model_type, prompt_map, search_box,
+                                 search_intent_result["data"].to_json(orient='records', force_ascii=False),
+                                 "query"))
+                post_processing_tasks[data_analyse_task] = ContentEnum.DATA_ANALYSE
+            data_visualization_task = asyncio.ensure_future(
+                run_blocking("llm", data_visualization, model_type, search_box, search_intent_result["data"],
+                             database_profile['prompt_map'], result_format == RESULT_FORMAT_ROWS))
+            post_processing_tasks[data_visualization_task] = ContentEnum.VISUALIZATION
+
+        post_processing_results = await push_results_when_ready(websocket, session_id, user_id,
+                                                                post_processing_tasks)
+        if ContentEnum.DATA_ANALYSE in post_processing_results:
+            await response_websocket(websocket, session_id, "Generating Data Insights", ContentEnum.STATE,
+                                     "end", user_id)
+            sql_search_result.data_analyse = post_processing_results[ContentEnum.DATA_ANALYSE]
+        generate_suggested_question_list = post_processing_results.get(ContentEnum.SUGGESTED_QUESTION, [])
+
+        if ContentEnum.VISUALIZATION in post_processing_results:
+            model_select_type, show_select_data, select_chart_type, show_chart_data = \
+                post_processing_results[ContentEnum.VISUALIZATION]
+
+            if select_chart_type != "-1":
+                sql_chart_data = ChartEntity(chart_type="", chart_data=[])
+                sql_chart_data.chart_type = select_chart_type
+                sql_chart_data.chart_data = show_chart_data
+                sql_search_result.sql_data_chart = [sql_chart_data]
+
+            sql_search_result.sql_data = show_select_data
+            sql_search_result.data_show_type = model_select_type
 
         log_info = str(search_intent_result["error_info"]) + ";" + sql_search_result.data_analyse
-        LogManagement.add_log_to_database(log_id=log_id, user_id=user_id, session_id=session_id,
-                                          profile_name=selected_profile, sql=sql_search_result.sql,
-                                          query=search_box,
-                                          intent="normal_search",
-                                          log_info=log_info,
-                                          time_str=current_time)
+        await run_blocking("default", LogManagement.add_log_to_database, log_id=log_id, user_id=user_id,
+                           session_id=session_id, profile_name=selected_profile, sql=sql_search_result.sql,
+                           query=search_box,
+                           intent="normal_search",
+                           log_info=log_info,
+                           time_str=current_time,
+                           entity_slot=logged_entity_slot,
+                           status=search_intent_result.get("status"),
+                           intent_source=intent_source)
         answer = Answer(query=search_box, query_intent="normal_search", knowledge_search_result=knowledge_search_result,
                         sql_search_result=sql_search_result, agent_search_result=agent_search_response,
                         suggested_question=generate_suggested_question_list)
         return answer
     else:
         sub_search_task = []
+        agent_task_results = await asyncio.gather(
+            *[run_blocking("agent", execute_agent_task, database_profile, model_type, each_task, result_format)
+              for each_task in agent_search_result])
         for i in range(len(agent_search_result)):
-            each_task_res = get_sql_result_tool(database_profile, agent_search_result[i]["sql"])
+            each_task_res, each_task_visualization = agent_task_results[i]
             if each_task_res["status_code"] == 200 and len(each_task_res["data"]) > 0:
                 agent_search_result[i]["data_result"] = each_task_res["data"].to_json(
                     orient='records')
                 filter_deep_dive_sql_result.append(agent_search_result[i])
-                each_task_sql_res = [list(each_task_res["data"].columns)] + each_task_res["data"].values.tolist()
 
-                model_select_type, show_select_data, select_chart_type, show_chart_data = data_visualization(model_type,
-                                                                                                             agent_search_result[
-                                                                                                                 i][
-                                                                                                                 "query"],
-                                                                                                             each_task_res[
-                                                                                                                 "data"],
-                                                                                                             database_profile[
-                                                                                                                 'prompt_map'])
+                model_select_type, show_select_data, select_chart_type, show_chart_data = each_task_visualization
 
                 each_task_sql_response = get_generated_sql_explain(agent_search_result[i]["response"])
                 sub_task_sql_result = SQLSearchResult(sql_data=show_select_data, sql=each_task_res["sql"],
                                                       data_show_type=model_select_type,
                                                       sql_gen_process=each_task_sql_response,
-                                                      data_analyse="", sql_data_chart=[])
+                                                      data_analyse="", sql_data_chart=[],
+                                                      truncated=each_task_res.get("truncated", False),
+                                                      total_count=each_task_res.get("total_count"),
+                                                      sql_data_columnar=each_task_res.get("columnar"))
                 if select_chart_type != "-1":
                     sub_sql_chart_data = ChartEntity(chart_type="", chart_data=[])
                     sub_sql_chart_data.chart_type = select_chart_type
@@ -583,19 +713,25 @@ async def ask_websocket(websocket: WebSocket, question: Question):
             else:
                 log_info = agent_search_result[i]["query"] + "The SQL error Info: "
             log_id = generate_log_id()
-            LogManagement.add_log_to_database(log_id=log_id, user_id=user_id, session_id=session_id,
-                                              profile_name=selected_profile, sql=each_task_res["sql"],
-                                              query=search_box + "; The sub task is " + agent_search_result[i]["query"],
-                                              intent="agent_search",
-                                              log_info=log_info,
-                                              time_str=current_time)
-        agent_data_analyse_result = data_analyse_tool(model_type, prompt_map, search_box,
-                                                      json.dumps(filter_deep_dive_sql_result, ensure_ascii=False),
-                                                      "agent")
+            await run_blocking("default", LogManagement.add_log_to_database, log_id=log_id, user_id=user_id,
+                               session_id=session_id, profile_name=selected_profile, sql=each_task_res["sql"],
+                               query=search_box + "; The sub task is " + agent_search_result[i]["query"],
+                               intent="agent_search",
+                               log_info=log_info,
+                               time_str=current_time,
+                               status=each_task_res.get("status"),
+                               intent_source=intent_source)
+        agent_data_analyse_result = await run_blocking("llm", data_analyse_tool, model_type, prompt_map, search_box,
+                                                       json.dumps(filter_deep_dive_sql_result, ensure_ascii=False),
+                                                       "agent")
         logger.info("agent_data_analyse_result")
         logger.info(agent_data_analyse_result)
         agent_search_response.agent_summary = agent_data_analyse_result
         agent_search_response.agent_sql_search_result = agent_sql_search_result
+        if suggested_question_task is not None:
+            post_processing_results = await push_results_when_ready(
+                websocket, session_id, user_id, {suggested_question_task: ContentEnum.SUGGESTED_QUESTION})
+            generate_suggested_question_list = post_processing_results[ContentEnum.SUGGESTED_QUESTION]
 
         answer = Answer(query=search_box, query_intent="agent_search", knowledge_search_result=knowledge_search_result,
                         sql_search_result=sql_search_result, agent_search_result=agent_search_response,
@@ -655,16 +791,35 @@ def explain_with_response_stream(current_nlq_chain: NLQChain) -> dict:
     return explain
 
 
+def classify_query_intent(profile_name, model_id, search_box, prompt_map):
+    """
+    Classify the intent with the local classifier, and with the model when the local classifier is not confident
+    :return: intent dict, and who classified it, see nlq.business.intent_classifier
+    """
+    intent_response = IntentClassifier.classify(profile_name, search_box)
+    if intent_response is not None:
+        return intent_response, INTENT_SOURCE_LOCAL
+    incr('intent.llm')
+    with Timer('intent.llm_seconds'):
+        return get_query_intent(model_id, search_box, prompt_map), INTENT_SOURCE_MODEL
+
+
+def get_suggested_question_list(prompt_map, search_box, model_id):
+    generated_sq = generate_suggested_question(prompt_map, search_box, model_id=model_id)
+    split_strings = generated_sq.split("[generate]")
+    return [s.strip() for s in split_strings if s.strip()]
+
+
 def get_executed_result(current_nlq_chain: NLQChain) -> str:
-    all_profiles = ProfileManagement.get_all_profiles_with_info()
-    sql_query_result = current_nlq_chain.get_executed_result_df(all_profiles[current_nlq_chain.profile])
+    database_profile = ProfileManagement.get_profile_info(current_nlq_chain.profile)
+    sql_query_result = current_nlq_chain.get_executed_result_df(database_profile)
     final_sql_query_result = sql_query_result.to_markdown()
     return final_sql_query_result
 
 
 async def normal_text_search_websocket(websocket: WebSocket, session_id: str, search_box, model_type, database_profile,
                                        entity_slot, opensearch_info, selected_profile, use_rag,user_id,
-                                       model_provider=None):
+                                       model_provider=None, speculative_search=None):
     entity_slot_retrieve = []
     retrieve_result = []
     response = ""
@@ -672,38 +827,45 @@ async def normal_text_search_websocket(websocket: WebSocket, session_id: str, se
     search_result = SearchTextSqlResult(search_query=search_box, entity_slot_retrieve=entity_slot_retrieve,
                                         retrieve_result=retrieve_result, response=response, sql=sql)
     try:
-        if database_profile['db_url'] == '':
-            conn_name = database_profile['conn_name']
-            db_url = ConnectionManagement.get_db_url_by_name(conn_name)
-            database_profile['db_url'] = db_url
-            database_profile['db_type'] = ConnectionManagement.get_db_type_by_name(conn_name)
-
-        if len(entity_slot) > 0 and use_rag:
-            await response_websocket(websocket, session_id, "Entity Info Retrieval", ContentEnum.STATE, "start", user_id)
-            for each_entity in entity_slot:
-                entity_retrieve = get_retrieve_opensearch(opensearch_info, each_entity, "ner",
-                                                          selected_profile, 1, 0.7)
-                if len(entity_retrieve) > 0:
-                    entity_slot_retrieve.extend(entity_retrieve)
-            await response_websocket(websocket, session_id, "Entity Info Retrieval", ContentEnum.STATE, "end", user_id)
+        await run_blocking("default", ConnectionManagement.resolve_profile_connection, database_profile)
 
         if use_rag:
+            # entity and QA retrievals are independent, run them concurrently
+            if len(entity_slot) > 0:
+                await response_websocket(websocket, session_id, "Entity Info Retrieval", ContentEnum.STATE, "start",
+                                         user_id)
             await response_websocket(websocket, session_id, "QA Info Retrieval", ContentEnum.STATE, "start", user_id)
-            retrieve_result = get_retrieve_opensearch(opensearch_info, search_box, "query",
-                                                      selected_profile, 3, 0.5)
+            entity_slot_retrieve, retrieve_result = await normal_retrieve_async(opensearch_info, search_box,
+                                                                                entity_slot, selected_profile,
+                                                                                use_rag, speculative_search)
+            if len(entity_slot) > 0:
+                await response_websocket(websocket, session_id, "Entity Info Retrieval", ContentEnum.STATE, "end",
+                                         user_id)
             await response_websocket(websocket, session_id, "QA Info Retrieval", ContentEnum.STATE, "end", user_id)
 
         await response_websocket(websocket, session_id, "Generating SQL", ContentEnum.STATE, "start", user_id)
 
-        response = text_to_sql(database_profile['tables_info'],
-                               database_profile['hints'],
-                               database_profile['prompt_map'],
-                               search_box,
-                               model_id=model_type,
-                               sql_examples=retrieve_result,
-                               ner_example=entity_slot_retrieve,
-                               dialect=database_profile['db_type'],
-                               model_provider=model_provider)
+        response = None
+        if speculative_search is not None:
+            response = await speculative_search.get_response_async(entity_slot_retrieve)
+            speculative_search.commit()
+        sql_result_future = None
+        if response is None and WS_STREAM_SQL:
+            response, sql_result_future = await stream_text_to_sql_websocket(websocket, session_id, user_id,
+                                                                             search_box, model_type, database_profile,
+                                                                             retrieve_result, entity_slot_retrieve,
+                                                                             model_provider)
+        elif response is None:
+            response = await run_blocking("llm", text_to_sql, database_profile['tables_info'],
+                                          database_profile['hints'],
+                                          database_profile['prompt_map'],
+                                          search_box,
+                                          model_id=model_type,
+                                          sql_examples=retrieve_result,
+                                          ner_example=entity_slot_retrieve,
+                                          dialect=database_profile['db_type'],
+                                          model_provider=model_provider,
+                                          profile_key=database_profile.get('profile_key'))
         logger.info(f'{response=}')
         await response_websocket(websocket, session_id, "Generating SQL", ContentEnum.STATE, "end", user_id)
         sql = get_generated_sql(response)
@@ -713,11 +875,77 @@ async def normal_text_search_websocket(websocket: WebSocket, session_id: str, se
         search_result.retrieve_result = retrieve_result
         search_result.response = response
         search_result.sql = sql
+        search_result.sql_result_future = sql_result_future
     except Exception as e:
         logger.error(e)
     return search_result
 
 
+async def stream_text_to_sql_websocket(websocket: WebSocket, session_id: str, user_id: str, search_box, model_type,
+                                       database_profile, retrieve_result, entity_slot_retrieve, model_provider=None):
+    """
+    Generate the SQL with a streamed response, relaying the SQL and explanation tokens to the client as they arrive,
+    and the extracted SQL as soon as </sql> is generated. The SQL execution starts at the same time, while the
+    explanation is still being generated.
+    :return: the complete response and the task of the get_sql_result_tool result, None if no SQL was generated
+    """
+    parser = GeneratedSQLStreamParser()
+    sql_result_task = None
+    cancellation = QueryCancellation()
+    completed = False
+    try:
+        async for text in iterate_blocking("llm", text_to_sql_stream, database_profile['tables_info'],
+                                           database_profile['hints'],
+                                           database_profile['prompt_map'],
+                                           search_box,
+                                           model_id=model_type,
+                                           sql_examples=retrieve_result,
+                                           ner_example=entity_slot_retrieve,
+                                           dialect=database_profile['db_type'],
+                                           model_provider=model_provider,
+                                           profile_key=database_profile.get('profile_key')):
+            part = "explain" if parser.sql_ready else "sql"
+            sql_completed = parser.feed(text)
+            await response_websocket(websocket, session_id, {"text": text, "part": part}, ContentEnum.SQL_STREAM,
+                                     user_id=user_id)
+            if sql_completed:
+                if EARLY_SQL_EXECUTION:
+                    sql_result_task = asyncio.ensure_future(
+                        run_blocking("database", get_early_sql_result, cancellation, database_profile, parser.sql,
+                                     model_type, search_box))
+                await response_websocket(websocket, session_id, parser.sql, ContentEnum.SQL, user_id=user_id)
+        completed = True
+    finally:
+        if not completed and sql_result_task is not None:
+            # nobody waits for the result, the query is stopped on the database
+            sql_result_task.cancel()
+            await run_blocking("default", cancellation.cancel)
+    return parser.response, sql_result_task
+
+
+async def push_results_when_ready(websocket: WebSocket, session_id: str, user_id: str, tasks: dict):
+    """
+    Send the result of each task to the client as soon as it is ready
+    :param tasks: map of asyncio task to the content type of its result
+    :return: map of content type to result
+    """
+    results = {}
+    pending = set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            content_type = tasks[task]
+            result = task.result()
+            results[content_type] = result
+            content = result
+            if content_type == ContentEnum.VISUALIZATION:
+                model_select_type, show_select_data, select_chart_type, show_chart_data = result
+                content = {"data_show_type": model_select_type, "sql_data": show_select_data,
+                           "chart_type": select_chart_type, "chart_data": show_chart_data}
+            await response_websocket(websocket, session_id, content, content_type, user_id=user_id)
+    return results
+
+
 async def response_websocket(websocket: WebSocket, session_id: str, content,
                              content_type: ContentEnum = ContentEnum.COMMON, status: str = "-1",
                              user_id: str = "admin"):
@@ -0,0 +1,167 @@
+"""
+Load benchmark of the ask_websocket pipeline with stubbed backends.
+
+Each session runs the stages of a normal search: intent, three retrievals, text-to-SQL, the SQL query and the
+analysis. The Bedrock, OpenSearch and database calls are stubbed by calls blocking their thread for a fixed latency,
+as boto3, opensearch-py and SQLAlchemy do. The sessions run either through the stage thread pools of utils.executor,
+as ask_websocket does, or with the blocking calls made on the event loop. A few sessions hit a slow model, the
+latency of the other sessions, the lag of the event loop and the queueing of each stage show how they are isolated.
+
+    python -m benchmarks.ask_websocket_load --sessions 1,10,50,200
+
+The stage pools are sized by LLM_CONCURRENCY, RETRIEVAL_CONCURRENCY and DATABASE_CONCURRENCY, as in the service.
+"""
+import argparse
+import asyncio
+import functools
+import statistics
+import threading
+import time
+
+from utils.executor import run_blocking, gather_blocking, shutdown_executors, stage_concurrency_map
+
+MODE_EXECUTOR = 'executor'
+MODE_BLOCKING = 'blocking'
+
+
+class StageProbe:
+    """
+    Per-stage in-flight calls and queueing of the stub backends
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.max_in_flight = {}
+        self.waits = {}
+
+    def call(self, stage, seconds, submitted_at):
+        with self.lock:
+            self.waits.setdefault(stage, []).append(time.perf_counter() - submitted_at)
+            self.in_flight[stage] = self.in_flight.get(stage, 0) + 1
+            self.max_in_flight[stage] = max(self.max_in_flight.get(stage, 0), self.in_flight[stage])
+        try:
+            time.sleep(seconds)
+        finally:
+            with self.lock:
+                self.in_flight[stage] -= 1
+
+    def stats(self):
+        with self.lock:
+            return {stage: {'max_in_flight': self.max_in_flight[stage],
+                            'p95_queue_ms': percentile(waits, 0.95) * 1000}
+                    for stage, waits in self.waits.items()}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+async def call_backend(mode, probe, stage, seconds):
+    if mode == MODE_BLOCKING:
+        return probe.call(stage, seconds, time.perf_counter())
+    return await run_blocking(stage, probe.call, stage, seconds, time.perf_counter())
+
+
+async def answer_question(mode, probe, latencies, asked_at):
+    """
+    :param latencies: seconds of the llm, retrieval and database calls of the session
+    :param asked_at: time the question was asked, a session waiting for the event loop is late to start
+    :return: seconds the session took to answer
+    """
+    # intent
+    await call_backend(mode, probe, 'llm', latencies['llm'])
+    # query, NER and agent retrievals
+    if mode == MODE_BLOCKING:
+        for _ in range(3):
+            probe.call('retrieval', latencies['retrieval'], time.perf_counter())
+    else:
+        await gather_blocking('retrieval', [functools.partial(probe.call, 'retrieval', latencies['retrieval'],
+                                                              time.perf_counter()) for _ in range(3)])
+    # text-to-SQL, query, analysis
+    await call_backend(mode, probe, 'llm', latencies['llm'])
+    await call_backend(mode, probe, 'database', latencies['database'])
+    await call_backend(mode, probe, 'llm', latencies['llm'])
+    return time.perf_counter() - asked_at
+
+
+async def monitor_loop_lag(stop, interval=0.01):
+    """
+    :return: max seconds the event loop was late to wake up a sleeping task
+    """
+    max_lag = 0.0
+    while not stop.is_set():
+        start_time = time.perf_counter()
+        await asyncio.sleep(interval)
+        max_lag = max(max_lag, time.perf_counter() - start_time - interval)
+    return max_lag
+
+
+async def run_sessions(mode, sessions, slow_sessions, latencies, slow_latencies):
+    probe = StageProbe()
+    stop = asyncio.Event()
+    lag_task = asyncio.ensure_future(monitor_loop_lag(stop))
+    start_time = time.perf_counter()
+    # the questions of the slow sessions are asked with the others, and answered by a slow model
+    slow_tasks = [asyncio.ensure_future(answer_question(mode, probe, slow_latencies, start_time))
+                  for _ in range(slow_sessions)]
+    session_seconds = await asyncio.gather(*[answer_question(mode, probe, latencies, start_time)
+                                             for _ in range(sessions)])
+    elapsed = time.perf_counter() - start_time
+    await asyncio.gather(*slow_tasks)
+    stop.set()
+    return {
+        'mode': mode,
+        'sessions': sessions,
+        'p50_ms': statistics.median(session_seconds) * 1000,
+        'p95_ms': percentile(session_seconds, 0.95) * 1000,
+        'max_ms': max(session_seconds) * 1000,
+        'sessions_per_second': sessions / elapsed,
+        'max_loop_lag_ms': await lag_task * 1000,
+        'stages': probe.stats(),
+    }
+
+
+def print_result(result, baseline_p50_ms):
+    stages = ', '.join(f"{stage} max {stats['max_in_flight']} in flight p95 queue {stats['p95_queue_ms']:.0f}ms"
+                       for stage, stats in sorted(result['stages'].items()))
+    print(f"{result['mode']:>8} {result['sessions']:>8} {result['p50_ms']:>8.0f} {result['p95_ms']:>8.0f} "
+          f"{result['max_ms']:>8.0f} {result['p50_ms'] / baseline_p50_ms:>6.2f}x {result['sessions_per_second']:>9.1f} "
+          f"{result['max_loop_lag_ms']:>8.0f}  {stages}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sessions', default='1,10,50,200', help='comma-separated concurrent sessions per run')
+    parser.add_argument('--slow-sessions', type=int, default=2, help='sessions hitting the slow model')
+    parser.add_argument('--llm-ms', type=float, default=100)
+    parser.add_argument('--slow-llm-ms', type=float, default=1000)
+    parser.add_argument('--retrieval-ms', type=float, default=20)
+    parser.add_argument('--database-ms', type=float, default=50)
+    parser.add_argument('--modes', default=f'{MODE_EXECUTOR},{MODE_BLOCKING}')
+    parser.add_argument('--max-blocking-sessions', type=int, default=50,
+                        help='larger runs of the blocking mode are skipped, its sessions run one at a time')
+    args = parser.parse_args()
+
+    latencies = {'llm': args.llm_ms / 1000, 'retrieval': args.retrieval_ms / 1000,
+                 'database': args.database_ms / 1000}
+    slow_latencies = dict(latencies, llm=args.slow_llm_ms / 1000)
+    print(f"stage concurrency: {stage_concurrency_map}")
+    print(f"{'mode':>8} {'sessions':>8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'p50/1':>7} {'sessions/s':>9} "
+          f"{'lag ms':>8}  stages")
+    try:
+        for mode in args.modes.split(','):
+            baseline_p50_ms = None
+            for sessions in [int(sessions) for sessions in args.sessions.split(',')]:
+                if mode == MODE_BLOCKING and sessions > args.max_blocking_sessions:
+                    continue
+                result = asyncio.run(run_sessions(mode, sessions, args.slow_sessions, latencies, slow_latencies))
+                baseline_p50_ms = baseline_p50_ms or result['p50_ms']
+                print_result(result, baseline_p50_ms)
+    finally:
+        shutdown_executors()
+
+
+if __name__ == '__main__':
+    main()
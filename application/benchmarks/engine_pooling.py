@@ -0,0 +1,101 @@
+"""
+Per-query latency of the generated queries with an engine created for each query, as before, and with the shared
+pooled engines of RelationDatabase.
+
+The database is a SQLite file, whose connections are local and cheap. The TCP, TLS and authentication handshakes of
+MySQL, PostgreSQL or Redshift are simulated by a delay on each new DBAPI connection. The queries run one at a time
+and from concurrent threads, like the database stage of the service does.
+
+    python -m benchmarks.engine_pooling --queries 200 --threads 1,8 --connect-ms 20
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlalchemy
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+
+from nlq.data_access.database import RelationDatabase
+from utils.env_var import DB_POOL_SIZE, DB_MAX_OVERFLOW
+
+QUERY = "SELECT category, SUM(amount) FROM sales GROUP BY category"
+
+
+def create_database(path):
+    engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE sales (id INTEGER PRIMARY KEY, category TEXT, amount REAL)"))
+        connection.execute(text("INSERT INTO sales (category, amount) "
+                                "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 1000) "
+                                "SELECT 'category' || (i % 10), i * 1.5 FROM n"))
+    engine.dispose()
+
+
+def query_with_new_engine(db_url):
+    engine = sqlalchemy.create_engine(db_url)
+    try:
+        with engine.connect() as connection:
+            return connection.execute(text(QUERY)).fetchall()
+    finally:
+        engine.dispose()
+
+
+def query_with_shared_engine(db_url):
+    with RelationDatabase.get_engine(db_url).connect() as connection:
+        return connection.execute(text(QUERY)).fetchall()
+
+
+def timed_query(query, db_url):
+    start_time = time.perf_counter()
+    query(db_url)
+    return time.perf_counter() - start_time
+
+
+def run(query, db_url, queries, threads):
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        seconds = list(executor.map(lambda _: timed_query(query, db_url), range(queries)))
+    elapsed = time.perf_counter() - start_time
+    seconds.sort()
+    return {
+        'p50_ms': statistics.median(seconds) * 1000,
+        'p95_ms': seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))] * 1000,
+        'queries_per_second': queries / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--threads', default='1,8', help='comma-separated concurrent threads per run')
+    parser.add_argument('--connect-ms', type=float, default=20, help='simulated handshake of a new connection')
+    args = parser.parse_args()
+
+    connections = []
+
+    @event.listens_for(Engine, 'do_connect')
+    def simulate_handshake(dialect, conn_rec, cargs, cparams):
+        connections.append(1)
+        time.sleep(args.connect_ms / 1000)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'benchmark.db')
+        create_database(path)
+        db_url = f"sqlite:///{path}"
+        print(f"pool size {DB_POOL_SIZE}, max overflow {DB_MAX_OVERFLOW}, connect {args.connect_ms:.0f}ms")
+        print(f"{'engine':>10} {'threads':>7} {'p50 ms':>8} {'p95 ms':>8} {'queries/s':>10} {'connections':>11}")
+        for threads in [int(threads) for threads in args.threads.split(',')]:
+            for name, query in (('per query', query_with_new_engine), ('shared', query_with_shared_engine)):
+                connections.clear()
+                result = run(query, db_url, args.queries, threads)
+                print(f"{name:>10} {threads:>7} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} "
+                      f"{result['queries_per_second']:>10.1f} {len(connections):>11}")
+            RelationDatabase.dispose_engine(db_url)
+
+
+if __name__ == '__main__':
+    main()
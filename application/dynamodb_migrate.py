@@ -0,0 +1,22 @@
+import logging
+
+from dotenv import load_dotenv
+
+from nlq.data_access.dynamo_query_log import DynamoQueryLogDao
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+
+def migrate_dynamodb():
+    """
+    Bring the DynamoDB tables of an existing deployment up to date, new tables are created up to date
+    """
+    query_log_dao = DynamoQueryLogDao()
+    query_log_dao.create_profile_time_index()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    migrate_dynamodb()
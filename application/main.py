@@ -6,6 +6,7 @@ from api.main import router
 from fastapi.middleware.cors import CORSMiddleware
 from api import service
 from api.schemas import Option
+from utils.executor import shutdown_executors
 
 app = FastAPI(title='GenBI')
 
@@ -23,6 +24,12 @@ biz_exception(app)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.include_router(router)
 
+
+@app.on_event("shutdown")
+def shutdown():
+    shutdown_executors()
+
+
 # changed from "/" to "/test" to avoid health check fails in ECS
 @app.get("/test", status_code=status.HTTP_302_FOUND)
 def index():
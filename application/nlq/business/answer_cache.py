@@ -0,0 +1,166 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass, replace
+from typing import Any
+
+import numpy as np
+
+from nlq.business.profile import ProfileManagement
+from utils.env_var import SEMANTIC_CACHE_ENABLED, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL, \
+    SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_WITH_RESULT
+from utils.metrics import incr, get_counter, register_gauge
+from utils.opensearch import get_query_embedding
+from utils.tool import get_question_literals, replace_generated_sql
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(*texts):
+    # rough estimate of 4 characters per token, only used to report the savings of the cache
+    return sum(len(text) for text in texts) // 4
+
+
+def normalize_vector(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    sql: str
+    response: str
+    data: Any = None
+    similarity: float = 1.0
+
+    def to_sql_result(self):
+        """
+        The cached result set in the format of get_sql_result_tool
+        """
+        return {"data": self.data.copy(), "sql": self.sql, "status_code": 200, "error_info": ""}
+
+
+@dataclass
+class AnswerCacheEntry:
+    vector: Any
+    answer: CachedAnswer
+    literals: tuple
+    version: tuple
+    expire_at: float
+    estimated_tokens: int
+
+
+class AnswerCacheManagement:
+    """
+    Per-profile semantic cache of the SQL generated for a question. A question whose embedding is close enough
+    to a cached question with the same literals (numbers, years, quoted strings) reuses its SQL, and optionally its
+    result set, so that "sales in 2023" does not reuse the SQL of "sales in 2024". Entries are dropped when the
+    profile (tables_info, prompt_map) or its few-shot samples change.
+
+    The cache is local to the process: the few-shot sample changes only invalidate the entries of the process that
+    made them, the other processes and replicas keep serving their entries until the profile version changes or
+    SEMANTIC_CACHE_TTL expires them.
+    """
+    entries = {}
+    sample_versions = {}
+    lock = threading.Lock()
+
+    @classmethod
+    def get_version(cls, profile_name):
+        return ProfileManagement.get_profile_version(profile_name), cls.sample_versions.get(profile_name, 0)
+
+    @classmethod
+    def get_answer(cls, profile_name, question):
+        """
+        Get the cached answer of the most similar question above the similarity threshold with the same literals
+        :param profile_name:
+        :param question:
+        :return: CachedAnswer or None
+        """
+        if not SEMANTIC_CACHE_ENABLED:
+            return None
+        try:
+            vector = normalize_vector(get_query_embedding(question))
+        except Exception as e:
+            logger.error(f"Failed to embed question for the answer cache: {e}")
+            return None
+        literals = get_question_literals(question)
+        version = cls.get_version(profile_name)
+        now = time.monotonic()
+        with cls.lock:
+            profile_entries = [entry for entry in cls.entries.get(profile_name, [])
+                               if entry.version == version and entry.expire_at > now]
+            cls.entries[profile_name] = profile_entries
+            best_entry = None
+            similarity = 0.0
+            if profile_entries:
+                similarities = np.stack([entry.vector for entry in profile_entries]) @ vector
+                # a question about other values, e.g. another year, needs its own SQL however similar it is
+                similarities[[entry.literals != literals for entry in profile_entries]] = -1.0
+                best_index = int(np.argmax(similarities))
+                similarity = float(similarities[best_index])
+                if similarity >= SEMANTIC_CACHE_THRESHOLD:
+                    best_entry = profile_entries.pop(best_index)
+                    # keep the most recently used entries at the end, the oldest ones are evicted first
+                    profile_entries.append(best_entry)
+        if best_entry is None:
+            incr('semantic_cache.miss')
+            return None
+        incr('semantic_cache.hit')
+        incr('semantic_cache.tokens_saved', best_entry.estimated_tokens)
+        logger.info(f"Answer cache hit for {question!r}: {best_entry.answer.question!r} "
+                    f"with similarity {similarity:.3f}")
+        return replace(best_entry.answer, similarity=similarity)
+
+    @classmethod
+    def put_answer(cls, profile_name, database_profile, question, sql, response, data=None):
+        """
+        Cache the generated SQL of a question, and its result set when SEMANTIC_CACHE_WITH_RESULT is enabled
+        :param sql: the executed SQL, the SQL of the response is replaced by it if the generated SQL was rewritten
+        :param response: the text-to-SQL response of the LLM
+        """
+        if not SEMANTIC_CACHE_ENABLED or not sql:
+            return
+        try:
+            vector = normalize_vector(get_query_embedding(question))
+        except Exception as e:
+            logger.error(f"Failed to embed question for the answer cache: {e}")
+            return
+        response = replace_generated_sql(response, sql)
+        answer = CachedAnswer(question=question, sql=sql, response=response,
+                              data=data.copy() if SEMANTIC_CACHE_WITH_RESULT and data is not None else None)
+        estimated_tokens = estimate_tokens(str(database_profile['tables_info']), question, response)
+        entry = AnswerCacheEntry(vector=vector, answer=answer, literals=get_question_literals(question),
+                                 version=cls.get_version(profile_name),
+                                 expire_at=time.monotonic() + SEMANTIC_CACHE_TTL, estimated_tokens=estimated_tokens)
+        with cls.lock:
+            profile_entries = cls.entries.setdefault(profile_name, [])
+            profile_entries.append(entry)
+            if len(profile_entries) > SEMANTIC_CACHE_MAX_ENTRIES:
+                del profile_entries[:len(profile_entries) - SEMANTIC_CACHE_MAX_ENTRIES]
+
+    @classmethod
+    def invalidate_samples(cls, profile_name):
+        """
+        Drop the cached answers of a profile after its few-shot samples changed, in this process only
+        """
+        with cls.lock:
+            cls.sample_versions[profile_name] = cls.sample_versions.get(profile_name, 0) + 1
+            cls.entries.pop(profile_name, None)
+
+    @classmethod
+    def stats(cls):
+        hit = get_counter('semantic_cache.hit')
+        total = hit + get_counter('semantic_cache.miss')
+        with cls.lock:
+            entries = sum(len(profile_entries) for profile_entries in cls.entries.values())
+        return {
+            'entries': entries,
+            'hit_rate': hit / total if total else 0.0,
+            'tokens_saved': get_counter('semantic_cache.tokens_saved'),
+        }
+
+
+register_gauge('semantic_cache', AnswerCacheManagement.stats)
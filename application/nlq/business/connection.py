@@ -1,12 +1,31 @@
 import logging
+from dataclasses import dataclass
+from typing import Any
+
 from nlq.data_access.dynamo_connection import ConnectConfigDao, ConnectConfigEntity
 from nlq.data_access.database import RelationDatabase
+from utils.cache import LRUCache
+from utils.env_var import CONNECTION_CACHE_REFRESH_SECONDS
+from utils.metrics import register_gauge
+from utils.result_cache import invalidate_connection_results
 
 logger = logging.getLogger(__name__)
 
 
+@dataclass
+class ConnectionInfo:
+    db_url: Any
+    db_type: str
+
+    @property
+    def engine(self):
+        return RelationDatabase.get_engine(self.db_url)
+
+
 class ConnectionManagement:
     connection_config_dao = ConnectConfigDao()
+    # resolved connections by name, invalidated on connection edits and refreshed for edits of other replicas
+    connection_cache = LRUCache(256, ttl=CONNECTION_CACHE_REFRESH_SECONDS)
 
     @classmethod
     def get_all_connections(cls):
@@ -16,6 +35,7 @@ class ConnectionManagement:
     @classmethod
     def add_connection(cls, conn_name, db_type, db_host, db_port, db_user, db_pwd, db_name, comment):
         cls.connection_config_dao.add_url_db(conn_name, db_type, db_host, db_port, db_user, db_pwd, db_name, comment)
+        cls.connection_cache.invalidate(conn_name)
         logger.info(f"Connection {conn_name} added")
 
     @classmethod
@@ -24,16 +44,24 @@ class ConnectionManagement:
 
     @classmethod
     def update_connection(cls, conn_name, db_type, db_host, db_port, db_user, db_pwd, db_name, comment):
+        # the engine of the previous URL is disposed once the new URL is stored and served, a caller resolving the
+        # connection in between would otherwise create and keep an engine with the previous credentials
+        previous_db_url = cls.get_stored_db_url(conn_name)
         cls.connection_config_dao.update_db_info(conn_name, db_type, db_host, db_port, db_user, db_pwd, db_name,
                                                  comment)
+        cls.connection_cache.invalidate(conn_name)
+        cls.dispose_engine(previous_db_url)
         logger.info(f"Connection {conn_name} updated")
 
     @classmethod
     def delete_connection(cls, conn_name):
+        previous_db_url = cls.get_stored_db_url(conn_name)
         if cls.connection_config_dao.delete(conn_name):
             logger.info(f"Connection {conn_name} deleted")
         else:
             logger.warning(f"Failed to delete Connection {conn_name}")
+        cls.connection_cache.invalidate(conn_name)
+        cls.dispose_engine(previous_db_url)
 
     @classmethod
     def get_table_name_by_config(cls, conn_config: ConnectConfigEntity, schema_names):
@@ -48,11 +76,50 @@ class ConnectionManagement:
         return RelationDatabase.get_table_definition_by_connection(conn_config, schema_names, table_names)
 
     @classmethod
-    def get_db_url_by_name(cls, conn_name):
+    def load_connection_info(cls, conn_name):
         conn_config = cls.get_conn_config_by_name(conn_name)
-        return RelationDatabase.get_db_url_by_connection(conn_config)
+        return ConnectionInfo(db_url=RelationDatabase.get_db_url_by_connection(conn_config),
+                              db_type=conn_config.db_type)
+
+    @classmethod
+    def get_connection_info(cls, conn_name) -> ConnectionInfo:
+        """
+        Resolve the DB URL, dialect and engine of a connection in one cached lookup
+        """
+        return cls.connection_cache.get_or_compute(conn_name, lambda: cls.load_connection_info(conn_name))
+
+    @classmethod
+    def resolve_profile_connection(cls, database_profile):
+        """
+        Fill in db_url and db_type of a data profile that refers to a connection by name
+        """
+        if database_profile['db_url'] == '':
+            connection_info = cls.get_connection_info(database_profile['conn_name'])
+            database_profile['db_url'] = connection_info.db_url
+            database_profile['db_type'] = connection_info.db_type
+        return database_profile
+
+    @classmethod
+    def get_db_url_by_name(cls, conn_name):
+        return cls.get_connection_info(conn_name).db_url
 
     @classmethod
     def get_db_type_by_name(cls, conn_name):
+        return cls.get_connection_info(conn_name).db_type
+
+    @classmethod
+    def get_stored_db_url(cls, conn_name):
+        """
+        :return: DB URL of the stored connection, None if there is no such connection
+        """
         conn_config = cls.get_conn_config_by_name(conn_name)
-        return conn_config.db_type
+        return RelationDatabase.get_db_url_by_connection(conn_config) if conn_config else None
+
+    @classmethod
+    def dispose_engine(cls, db_url):
+        if db_url is not None:
+            RelationDatabase.dispose_engine(db_url)
+            invalidate_connection_results(RelationDatabase.get_engine_key(db_url))
+
+
+register_gauge('connection_cache', ConnectionManagement.connection_cache.stats)
@@ -0,0 +1,232 @@
+import functools
+import json
+import logging
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any
+
+import numpy as np
+
+from nlq.business.answer_cache import normalize_vector
+from nlq.business.log_store import LogManagement
+from utils.env_var import INTENT_CLASSIFIER_ENABLED, INTENT_CLASSIFIER_THRESHOLD, INTENT_CLASSIFIER_SLOT_THRESHOLD, \
+    INTENT_CLASSIFIER_TOP_K, INTENT_CLASSIFIER_MIN_VOTES, INTENT_CLASSIFIER_MAX_EXAMPLES, \
+    INTENT_CLASSIFIER_REFRESH_SECONDS, RETRIEVAL_TIMEOUT, EMBEDDING_MAX_BATCH_SIZE
+from utils.executor import gather, submit
+from utils.metrics import incr, get_counter, register_gauge
+from utils.opensearch import get_query_embedding, get_query_embeddings
+
+logger = logging.getLogger(__name__)
+
+LOGGED_INTENTS = ("normal_search", "agent_search", "knowledge_search", "reject_search")
+DOWNVOTED_INTENTS = ("normal_search_user_downvote", "agent_search_user_downvote")
+AGENT_SUB_TASK_SEPARATOR = "; The sub task is "
+
+# Who classified the intent of a logged query, only the intents of the model are used as labels, the local
+# predictions would otherwise reinforce their own mistakes
+INTENT_SOURCE_MODEL = "model"
+INTENT_SOURCE_LOCAL = "local"
+
+
+@dataclass
+class IntentExample:
+    query: str
+    intent: str
+    slot: Any = None
+
+
+@dataclass
+class IntentIndex:
+    examples: list = field(default_factory=list)
+    vectors: Any = None
+    built_at: float = 0.0
+
+
+def get_intent_examples(logs):
+    """
+    Turn the query logs into labelled examples, one per distinct query, the newest label wins.
+    Only the intents classified by the model are labels, downvoted queries are skipped, and normal searches
+    are only used when their entity slot was logged.
+    :param logs: query logs, newest first
+    """
+    examples = {}
+    downvoted = set()
+    for log in logs:
+        query = log.query.split(AGENT_SUB_TASK_SEPARATOR)[0].strip()
+        if log.intent in DOWNVOTED_INTENTS:
+            # the downvote is logged after the answer, so before it in the newest first logs
+            downvoted.add(query)
+            continue
+        if log.intent not in LOGGED_INTENTS or log.intent_source != INTENT_SOURCE_MODEL:
+            continue
+        if not query or query in examples or query in downvoted:
+            continue
+        if log.intent == "normal_search" and log.entity_slot is None:
+            continue
+        examples[query] = IntentExample(query=query, intent=log.intent, slot=log.entity_slot)
+    return list(examples.values())
+
+
+def build_intent_index(examples):
+    # embedded in batches in the background stage, the retrieval stage is kept for the questions
+    batches = [[example.query for example in examples[start:start + EMBEDDING_MAX_BATCH_SIZE]]
+               for start in range(0, len(examples), EMBEDDING_MAX_BATCH_SIZE)]
+    calls = [functools.partial(get_query_embeddings, batch) for batch in batches]
+    batch_embeddings = gather("background", calls, timeout=RETRIEVAL_TIMEOUT * max(1, len(calls)))
+    embeddings = []
+    for batch, batch_embedding in zip(batches, batch_embeddings):
+        embeddings.extend(batch_embedding if batch_embedding is not None else [None] * len(batch))
+    indexed_examples = []
+    vectors = []
+    for example, embedding in zip(examples, embeddings):
+        if embedding is not None:
+            indexed_examples.append(example)
+            vectors.append(normalize_vector(embedding))
+    return IntentIndex(examples=indexed_examples, vectors=np.stack(vectors) if vectors else None,
+                       built_at=time.monotonic())
+
+
+def classify_with_index(index, vector, threshold=INTENT_CLASSIFIER_THRESHOLD,
+                        slot_threshold=INTENT_CLASSIFIER_SLOT_THRESHOLD, top_k=INTENT_CLASSIFIER_TOP_K,
+                        min_votes=INTENT_CLASSIFIER_MIN_VOTES):
+    """
+    Nearest-neighbour vote over the logged queries
+    :return: intent dict in the format of get_query_intent, None if the neighbours are not confident
+    """
+    if index.vectors is None:
+        return None
+    similarities = index.vectors @ vector
+    top_indexes = np.argsort(-similarities)[:top_k]
+    neighbours = [(index.examples[i], float(similarities[i])) for i in top_indexes if similarities[i] >= threshold]
+    if not neighbours:
+        return None
+    intents = {example.intent for example, similarity in neighbours}
+    nearest, nearest_similarity = neighbours[0]
+    # a near duplicate decides alone, otherwise the close neighbours have to agree
+    if len(intents) != 1 or (len(neighbours) < min_votes and nearest_similarity < slot_threshold):
+        return None
+    intent = nearest.intent
+    if intent == "normal_search":
+        # the entities of a normal search drive the NER retrieval, only a near duplicate knows them
+        if nearest_similarity < slot_threshold or nearest.slot is None:
+            return None
+        return {"intent": intent, "slot": list(nearest.slot)}
+    return {"intent": intent, "slot": []}
+
+
+class IntentClassifier:
+    """
+    Local intent classifier answering confidently classified questions without calling the model, by
+    nearest-neighbour search over the previously logged queries of the profile. The index of a profile is
+    built in the background and refreshed every INTENT_CLASSIFIER_REFRESH_SECONDS.
+    """
+    indexes = {}
+    building = set()
+    lock = threading.Lock()
+
+    @classmethod
+    def get_index(cls, profile_name):
+        with cls.lock:
+            index = cls.indexes.get(profile_name)
+            stale = index is None or time.monotonic() - index.built_at > INTENT_CLASSIFIER_REFRESH_SECONDS
+            if stale and profile_name not in cls.building:
+                cls.building.add(profile_name)
+                submit("default", cls.refresh_index, profile_name)
+        return index
+
+    @classmethod
+    def refresh_index(cls, profile_name):
+        try:
+            logs = LogManagement.get_logs_by_profile(profile_name, INTENT_CLASSIFIER_MAX_EXAMPLES)
+            index = build_intent_index(get_intent_examples(logs))
+            with cls.lock:
+                cls.indexes[profile_name] = index
+            logger.info(f"Intent index of {profile_name} built with {len(index.examples)} examples")
+        except Exception as e:
+            logger.error(f"Failed to build the intent index of {profile_name}: {e}")
+        finally:
+            with cls.lock:
+                cls.building.discard(profile_name)
+
+    @classmethod
+    def classify(cls, profile_name, search_box):
+        """
+        Classify the intent of a question locally
+        :return: intent dict in the format of get_query_intent, None to escalate to the model
+        """
+        if not INTENT_CLASSIFIER_ENABLED:
+            return None
+        index = cls.get_index(profile_name)
+        if index is None:
+            return None
+        try:
+            intent_response = classify_with_index(index, normalize_vector(get_query_embedding(search_box)))
+        except Exception as e:
+            logger.error(f"Local intent classification failed: {e}")
+            intent_response = None
+        incr('intent.local' if intent_response is not None else 'intent.escalated')
+        return intent_response
+
+    @classmethod
+    def stats(cls):
+        local = get_counter('intent.local')
+        total = local + get_counter('intent.escalated')
+        return {'local_rate': local / total if total else 0.0}
+
+
+register_gauge('intent_classifier', IntentClassifier.stats)
+
+
+def evaluate_intent_classifier(profile_name, model_id=None, prompt_map=None, test_ratio=0.2, limit=None):
+    """
+    Replay the logged queries of a profile: the older ones build the index, the newest test_ratio of them
+    are classified locally and compared with their logged intent
+    :param profile_name:
+    :param model_id: if set, the latency of the model is measured on the escalated queries
+    :param prompt_map: prompt map of the model, the default prompts if None
+    :param test_ratio: share of the newest queries replayed
+    :param limit: max number of logs read
+    :return: dict with the local coverage, the local accuracy and the estimated model latency saved
+    """
+    examples = get_intent_examples(LogManagement.get_logs_by_profile(profile_name, limit))
+    test_count = int(len(examples) * test_ratio)
+    # the logs are newest first
+    test_examples, train_examples = examples[:test_count], examples[test_count:]
+    index = build_intent_index(train_examples)
+
+    local = 0
+    correct = 0
+    local_seconds = 0.0
+    model_seconds = []
+    for example in test_examples:
+        start_time = time.perf_counter()
+        intent_response = classify_with_index(index, normalize_vector(get_query_embedding(example.query)))
+        local_seconds += time.perf_counter() - start_time
+        if intent_response is not None:
+            local += 1
+            correct += intent_response['intent'] == example.intent
+        elif model_id is not None:
+            from utils.llm import get_query_intent
+            from utils.prompts.generate_prompt import prompt_map_dict
+            start_time = time.perf_counter()
+            get_query_intent(model_id, example.query, prompt_map or prompt_map_dict)
+            model_seconds.append(time.perf_counter() - start_time)
+
+    total = len(test_examples)
+    average_model_seconds = sum(model_seconds) / len(model_seconds) if model_seconds else None
+    return {
+        'train_examples': len(index.examples),
+        'test_examples': total,
+        'local_coverage': local / total if total else 0.0,
+        'local_accuracy': correct / local if local else None,
+        'average_local_seconds': local_seconds / total if total else 0.0,
+        'average_model_seconds': average_model_seconds,
+        'estimated_seconds_saved': local * average_model_seconds if average_model_seconds is not None else None,
+    }
+
+
+if __name__ == '__main__':
+    # python -m nlq.business.intent_classifier <profile_name> [model_id]
+    print(json.dumps(evaluate_intent_classifier(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None), indent=2))
@@ -9,6 +9,17 @@ class LogManagement:
     query_log_dao = DynamoQueryLogDao()
 
     @classmethod
-    def add_log_to_database(cls, log_id, user_id, session_id, profile_name, sql, query, intent, log_info, time_str):
+    def add_log_to_database(cls, log_id, user_id, session_id, profile_name, sql, query, intent, log_info, time_str,
+                            entity_slot=None, status=None, intent_source=None):
+        """
+        :param entity_slot: entities of a classified normal search
+        :param status: status of the executed query, e.g. timeout, see utils.query_control
+        :param intent_source: who classified the intent, see nlq.business.intent_classifier
+        """
         cls.query_log_dao.add_log(log_id=log_id, profile_name=profile_name, user_id=user_id, session_id=session_id,
-                                  sql=sql, query=query, intent=intent, log_info=log_info, time_str=time_str)
+                                  sql=sql, query=query, intent=intent, log_info=log_info, time_str=time_str,
+                                  entity_slot=entity_slot, status=status, intent_source=intent_source)
+
+    @classmethod
+    def get_logs_by_profile(cls, profile_name, limit=None):
+        return cls.query_log_dao.get_logs_by_profile(profile_name, limit)
@@ -2,7 +2,7 @@ import pandas as pd
 import re
 import logging
 from nlq.business.connection import ConnectionManagement
-from utils.apis import query_from_sql_pd
+from utils.apis import query_from_sql_pd, get_profile_max_rows, get_profile_result_cache_ttl
 logger = logging.getLogger(__name__)
 
 class NLQChain:
@@ -75,7 +75,9 @@ class NLQChain:
                 return pd.DataFrame()
             self.executed_result_df = query_from_sql_pd(
                 p_db_url=db_url,
-                query=self.get_generated_sql())
+                query=self.get_generated_sql(),
+                max_rows=get_profile_max_rows(profile),
+                result_cache_ttl=get_profile_result_cache_ttl(profile))
 
         return self.executed_result_df
 
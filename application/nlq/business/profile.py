@@ -1,38 +1,128 @@
+import hashlib
+import json
 import logging
+import threading
+
 from nlq.data_access.dynamo_profile import ProfileConfigDao, ProfileConfigEntity
+from utils.cache import LRUCache
+from utils.env_var import PROFILE_CACHE_REFRESH_SECONDS
+from utils.metrics import register_gauge
 
 logger = logging.getLogger(__name__)
 
+
+def to_profile_info(profile: ProfileConfigEntity):
+    return {
+        'db_url': '',
+        'conn_name': profile.conn_name,
+        'tables_info': profile.tables_info,
+        'hints': '',
+        'search_samples': [],
+        'comments': profile.comments,
+        'prompt_map': profile.prompt_map,
+        'max_rows': int(profile.max_rows) if profile.max_rows is not None else None,
+        'result_cache_ttl': int(profile.result_cache_ttl) if profile.result_cache_ttl is not None else None
+    }
+
+
+def get_profile_fingerprint(profile_info):
+    if profile_info is None:
+        return None
+    return hashlib.sha1(json.dumps(profile_info, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
 class ProfileManagement:
     profile_config_dao = ProfileConfigDao()
+    # Read-through cache of the profile info, entries expire after PROFILE_CACHE_REFRESH_SECONDS so that
+    # changes made by other replicas converge, and are invalidated at once by the changes made here
+    profile_cache = LRUCache(1024, ttl=PROFILE_CACHE_REFRESH_SECONDS)
+    profile_names_cache = LRUCache(1, ttl=PROFILE_CACHE_REFRESH_SECONDS)
+    profile_versions = {}
+    profile_fingerprints = {}
+    profile_versions_lock = threading.Lock()
 
     @classmethod
     def get_all_profiles(cls):
+        return cls.profile_names_cache.get_or_compute('all', cls.load_all_profiles)
+
+    @classmethod
+    def load_all_profiles(cls):
         logger.info('get all profiles...')
-        return [conn.profile_name for conn in cls.profile_config_dao.get_profile_list()]
+        profile_names = []
+        for profile in cls.profile_config_dao.get_profile_list():
+            profile_info = to_profile_info(profile)
+            profile_info['profile_key'] = (profile.profile_name,
+                                           cls.track_profile_version(profile.profile_name, profile_info))
+            cls.profile_cache.put(profile.profile_name, profile_info)
+            profile_names.append(profile.profile_name)
+        return profile_names
+
+    @classmethod
+    def load_profile_info(cls, profile_name):
+        logger.info(f'get profile {profile_name} with info...')
+        profile = cls.profile_config_dao.get_by_name(profile_name)
+        profile_info = to_profile_info(profile) if profile else None
+        version = cls.track_profile_version(profile_name, profile_info)
+        if profile_info is not None:
+            profile_info['profile_key'] = (profile_name, version)
+        return profile_info
+
+    @classmethod
+    def get_profile_info(cls, profile_name):
+        """
+        Get the info of one profile, None if the profile does not exist. Its profile_key, the profile name and
+        version, identifies the tables and prompts of the profile for the caches derived from them.
+        :param profile_name:
+        :return: a shallow copy of the cached profile info, callers may set keys such as db_url on it
+        """
+        profile_info = cls.profile_cache.get_or_compute(profile_name,
+                                                        lambda: cls.load_profile_info(profile_name))
+        return dict(profile_info) if profile_info is not None else None
 
     @classmethod
     def get_all_profiles_with_info(cls):
-        logger.info('get all profiles with info...')
-        profile_list = cls.profile_config_dao.get_profile_list()
         profile_map = {}
-        for profile in profile_list:
-            profile_map[profile.profile_name] = {
-                'db_url': '',
-                'conn_name': profile.conn_name,
-                'tables_info': profile.tables_info,
-                'hints': '',
-                'search_samples': [],
-                'comments':  profile.comments,
-                'prompt_map': profile.prompt_map
-            }
-
+        for profile_name in cls.get_all_profiles():
+            profile_info = cls.get_profile_info(profile_name)
+            if profile_info is not None:
+                profile_map[profile_name] = profile_info
         return profile_map
 
+    @classmethod
+    def get_profile_version(cls, profile_name):
+        """
+        Get the version of a profile, increased on every change, so that caches derived from a profile
+        can tell whether they are stale
+        """
+        with cls.profile_versions_lock:
+            return cls.profile_versions.get(profile_name, 0)
+
+    @classmethod
+    def track_profile_version(cls, profile_name, profile_info):
+        """
+        :return: the version of the loaded profile info
+        """
+        # a reloaded profile that differs from the last one seen was changed elsewhere, e.g. by another replica
+        fingerprint = get_profile_fingerprint(profile_info)
+        with cls.profile_versions_lock:
+            if profile_name in cls.profile_fingerprints and cls.profile_fingerprints[profile_name] != fingerprint:
+                cls.profile_versions[profile_name] = cls.profile_versions.get(profile_name, 0) + 1
+            cls.profile_fingerprints[profile_name] = fingerprint
+            return cls.profile_versions.get(profile_name, 0)
+
+    @classmethod
+    def invalidate_profile(cls, profile_name):
+        with cls.profile_versions_lock:
+            cls.profile_versions[profile_name] = cls.profile_versions.get(profile_name, 0) + 1
+            cls.profile_fingerprints.pop(profile_name, None)
+        cls.profile_cache.invalidate(profile_name)
+        cls.profile_names_cache.clear()
+
     @classmethod
     def add_profile(cls, profile_name, conn_name, schemas, tables, comment):
         entity = ProfileConfigEntity(profile_name, conn_name, schemas, tables, comment)
         cls.profile_config_dao.add(entity)
+        cls.invalidate_profile(profile_name)
         logger.info(f"Profile {profile_name} added")
 
     @classmethod
@@ -41,15 +131,16 @@ class ProfileManagement:
 
     @classmethod
     def update_profile(cls, profile_name, conn_name, schemas, tables, comment, tables_info):
-        all_profiles = ProfileManagement.get_all_profiles_with_info()
-        prompt_map = all_profiles[profile_name]["prompt_map"]
+        prompt_map = cls.get_profile_info(profile_name)["prompt_map"]
         entity = ProfileConfigEntity(profile_name, conn_name, schemas, tables, comment, tables_info, prompt_map)
         cls.profile_config_dao.update(entity)
+        cls.invalidate_profile(profile_name)
         logger.info(f"Profile {profile_name} updated")
 
     @classmethod
     def delete_profile(cls, profile_name):
         cls.profile_config_dao.delete(profile_name)
+        cls.invalidate_profile(profile_name)
         logger.info(f"Profile {profile_name} updated")
 
     @classmethod
@@ -68,9 +159,32 @@ class ProfileManagement:
                 logger.info('tables info merged', tables_info)
 
         cls.profile_config_dao.update_table_def(profile_name, tables_info)
+        cls.invalidate_profile(profile_name)
         logger.info(f"Table definition updated")
 
     @classmethod
     def update_table_prompt_map(cls, profile_name, prompt_map):
         cls.profile_config_dao.update_table_prompt_map(profile_name, prompt_map)
+        cls.invalidate_profile(profile_name)
         logger.info(f"System and user prompt updated")
+
+    @classmethod
+    def update_max_rows(cls, profile_name, max_rows):
+        """
+        Set the max rows returned by the queries of a profile, None to use SQL_MAX_ROWS
+        """
+        cls.profile_config_dao.update_max_rows(profile_name, max_rows)
+        cls.invalidate_profile(profile_name)
+        logger.info(f"Max rows of {profile_name} updated")
+
+    @classmethod
+    def update_result_cache_ttl(cls, profile_name, result_cache_ttl):
+        """
+        Set the seconds the query results of a profile are cached, 0 to disable, None to use RESULT_CACHE_TTL
+        """
+        cls.profile_config_dao.update_result_cache_ttl(profile_name, result_cache_ttl)
+        cls.invalidate_profile(profile_name)
+        logger.info(f"Result cache TTL of {profile_name} updated")
+
+
+register_gauge('profile_cache', ProfileManagement.profile_cache.stats)
@@ -2,9 +2,12 @@ import logging
 import os
 import boto3
 import json
+from nlq.business.answer_cache import AnswerCacheManagement
 from nlq.data_access.opensearch import OpenSearchDao
 from utils.env_var import BEDROCK_REGION, AOS_HOST, AOS_PORT, AOS_USER, AOS_PASSWORD, opensearch_info
-from utils.env_var import bedrock_ak_sk_info
+from utils.env_var import bedrock_ak_sk_info, SAGEMAKER_ENDPOINT_EMBEDDING
+from utils.llm import create_vector_embedding_with_sagemaker as sagemaker_vector_embedding, \
+    create_vector_embeddings_with_sagemaker as sagemaker_vector_embeddings
 
 logger = logging.getLogger(__name__)
 
@@ -73,33 +76,82 @@ class VectorStore:
     @classmethod
     def add_sample(cls, profile_name, question, answer):
         logger.info(f'add sample question: {question} to profile {profile_name}')
-        embedding = cls.create_vector_embedding_with_bedrock(question)
+        embedding = cls.create_vector_embedding(question)
         has_same_sample = cls.search_same_query(profile_name, 1, opensearch_info['sql_index'], embedding)
         if has_same_sample:
             logger.info(f'delete sample sample entity: {question} to profile {profile_name}')
         if cls.opensearch_dao.add_sample(opensearch_info['sql_index'], profile_name, question, answer, embedding):
             logger.info('Sample added')
+        AnswerCacheManagement.invalidate_samples(profile_name)
 
     @classmethod
     def add_entity_sample(cls, profile_name, entity, comment):
         logger.info(f'add sample entity: {entity} to profile {profile_name}')
-        embedding = cls.create_vector_embedding_with_bedrock(entity)
+        embedding = cls.create_vector_embedding(entity)
         has_same_sample = cls.search_same_query(profile_name, 1, opensearch_info['ner_index'], embedding)
         if has_same_sample:
             logger.info(f'delete sample sample entity: {entity} to profile {profile_name}')
         if cls.opensearch_dao.add_entity_sample(opensearch_info['ner_index'], profile_name, entity, comment, embedding):
             logger.info('Sample added')
+        AnswerCacheManagement.invalidate_samples(profile_name)
 
     @classmethod
     def add_agent_cot_sample(cls, profile_name, entity, comment):
         logger.info(f'add agent sample query: {entity} to profile {profile_name}')
-        embedding = cls.create_vector_embedding_with_bedrock(entity)
+        embedding = cls.create_vector_embedding(entity)
         has_same_sample = cls.search_same_query(profile_name, 1, opensearch_info['agent_index'], embedding)
         if has_same_sample:
             logger.info(f'delete agent sample sample query: {entity} to profile {profile_name}')
         if cls.opensearch_dao.add_agent_cot_sample(opensearch_info['agent_index'], profile_name, entity, comment, embedding):
             logger.info('Sample added')
 
+    @classmethod
+    def add_samples(cls, profile_name, samples):
+        """
+        Add (question, sql) samples, the questions are embedded in batches. Like add_sample, a sample replaces
+        the existing sample of the same question, and the last sample of a question repeated in samples wins.
+        """
+        samples = list(dict(samples).items())
+        logger.info(f'add {len(samples)} samples to profile {profile_name}')
+        embeddings = cls.create_vector_embeddings([question for question, answer in samples])
+        replaced = sum(cls.search_same_query(profile_name, 1, opensearch_info['sql_index'], embedding)
+                       for embedding in embeddings)
+        if replaced:
+            logger.info(f'delete {replaced} samples replaced in profile {profile_name}')
+        if cls.opensearch_dao.add_samples(opensearch_info['sql_index'], profile_name, samples, embeddings):
+            logger.info(f'{len(samples)} samples added')
+        AnswerCacheManagement.invalidate_samples(profile_name)
+
+    @classmethod
+    def add_entity_samples(cls, profile_name, samples):
+        """
+        Add (entity, comment) samples, the entities are embedded in batches. Like add_entity_sample, a sample
+        replaces the existing sample of the same entity, and the last sample of an entity repeated in samples wins.
+        """
+        samples = list(dict(samples).items())
+        logger.info(f'add {len(samples)} sample entities to profile {profile_name}')
+        embeddings = cls.create_vector_embeddings([entity for entity, comment in samples])
+        replaced = sum(cls.search_same_query(profile_name, 1, opensearch_info['ner_index'], embedding)
+                       for embedding in embeddings)
+        if replaced:
+            logger.info(f'delete {replaced} sample entities replaced in profile {profile_name}')
+        if cls.opensearch_dao.add_entity_samples(opensearch_info['ner_index'], profile_name, samples, embeddings):
+            logger.info(f'{len(samples)} sample entities added')
+        AnswerCacheManagement.invalidate_samples(profile_name)
+
+    @classmethod
+    def create_vector_embedding(cls, text):
+        if SAGEMAKER_ENDPOINT_EMBEDDING:
+            return cls.create_vector_embedding_with_sagemaker(text)
+        return cls.create_vector_embedding_with_bedrock(text)
+
+    @classmethod
+    def create_vector_embeddings(cls, texts):
+        if SAGEMAKER_ENDPOINT_EMBEDDING:
+            records = sagemaker_vector_embeddings(SAGEMAKER_ENDPOINT_EMBEDDING, texts, index_name='')
+            return [record['vector_field'] for record in records]
+        return [cls.create_vector_embedding_with_bedrock(text) for text in texts]
+
     @classmethod
     def create_vector_embedding_with_bedrock(cls, text):
         payload = {"inputText": f"{text}"}
@@ -118,20 +170,22 @@ class VectorStore:
         return embedding
 
     @classmethod
-    def create_vector_embedding_with_sagemaker(cls):
-        # to do
-        pass
+    def create_vector_embedding_with_sagemaker(cls, text):
+        record = sagemaker_vector_embedding(SAGEMAKER_ENDPOINT_EMBEDDING, text, index_name='')
+        return record['vector_field']
 
     @classmethod
     def delete_sample(cls, profile_name, doc_id):
         logger.info(f'delete sample question id: {doc_id} from profile {profile_name}')
         ret = cls.opensearch_dao.delete_sample(opensearch_info['sql_index'], profile_name, doc_id)
+        AnswerCacheManagement.invalidate_samples(profile_name)
         print(ret)
 
     @classmethod
     def delete_entity_sample(cls, profile_name, doc_id):
         logger.info(f'delete sample question id: {doc_id} from profile {profile_name}')
         ret = cls.opensearch_dao.delete_sample(opensearch_info['ner_index'], profile_name, doc_id)
+        AnswerCacheManagement.invalidate_samples(profile_name)
         print(ret)
 
     @classmethod
@@ -1,10 +1,13 @@
 import logging
+import threading
 
 import sqlalchemy
 import sqlalchemy as db
 from sqlalchemy import text, Column, inspect
+from sqlalchemy.pool import QueuePool
 
 from nlq.data_access.dynamo_connection import ConnectConfigEntity
+from utils.env_var import DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE, DB_POOL_PRE_PING
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +22,62 @@ class RelationDatabase():
         # Add more mappings here for other databases
     }
 
+    # one pooled engine per resolved DB URL, shared by all queries of the process
+    engines = {}
+    engines_lock = threading.Lock()
+
+    @classmethod
+    def get_engine_key(cls, db_url):
+        if isinstance(db_url, db.engine.URL):
+            return db_url.render_as_string(hide_password=False)
+        return str(db_url)
+
+    @classmethod
+    def get_engine(cls, db_url):
+        """
+        Get the shared engine of a DB URL, creating it with the configured pool on first use
+        :param db_url: str or sqlalchemy URL
+        :return: sqlalchemy Engine
+        """
+        key = cls.get_engine_key(db_url)
+        engine = cls.engines.get(key)
+        if engine is None:
+            with cls.engines_lock:
+                engine = cls.engines.get(key)
+                if engine is None:
+                    url = db.engine.make_url(db_url)
+                    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+                        # an in-memory SQLite database lives in its connection, kept by the default pool
+                        engine = db.create_engine(db_url)
+                    elif url.get_backend_name() == 'sqlite':
+                        # a SQLite file is pooled like the other databases, its connections move between threads
+                        engine = db.create_engine(db_url,
+                                                  poolclass=QueuePool,
+                                                  connect_args={'check_same_thread': False},
+                                                  pool_size=DB_POOL_SIZE,
+                                                  max_overflow=DB_MAX_OVERFLOW,
+                                                  pool_recycle=DB_POOL_RECYCLE,
+                                                  pool_pre_ping=DB_POOL_PRE_PING)
+                    else:
+                        engine = db.create_engine(db_url,
+                                                  pool_size=DB_POOL_SIZE,
+                                                  max_overflow=DB_MAX_OVERFLOW,
+                                                  pool_recycle=DB_POOL_RECYCLE,
+                                                  pool_pre_ping=DB_POOL_PRE_PING)
+                    cls.engines[key] = engine
+        return engine
+
+    @classmethod
+    def dispose_engine(cls, db_url):
+        """
+        Close the pooled connections of a DB URL, e.g. after its connection was updated or deleted
+        """
+        with cls.engines_lock:
+            engine = cls.engines.pop(cls.get_engine_key(db_url), None)
+        if engine is not None:
+            engine.dispose()
+            logger.info(f"Disposed engine of {engine.url!r}")
+
     @classmethod
     def get_db_url(cls, db_type, user, password, host, port, db_name):
         if db_type == 'bigquery':
@@ -54,7 +113,7 @@ class RelationDatabase():
         db_type = connection.db_type
         db_url = cls.get_db_url(db_type, connection.db_user, connection.db_pwd, connection.db_host, connection.db_port,
                                 connection.db_name)
-        engine = db.create_engine(db_url)
+        engine = cls.get_engine(db_url)
         inspector = inspect(engine)
 
         if db_type == 'postgresql':
@@ -78,7 +137,7 @@ class RelationDatabase():
     def get_metadata_by_connection(cls, connection, schemas):
         db_url = cls.get_db_url(connection.db_type, connection.db_user, connection.db_pwd, connection.db_host,
                                 connection.db_port, connection.db_name)
-        engine = db.create_engine(db_url)
+        engine = cls.get_engine(db_url)
         # connection = engine.connect()
         metadata = db.MetaData()
         # For bigquery, the schema should be empty
@@ -16,7 +16,8 @@ DYNAMODB_AWS_REGION = os.environ.get('DYNAMODB_AWS_REGION')
 class ProfileConfigEntity:
 
     def __init__(self, profile_name: str, conn_name: str, schemas: List[str], tables: List[str], comments: str,
-                 tables_info: dict = None, prompt_map: dict = prompt_map_dict, **kwargs):
+                 tables_info: dict = None, prompt_map: dict = prompt_map_dict, max_rows: int = None,
+                 result_cache_ttl: int = None, **kwargs):
         self.profile_name = profile_name
         self.conn_name = conn_name
         self.schemas = schemas
@@ -24,6 +25,8 @@ class ProfileConfigEntity:
         self.comments = comments
         self.tables_info = tables_info
         self.prompt_map = prompt_map
+        self.max_rows = max_rows
+        self.result_cache_ttl = result_cache_ttl
 
     def to_dict(self):
         """Convert to DynamoDB item format"""
@@ -37,6 +40,10 @@ class ProfileConfigEntity:
         }
         if self.tables_info:
             base_props['tables_info'] = self.tables_info
+        if self.max_rows is not None:
+            base_props['max_rows'] = self.max_rows
+        if self.result_cache_ttl is not None:
+            base_props['result_cache_ttl'] = self.result_cache_ttl
         return base_props
 
 
@@ -161,3 +168,43 @@ class ProfileConfigDao:
             raise
         else:
             return response["Attributes"]
+
+    def update_max_rows(self, profile_name, max_rows):
+        try:
+            response = self.table.update_item(
+                Key={"profile_name": profile_name},
+                UpdateExpression="set max_rows=:mr",
+                ExpressionAttributeValues={":mr": max_rows},
+                ReturnValues="UPDATED_NEW",
+            )
+        except ClientError as err:
+            logger.error(
+                "Couldn't update profile %s in table %s. Here's why: %s: %s",
+                profile_name,
+                self.table.name,
+                err.response["Error"]["Code"],
+                err.response["Error"]["Message"],
+            )
+            raise
+        else:
+            return response["Attributes"]
+
+    def update_result_cache_ttl(self, profile_name, result_cache_ttl):
+        try:
+            response = self.table.update_item(
+                Key={"profile_name": profile_name},
+                UpdateExpression="set result_cache_ttl=:ttl",
+                ExpressionAttributeValues={":ttl": result_cache_ttl},
+                ReturnValues="UPDATED_NEW",
+            )
+        except ClientError as err:
+            logger.error(
+                "Couldn't update profile %s in table %s. Here's why: %s: %s",
+                profile_name,
+                self.table.name,
+                err.response["Error"]["Code"],
+                err.response["Error"]["Message"],
+            )
+            raise
+        else:
+            return response["Attributes"]
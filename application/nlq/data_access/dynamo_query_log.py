@@ -2,17 +2,21 @@ import logging
 import os
 
 import boto3
+from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
 
 logger = logging.getLogger(__name__)
 
 # DynamoDB table name
 QUERY_LOG_TABLE_NAME = 'NlqQueryLogging'
+# Index of the logs of a profile, newest first
+PROFILE_TIME_INDEX_NAME = 'profile_name-time_str-index'
 DYNAMODB_AWS_REGION = os.environ.get('DYNAMODB_AWS_REGION')
 
 
 class DynamoQueryLogEntity:
-    def __init__(self, log_id, profile_name, user_id, session_id, sql, query, intent, log_info, time_str):
+    def __init__(self, log_id, profile_name, user_id, session_id, sql, query, intent, log_info, time_str,
+                 entity_slot=None, status=None, intent_source=None):
         self.log_id = log_id
         self.profile_name = profile_name
         self.user_id = user_id
@@ -22,10 +26,13 @@ class DynamoQueryLogEntity:
         self.intent = intent
         self.log_info = log_info
         self.time_str = time_str
+        self.entity_slot = entity_slot
+        self.status = status
+        self.intent_source = intent_source
 
     def to_dict(self):
         """Convert to DynamoDB item format"""
-        return {
+        base_props = {
             'log_id': self.log_id,
             'profile_name': self.profile_name,
             'user_id': self.user_id,
@@ -36,6 +43,13 @@ class DynamoQueryLogEntity:
             'log_info': self.log_info,
             'time_str': self.time_str
         }
+        if self.entity_slot is not None:
+            base_props['entity_slot'] = self.entity_slot
+        if self.status is not None:
+            base_props['status'] = self.status
+        if self.intent_source is not None:
+            base_props['intent_source'] = self.intent_source
+        return base_props
 
 
 class DynamoQueryLogDao:
@@ -85,8 +99,10 @@ class DynamoQueryLogDao:
                 ],
                 AttributeDefinitions=[
                     {"AttributeName": "log_id", "AttributeType": "S"},
-                    # {"AttributeName": "conn_name", "AttributeType": "S"},
+                    {"AttributeName": "profile_name", "AttributeType": "S"},
+                    {"AttributeName": "time_str", "AttributeType": "S"},
                 ],
+                GlobalSecondaryIndexes=[self.get_profile_time_index_definition()],
                 ProvisionedThroughput={
                     "ReadCapacityUnits": 2,
                     "WriteCapacityUnits": 1,
@@ -104,6 +120,52 @@ class DynamoQueryLogDao:
             )
             raise
 
+    @staticmethod
+    def get_profile_time_index_definition(provisioned=True):
+        index = {
+            "IndexName": PROFILE_TIME_INDEX_NAME,
+            "KeySchema": [
+                {"AttributeName": "profile_name", "KeyType": "HASH"},
+                {"AttributeName": "time_str", "KeyType": "RANGE"},
+            ],
+            "Projection": {"ProjectionType": "ALL"},
+        }
+        if provisioned:
+            index["ProvisionedThroughput"] = {
+                "ReadCapacityUnits": 2,
+                "WriteCapacityUnits": 1,
+            }
+        return index
+
+    def create_profile_time_index(self):
+        """
+        Add the profile index to a table created without it, DynamoDB backfills it in the background.
+        One-off migration of existing deployments, run by dynamodb_migrate.py
+        """
+        try:
+            indexes = self.table.global_secondary_indexes or []
+            if any(index["IndexName"] == PROFILE_TIME_INDEX_NAME for index in indexes):
+                return
+            billing_mode = (self.table.billing_mode_summary or {}).get("BillingMode", "PROVISIONED")
+            self.table.update(
+                AttributeDefinitions=[
+                    {"AttributeName": "profile_name", "AttributeType": "S"},
+                    {"AttributeName": "time_str", "AttributeType": "S"},
+                ],
+                GlobalSecondaryIndexUpdates=[
+                    {"Create": self.get_profile_time_index_definition(billing_mode == "PROVISIONED")}
+                ],
+            )
+            logger.info(f"Index {PROFILE_TIME_INDEX_NAME} of DynamoDB Table {self.table_name} created")
+        except ClientError as err:
+            logger.error(
+                "Couldn't create index %s of table %s. Here's why: %s: %s",
+                PROFILE_TIME_INDEX_NAME,
+                self.table_name,
+                err.response["Error"]["Code"],
+                err.response["Error"]["Message"],
+            )
+
     def add(self, entity):
         try:
             self.table.put_item(Item=entity.to_dict())
@@ -113,6 +175,51 @@ class DynamoQueryLogDao:
     def update(self, entity):
         self.table.put_item(Item=entity.to_dict())
 
-    def add_log(self, log_id, profile_name, user_id, session_id, sql, query, intent, log_info, time_str):
-        entity = DynamoQueryLogEntity(log_id, profile_name, user_id, session_id, sql, query, intent, log_info, time_str)
+    def add_log(self, log_id, profile_name, user_id, session_id, sql, query, intent, log_info, time_str,
+                entity_slot=None, status=None, intent_source=None):
+        entity = DynamoQueryLogEntity(log_id, profile_name, user_id, session_id, sql, query, intent, log_info, time_str,
+                                      entity_slot, status, intent_source)
         self.add(entity)
+
+    def get_logs_by_profile(self, profile_name, limit=None):
+        """
+        Get the logs of a profile, newest first, from the profile index
+        :param profile_name:
+        :param limit: max number of logs, None for all
+        :return: list of DynamoQueryLogEntity, empty while the index is being backfilled
+        """
+        items = []
+        query_kwargs = {
+            'IndexName': PROFILE_TIME_INDEX_NAME,
+            'KeyConditionExpression': Key('profile_name').eq(profile_name),
+            'ScanIndexForward': False,
+        }
+        try:
+            while limit is None or len(items) < limit:
+                if limit is not None:
+                    query_kwargs['Limit'] = limit - len(items)
+                response = self.table.query(**query_kwargs)
+                items.extend(response['Items'])
+                if 'LastEvaluatedKey' not in response:
+                    break
+                query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        except ClientError as err:
+            logger.warning(
+                "Couldn't query the logs of %s. Here's why: %s: %s",
+                profile_name,
+                err.response["Error"]["Code"],
+                err.response["Error"]["Message"],
+            )
+            return []
+        return [DynamoQueryLogEntity(log_id=item['log_id'],
+                                     profile_name=item['profile_name'],
+                                     user_id=item.get('user_id'),
+                                     session_id=item.get('session_id'),
+                                     sql=item.get('sql'),
+                                     query=item.get('query'),
+                                     intent=item.get('intent'),
+                                     log_info=item.get('log_info'),
+                                     time_str=item['time_str'],
+                                     entity_slot=item.get('entity_slot'),
+                                     status=item.get('status'),
+                                     intent_source=item.get('intent_source')) for item in items]
@@ -138,11 +138,7 @@ def normal_text_search_streamlit(search_box, model_type, database_profile, entit
     search_result = SearchTextSqlResult(search_query=search_box, entity_slot_retrieve=entity_slot_retrieve,
                                         retrieve_result=retrieve_result, response=response, sql=sql)
     try:
-        if database_profile['db_url'] == '':
-            conn_name = database_profile['conn_name']
-            db_url = ConnectionManagement.get_db_url_by_name(conn_name)
-            database_profile['db_url'] = db_url
-            database_profile['db_type'] = ConnectionManagement.get_db_type_by_name(conn_name)
+        ConnectionManagement.resolve_profile_connection(database_profile)
 
         with st.status("Performing Entity retrieval...") as status_text:
             if len(entity_slot) > 0 and use_rag:
@@ -184,7 +180,8 @@ def normal_text_search_streamlit(search_box, model_type, database_profile, entit
                                    sql_examples=retrieve_result,
                                    ner_example=entity_slot_retrieve,
                                    dialect=database_profile['db_type'],
-                                   model_provider=model_provider)
+                                   model_provider=model_provider,
+                                   profile_key=database_profile.get('profile_key'))
 
             sql = get_generated_sql(response)
 
@@ -376,11 +373,7 @@ def main():
 
                 with st.spinner('Connecting to database...'):
                     # fix db url is Empty
-                    if database_profile['db_url'] == '':
-                        conn_name = database_profile['conn_name']
-                        db_url = ConnectionManagement.get_db_url_by_name(conn_name)
-                        database_profile['db_url'] = db_url
-                        database_profile['db_type'] = ConnectionManagement.get_db_type_by_name(conn_name)
+                    ConnectionManagement.resolve_profile_connection(database_profile)
                     prompt_map = database_profile['prompt_map']
                     prompt_map_flag = False
                     for key in prompt_map_dict:
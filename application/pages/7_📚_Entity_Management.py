@@ -7,7 +7,7 @@ import logging
 from nlq.business.profile import ProfileManagement
 from nlq.business.vector_store import VectorStore
 from utils.navigation import make_sidebar
-from utils.env_var import opensearch_info
+from utils.env_var import opensearch_info, EMBEDDING_MAX_BATCH_SIZE
 
 logger = logging.getLogger(__name__)
 
@@ -123,11 +123,10 @@ def main():
                             total_rows = len(each_upload_data)
                             progress_bar = st.progress(0)
                             progress_text = "batch insert {} entity  in progress. Please wait.".format(uploaded_file.name)
-                            for j, item in enumerate(each_upload_data.itertuples(), 1):
-                                entity = str(item.entity)
-                                comment = str(item.comment)
-                                VectorStore.add_entity_sample(current_profile, entity, comment)
-                                progress = (j * 1.0) / total_rows
+                            samples = [(str(item.entity), str(item.comment)) for item in each_upload_data.itertuples()]
+                            for j in range(0, total_rows, EMBEDDING_MAX_BATCH_SIZE):
+                                VectorStore.add_entity_samples(current_profile, samples[j:j + EMBEDDING_MAX_BATCH_SIZE])
+                                progress = min(j + EMBEDDING_MAX_BATCH_SIZE, total_rows) * 1.0 / total_rows
                                 progress_bar.progress(progress, text=progress_text)
                             progress_bar.empty()
                         st.success("{uploaded_file} uploaded successfully!".format(uploaded_file=uploaded_file.name))
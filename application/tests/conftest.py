@@ -0,0 +1,20 @@
+import os
+from unittest import mock
+
+import boto3
+
+# utils.env_var creates a Secrets Manager client at import, which needs a region even when no secret is read
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+# the DAOs of the business modules connect to DynamoDB when they are created, at import. The tests never reach
+# DynamoDB, the DAOs get mock resources and the tests stub the DAO methods they use.
+boto3_resource = boto3.resource
+
+
+def mock_dynamodb_resource(service_name, *args, **kwargs):
+    if service_name == 'dynamodb':
+        return mock.MagicMock()
+    return boto3_resource(service_name, *args, **kwargs)
+
+
+boto3.resource = mock_dynamodb_resource
@@ -0,0 +1,156 @@
+import threading
+import time
+
+import pytest
+
+from utils.cache import LRUCache, SQLiteCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.evictions == 1
+
+
+def test_lru_cache_put_replaces_value():
+    cache = LRUCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('a', 2)
+    assert cache.get('a') == 2
+    assert len(cache) == 1
+
+
+def test_lru_cache_expires_entries():
+    cache = LRUCache(max_entries=10, ttl=0.05)
+    cache.put('a', 1)
+    cache.put('b', 2, ttl=60)
+    time.sleep(0.1)
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    assert len(cache) == 1
+
+
+def test_lru_cache_size_budget():
+    cache = LRUCache(max_entries=10, max_bytes=10, size_of=len)
+    cache.put('a', 'xxxx')
+    cache.put('b', 'yyyy')
+    cache.put('c', 'zzzz')
+    assert cache.get('a') is None
+    assert cache.current_bytes == 8
+    # larger than the whole budget, not cached
+    cache.put('d', 'x' * 11)
+    assert cache.get('d') is None
+    assert cache.get('b') == 'yyyy'
+
+
+def test_lru_cache_disabled():
+    cache = LRUCache(max_entries=0)
+    cache.put('a', 1)
+    assert cache.get('a') is None
+    calls = []
+    assert cache.get_or_compute('a', lambda: calls.append(1) or 2) == 2
+    assert cache.get_or_compute('a', lambda: calls.append(1) or 2) == 2
+    assert len(calls) == 2
+
+
+def test_lru_cache_invalidate_where():
+    cache = LRUCache(max_entries=10)
+    cache.put(('profile1', 'q1'), 1)
+    cache.put(('profile1', 'q2'), 2)
+    cache.put(('profile2', 'q1'), 3)
+    cache.invalidate_where(lambda key: key[0] == 'profile1')
+    assert len(cache) == 1
+    assert cache.get(('profile2', 'q1')) == 3
+
+
+def test_get_or_compute_single_flight():
+    cache = LRUCache(max_entries=10)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'value'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute('key', compute)))
+               for _ in range(8)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    # the other callers are now waiting for the first one
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == ['value'] * 8
+    assert len(calls) == 1
+    assert cache.get('key') == 'value'
+
+
+def test_get_or_compute_failure_is_shared_and_not_cached():
+    cache = LRUCache(max_entries=10)
+    started = threading.Event()
+    release = threading.Event()
+
+    def compute():
+        started.set()
+        release.wait(5)
+        raise ValueError('backend down')
+
+    errors = []
+
+    def call():
+        try:
+            cache.get_or_compute('key', compute)
+        except ValueError as e:
+            errors.append(e)
+
+    first = threading.Thread(target=call)
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=call)
+    second.start()
+    time.sleep(0.05)
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert len(errors) == 2
+    assert cache.get('key') is None
+    assert cache.get_or_compute('key', lambda: 'recovered') == 'recovered'
+
+
+def test_sqlite_cache(tmp_path):
+    cache = SQLiteCache(str(tmp_path / 'cache.db'), max_entries=2)
+    cache.put('a', '1')
+    cache.put('b', '2', ttl=-1)
+    assert cache.get('a') == '1'
+    assert cache.get('b') is None
+    cache.put('c', '3')
+    cache.put('d', '4')
+    assert cache.get('a') is None
+    assert cache.get('d') == '4'
+    # persisted for the next process
+    assert SQLiteCache(str(tmp_path / 'cache.db')).get('d') == '4'
+
+
+@pytest.mark.parametrize('ttl', [None, 60])
+def test_lru_cache_stats(ttl):
+    cache = LRUCache(max_entries=10, ttl=ttl)
+    cache.put('a', 1)
+    cache.get('a')
+    cache.get('b')
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['hit_rate'] == 0.5
@@ -0,0 +1,87 @@
+import pandas as pd
+import pytest
+
+from nlq.business.connection import ConnectionManagement
+from nlq.data_access.database import RelationDatabase
+from nlq.data_access.dynamo_connection import ConnectConfigEntity
+from utils.cache import LRUCache
+from utils.result_cache import get_cached_result, put_cached_result
+
+
+class ConnectConfigDaoStub:
+    """
+    Stand for ConnectConfigDao, counting the reads that would reach DynamoDB
+    """
+
+    def __init__(self, *entities):
+        self.entities = {entity.conn_name: entity for entity in entities}
+        self.reads = 0
+
+    def get_by_name(self, conn_name):
+        self.reads += 1
+        return self.entities.get(conn_name)
+
+    def update_db_info(self, conn_name, db_type, db_host="", db_port=0, db_user="", db_pwd="", db_name="",
+                       comment=""):
+        self.entities[conn_name] = ConnectConfigEntity(None, conn_name, db_type, db_name, db_host, db_port, db_user,
+                                                       db_pwd, comment)
+
+    def delete(self, conn_name):
+        return self.entities.pop(conn_name, None) is not None
+
+
+def connection_entity(conn_name, db_pwd='password'):
+    return ConnectConfigEntity(None, conn_name, 'mysql', 'llm', 'localhost', 3306, 'admin', db_pwd, '')
+
+
+@pytest.fixture
+def connection_config_dao(monkeypatch):
+    dao = ConnectConfigDaoStub(connection_entity('sales_db'))
+    monkeypatch.setattr(ConnectionManagement, 'connection_config_dao', dao)
+    monkeypatch.setattr(ConnectionManagement, 'connection_cache', LRUCache(256, ttl=60))
+    yield dao
+    for entity in list(dao.entities.values()):
+        RelationDatabase.dispose_engine(RelationDatabase.get_db_url_by_connection(entity))
+
+
+def engine_key(conn_name, db_pwd='password'):
+    return RelationDatabase.get_engine_key(RelationDatabase.get_db_url_by_connection(connection_entity(conn_name,
+                                                                                                       db_pwd)))
+
+
+def test_connection_is_resolved_once(connection_config_dao):
+    profile = {'db_url': '', 'conn_name': 'sales_db'}
+    ConnectionManagement.resolve_profile_connection(profile)
+    assert profile['db_type'] == 'mysql'
+    assert RelationDatabase.get_engine_key(profile['db_url']) == engine_key('sales_db')
+    assert ConnectionManagement.get_db_type_by_name('sales_db') == 'mysql'
+    assert ConnectionManagement.get_connection_info('sales_db').engine is \
+        RelationDatabase.get_engine(profile['db_url'])
+    assert connection_config_dao.reads == 1
+
+
+def test_profile_with_url_is_not_resolved(connection_config_dao):
+    profile = {'db_url': 'sqlite://', 'db_type': 'sqlite', 'conn_name': 'sales_db'}
+    assert ConnectionManagement.resolve_profile_connection(profile)['db_url'] == 'sqlite://'
+    assert connection_config_dao.reads == 0
+
+
+def test_update_disposes_the_previous_engine_and_results(connection_config_dao):
+    previous_key = engine_key('sales_db')
+    ConnectionManagement.get_connection_info('sales_db').engine
+    result = {"data": pd.DataFrame({"total": [1]}), "truncated": False, "total_count": 1}
+    put_cached_result(previous_key, "SELECT 1", 0, result, ttl=60)
+    ConnectionManagement.update_connection('sales_db', 'mysql', 'localhost', 3306, 'admin', 'new password', 'llm', '')
+    assert previous_key not in RelationDatabase.engines
+    assert get_cached_result(previous_key, "SELECT 1", 0) is None
+    # the next lookup resolves the new credentials
+    assert RelationDatabase.get_engine_key(ConnectionManagement.get_db_url_by_name('sales_db')) == \
+        engine_key('sales_db', 'new password')
+
+
+def test_delete_disposes_the_engine(connection_config_dao):
+    previous_key = engine_key('sales_db')
+    ConnectionManagement.get_connection_info('sales_db').engine
+    ConnectionManagement.delete_connection('sales_db')
+    assert previous_key not in RelationDatabase.engines
+    assert ConnectionManagement.connection_cache.get('sales_db') is None
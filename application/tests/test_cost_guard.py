@@ -0,0 +1,105 @@
+import pytest
+from sqlalchemy import text
+
+from nlq.data_access.database import RelationDatabase
+from utils import cost_guard
+from utils.cost_guard import COST_GUARD_OFF, COST_GUARD_REJECT, COST_GUARD_REWRITE, QueryCost, QueryCostExceeded, \
+    explain_query_cost, get_cost_overrun, guard_query_cost
+
+PROFILE = {'tables_info': 'CREATE TABLE sales (id INTEGER PRIMARY KEY, region_id INTEGER, amount REAL)',
+           'prompt_map': {}, 'db_type': 'sqlite'}
+
+
+@pytest.fixture
+def db_url(tmp_path):
+    db_url = f"sqlite:///{tmp_path / 'sales.db'}"
+    with RelationDatabase.get_engine(db_url).begin() as connection:
+        connection.execute(text("CREATE TABLE sales (id INTEGER PRIMARY KEY, region_id INTEGER, amount REAL)"))
+        connection.execute(text("CREATE TABLE region (id INTEGER PRIMARY KEY, name TEXT)"))
+        connection.execute(text("INSERT INTO sales (id, region_id, amount) VALUES (:id, :region_id, 1.0)"),
+                           [{"id": i, "region_id": i % 10} for i in range(1, 1001)])
+        connection.execute(text("INSERT INTO region (id, name) VALUES (:id, 'region')"),
+                           [{"id": i} for i in range(1, 11)])
+    yield db_url
+    RelationDatabase.dispose_engine(db_url)
+
+
+def explain(db_url, sql):
+    with RelationDatabase.get_engine(db_url).connect() as connection:
+        return explain_query_cost(connection, sql)
+
+
+def test_sqlite_full_scan_rows(db_url):
+    assert explain(db_url, "SELECT * FROM sales -- all sales").rows == 1000
+
+
+def test_sqlite_join_rows_are_the_product_of_the_scans(db_url):
+    assert explain(db_url, "SELECT * FROM sales s, region r WHERE s.amount > length(r.name)").rows == 1000 * 10
+
+
+def test_sqlite_index_search_is_not_counted(db_url):
+    assert explain(db_url, "SELECT * FROM sales WHERE id = 5").rows is None
+
+
+def test_failed_explain_is_not_estimated(db_url):
+    assert explain(db_url, "SELECT * FROM missing_table") is None
+
+
+def test_cost_overrun():
+    assert get_cost_overrun(None, max_rows=1) is None
+    assert get_cost_overrun(QueryCost(rows=10), max_rows=100) is None
+    assert "rows" in get_cost_overrun(QueryCost(rows=1000), max_rows=100)
+    assert "planner cost" in get_cost_overrun(QueryCost(cost=1000.0), max_rows=0, max_cost=100)
+    assert "bytes" in get_cost_overrun(QueryCost(bytes=1000), max_rows=0, max_cost=0, max_bytes=100)
+    # 0 for no budget
+    assert get_cost_overrun(QueryCost(rows=1000), max_rows=0) is None
+
+
+def test_guard_off_does_not_explain(monkeypatch):
+    monkeypatch.setattr(cost_guard, 'SQL_COST_GUARD', COST_GUARD_OFF)
+    assert guard_query_cost("sqlite:///does/not/exist.db", PROFILE, "SELECT * FROM sales") == "SELECT * FROM sales"
+
+
+def test_guard_rejects_query_over_budget(db_url, monkeypatch):
+    monkeypatch.setattr(cost_guard, 'SQL_COST_GUARD', COST_GUARD_REJECT)
+    monkeypatch.setattr(cost_guard, 'SQL_COST_MAX_ROWS', 100)
+    assert guard_query_cost(db_url, PROFILE, "SELECT * FROM sales WHERE id = 5") == "SELECT * FROM sales WHERE id = 5"
+    with pytest.raises(QueryCostExceeded):
+        guard_query_cost(db_url, PROFILE, "SELECT * FROM sales", model_id='model', search_box='all sales')
+
+
+def test_guard_rewrites_query_over_budget(db_url, monkeypatch):
+    monkeypatch.setattr(cost_guard, 'SQL_COST_GUARD', COST_GUARD_REWRITE)
+    monkeypatch.setattr(cost_guard, 'SQL_COST_MAX_ROWS', 100)
+    monkeypatch.setattr(cost_guard, 'SQL_COST_REWRITE_ATTEMPTS', 1)
+    rewrites = []
+
+    def rewrite_expensive_sql(ddl, prompt_map, search_box, sql, cost_overrun, model_id=None, dialect='mysql'):
+        rewrites.append((search_box, sql, model_id, dialect))
+        return "<sql>SELECT * FROM sales WHERE id = 5</sql>\nOnly the requested sale is read."
+
+    monkeypatch.setattr(cost_guard, 'rewrite_expensive_sql', rewrite_expensive_sql)
+    assert guard_query_cost(db_url, PROFILE, "SELECT * FROM sales", model_id='model', search_box='sale 5') == \
+        "SELECT * FROM sales WHERE id = 5"
+    assert rewrites == [('sale 5', "SELECT * FROM sales", 'model', 'sqlite')]
+
+
+def test_guard_rejects_rewrite_still_over_budget(db_url, monkeypatch):
+    monkeypatch.setattr(cost_guard, 'SQL_COST_GUARD', COST_GUARD_REWRITE)
+    monkeypatch.setattr(cost_guard, 'SQL_COST_MAX_ROWS', 100)
+    monkeypatch.setattr(cost_guard, 'SQL_COST_REWRITE_ATTEMPTS', 2)
+    rewrites = []
+
+    def rewrite_expensive_sql(ddl, prompt_map, search_box, sql, cost_overrun, model_id=None, dialect='mysql'):
+        rewrites.append(sql)
+        return "<sql>SELECT * FROM sales WHERE amount > 0</sql>"
+
+    monkeypatch.setattr(cost_guard, 'rewrite_expensive_sql', rewrite_expensive_sql)
+    with pytest.raises(QueryCostExceeded):
+        guard_query_cost(db_url, PROFILE, "SELECT * FROM sales", model_id='model', search_box='sales')
+    assert len(rewrites) == 2
+    # without the question the query cannot be generated again, it is rejected at once
+    rewrites.clear()
+    with pytest.raises(QueryCostExceeded):
+        guard_query_cost(db_url, PROFILE, "SELECT * FROM sales")
+    assert rewrites == []
@@ -0,0 +1,44 @@
+import threading
+
+from sqlalchemy import text
+from sqlalchemy.pool import QueuePool
+
+from nlq.data_access.database import RelationDatabase
+
+
+def test_engine_is_shared_per_url(tmp_path):
+    db_url = f"sqlite:///{tmp_path / 'shared.db'}"
+    engine = RelationDatabase.get_engine(db_url)
+    try:
+        assert RelationDatabase.get_engine(db_url) is engine
+        assert isinstance(engine.pool, QueuePool)
+    finally:
+        RelationDatabase.dispose_engine(db_url)
+    assert RelationDatabase.get_engine_key(db_url) not in RelationDatabase.engines
+
+
+def test_pooled_sqlite_connections_move_between_threads(tmp_path):
+    db_url = f"sqlite:///{tmp_path / 'threads.db'}"
+    results = []
+
+    def query():
+        with RelationDatabase.get_engine(db_url).connect() as connection:
+            results.append(connection.execute(text("SELECT 1")).scalar())
+
+    try:
+        for _ in range(3):
+            thread = threading.Thread(target=query)
+            thread.start()
+            thread.join(5)
+        assert results == [1, 1, 1]
+        assert RelationDatabase.get_engine(db_url).pool.checkedin() == 1
+    finally:
+        RelationDatabase.dispose_engine(db_url)
+
+
+def test_memory_database_keeps_default_pool():
+    engine = RelationDatabase.get_engine("sqlite://")
+    try:
+        assert not isinstance(engine.pool, QueuePool)
+    finally:
+        RelationDatabase.dispose_engine("sqlite://")
@@ -0,0 +1,34 @@
+from nlq.data_access.dynamo_query_log import DynamoQueryLogDao, PROFILE_TIME_INDEX_NAME
+
+LOG = {'log_id': 'log-1', 'profile_name': 'sales', 'user_id': 'admin', 'session_id': 'session-1',
+       'sql': 'SELECT 1', 'query': 'one', 'intent': 'normal_search', 'log_info': '', 'time_str': '2024-01-01 00:00:00'}
+
+
+def test_dao_does_not_migrate_the_table():
+    dao = DynamoQueryLogDao()
+    dao.table.update.assert_not_called()
+
+
+def test_profile_index_is_created_once():
+    dao = DynamoQueryLogDao()
+    dao.table.global_secondary_indexes = None
+    dao.table.billing_mode_summary = {'BillingMode': 'PAY_PER_REQUEST'}
+    dao.create_profile_time_index()
+    index = dao.table.update.call_args.kwargs['GlobalSecondaryIndexUpdates'][0]['Create']
+    assert index['IndexName'] == PROFILE_TIME_INDEX_NAME
+    assert 'ProvisionedThroughput' not in index
+    dao.table.update.reset_mock()
+    dao.table.global_secondary_indexes = [{'IndexName': PROFILE_TIME_INDEX_NAME}]
+    dao.create_profile_time_index()
+    dao.table.update.assert_not_called()
+
+
+def test_logs_with_unknown_attributes():
+    dao = DynamoQueryLogDao()
+    dao.table.query.return_value = {'Items': [{**LOG, 'feedback': 'upvote'},
+                                              {'log_id': 'log-2', 'profile_name': 'sales',
+                                               'time_str': '2023-12-31 00:00:00'}]}
+    logs = dao.get_logs_by_profile('sales')
+    assert [log.log_id for log in logs] == ['log-1', 'log-2']
+    assert logs[0].to_dict() == LOG
+    assert logs[1].intent is None
@@ -0,0 +1,76 @@
+import copy
+
+import pytest
+
+from utils.cache import LRUCache
+from utils.prompts import generate_prompt
+from utils.prompts.generate_prompt import PromptTemplate, generate_llm_prompt, prompt_map_dict
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+DDL = {"sales": {"description": "sales", "ddl": "CREATE TABLE sales (id INTEGER, amount REAL);"}}
+
+
+def test_render_matches_str_format():
+    template = "Schema:\n{sql_schema}\nDialect: {dialect}\nQuestion: {question}\n"
+    values = {"sql_schema": "sales(id, amount)", "dialect": "mysql", "question": "total sales?"}
+    prompt_template = PromptTemplate(template, sql_schema=values["sql_schema"], dialect=values["dialect"])
+    assert prompt_template.render(question=values["question"]) == template.format(**values)
+
+
+def test_bound_fields_are_spliced_once():
+    prompt_template = PromptTemplate("{a}-{b}-{a}", a="x")
+    assert prompt_template.parts == ["x-", ("b", None, ""), "-x"]
+    assert prompt_template.render(b="y") == "x-y-x"
+
+
+def test_conversion_format_spec_and_escaped_braces():
+    template = "{{literal}} {name!r} {count:>4} {ratio:.2f}"
+    prompt_template = PromptTemplate(template, ratio=0.5)
+    assert prompt_template.render(name="n", count=7) == template.format(name="n", count=7, ratio=0.5)
+
+
+def test_missing_value_raises():
+    with pytest.raises(KeyError):
+        PromptTemplate("{question}").render()
+
+
+@pytest.mark.parametrize("template", ["{0}", "{}", "{table.name}", "{rows[0]}", "{value:{width}}"])
+def test_unsupported_fields_raise(template):
+    with pytest.raises(ValueError):
+        PromptTemplate(template)
+
+
+@pytest.fixture
+def static_prompts(monkeypatch):
+    monkeypatch.setattr(generate_prompt, 'static_llm_prompt_cache', LRUCache(10))
+    generations = []
+    generate_static_llm_prompt = generate_prompt.generate_static_llm_prompt
+
+    def count_generations(ddl, prompt_map, model_id, dialect):
+        generations.append((model_id, dialect))
+        return generate_static_llm_prompt(ddl, prompt_map, model_id, dialect)
+
+    monkeypatch.setattr(generate_prompt, 'generate_static_llm_prompt', count_generations)
+    return generations
+
+
+def test_static_prompt_is_cached_per_profile_version(static_prompts):
+    prompt = generate_llm_prompt(DDL, "", prompt_map_dict, "total sales?", model_id=MODEL_ID,
+                                 profile_key=('sales', 0))
+    assert generate_llm_prompt(DDL, "", prompt_map_dict, "total sales?", model_id=MODEL_ID,
+                               profile_key=('sales', 0)) == prompt
+    assert generate_llm_prompt(DDL, "", prompt_map_dict, "total sales?", model_id=MODEL_ID) == prompt
+    assert generate_llm_prompt(DDL, "", prompt_map_dict, "total sales?", model_id=MODEL_ID, dialect='postgresql',
+                               profile_key=('sales', 0)) != prompt
+    # cached once per model and dialect of the profile version, never without a profile
+    assert static_prompts == [(MODEL_ID, 'mysql'), (MODEL_ID, 'mysql'), (MODEL_ID, 'postgresql')]
+
+
+def test_changed_profile_gets_a_new_prompt(static_prompts):
+    user_prompt, system_prompt = generate_llm_prompt(DDL, "", prompt_map_dict, "total sales?", model_id=MODEL_ID,
+                                                     profile_key=('sales', 0))
+    prompt_map = copy.deepcopy(prompt_map_dict)
+    name = generate_prompt.support_model_ids_map[MODEL_ID]
+    prompt_map['text2sql']['system_prompt'][name] = "You write {dialect} queries."
+    assert generate_llm_prompt(DDL, "", prompt_map, "total sales?", model_id=MODEL_ID,
+                               profile_key=('sales', 1)) == (user_prompt, "You write mysql queries.")
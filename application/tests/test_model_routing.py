@@ -0,0 +1,101 @@
+import pytest
+
+from utils import llm, model_routing
+from utils.metrics import get_counter
+from utils.model_routing import get_fallback_model, record_model_call, route_model
+from utils.rate_limit import PRIORITY_INTERACTIVE
+
+HAIKU = "anthropic.claude-3-haiku-20240307-v1:0"
+SONNET = "anthropic.claude-3-sonnet-20240229-v1:0"
+SONNET_3_5 = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+
+
+class RateLimiterStub:
+
+    def __init__(self, wait):
+        self.wait = wait
+
+    def expected_wait(self, tokens, priority=PRIORITY_INTERACTIVE):
+        return self.wait
+
+
+@pytest.fixture
+def routing(monkeypatch):
+    monkeypatch.setattr(model_routing, 'LLM_STAGE_MODELS', {'intent': HAIKU, 'knowledge': 'unknown.model-v1'})
+    monkeypatch.setattr(model_routing, 'LLM_FALLBACK_MODELS', {SONNET_3_5: SONNET})
+    monkeypatch.setattr(llm, 'LLM_FALLBACK_WAIT_SECONDS', 10)
+    waits = {}
+    monkeypatch.setattr(llm, 'get_rate_limiter', lambda model_id: RateLimiterStub(waits.get(model_id, 0.0)))
+    return waits
+
+
+def scheduled_model_stub(calls, throttled_models=()):
+    def invoke_scheduled_model(model_id, system_prompt, user_prompt, max_tokens, reserved_tokens, priority, stage,
+                               with_response_stream=False):
+        calls.append(model_id)
+        if model_id in throttled_models:
+            return "", True
+        return f"answer of {model_id}", False
+
+    return invoke_scheduled_model
+
+
+def test_stage_routing(routing):
+    assert route_model('intent', SONNET_3_5) == HAIKU
+    # a stage without a route, or routed to a model without prompts, keeps the model chosen by the user
+    assert route_model('sql', SONNET_3_5) == SONNET_3_5
+    assert route_model('knowledge', SONNET_3_5) == SONNET_3_5
+    assert get_fallback_model(SONNET_3_5) == SONNET
+    assert get_fallback_model(HAIKU) is None
+
+
+def test_model_is_used_when_available(routing, monkeypatch):
+    calls = []
+    monkeypatch.setattr(llm, 'invoke_scheduled_model', scheduled_model_stub(calls))
+    assert llm.invoke_with_fallback(SONNET_3_5, "system", "user", 100, 200, PRIORITY_INTERACTIVE, 'sql') == \
+        (f"answer of {SONNET_3_5}", SONNET_3_5)
+    assert calls == [SONNET_3_5]
+
+
+def test_saturated_model_uses_its_fallback(routing, monkeypatch):
+    calls = []
+    routing[SONNET_3_5] = 30.0
+    monkeypatch.setattr(llm, 'invoke_scheduled_model', scheduled_model_stub(calls))
+    fallbacks = get_counter('llm_routing.sql.fallback')
+    assert llm.invoke_with_fallback(SONNET_3_5, "system", "user", 100, 200, PRIORITY_INTERACTIVE, 'sql') == \
+        (f"answer of {SONNET}", SONNET)
+    assert calls == [SONNET]
+    assert get_counter('llm_routing.sql.fallback') == fallbacks + 1
+
+
+def test_throttled_model_retries_on_its_fallback(routing, monkeypatch):
+    calls = []
+    monkeypatch.setattr(llm, 'invoke_scheduled_model', scheduled_model_stub(calls, throttled_models=[SONNET_3_5]))
+    assert llm.invoke_with_fallback(SONNET_3_5, "system", "user", 100, 200, PRIORITY_INTERACTIVE, 'sql') == \
+        (f"answer of {SONNET}", SONNET)
+    assert calls == [SONNET_3_5, SONNET]
+
+
+def test_fallback_is_tried_once(routing, monkeypatch):
+    calls = []
+    routing[SONNET_3_5] = 30.0
+    monkeypatch.setattr(llm, 'invoke_scheduled_model', scheduled_model_stub(calls, throttled_models=[SONNET]))
+    assert llm.invoke_with_fallback(SONNET_3_5, "system", "user", 100, 200, PRIORITY_INTERACTIVE, 'sql') == \
+        ("", SONNET)
+    assert calls == [SONNET]
+
+
+def test_model_without_fallback_returns_the_throttled_response(routing, monkeypatch):
+    calls = []
+    monkeypatch.setattr(llm, 'invoke_scheduled_model', scheduled_model_stub(calls, throttled_models=[HAIKU]))
+    assert llm.invoke_with_fallback(HAIKU, "system", "user", 100, 200, PRIORITY_INTERACTIVE, 'intent') == \
+        ("", HAIKU)
+    assert calls == [HAIKU]
+
+
+def test_model_call_cost():
+    cost = get_counter('llm_routing.other.cost')
+    calls = get_counter(f'llm_routing.other.{HAIKU}.calls')
+    record_model_call('other', HAIKU, 0.5, 1000, 2000)
+    assert get_counter('llm_routing.other.cost') == pytest.approx(cost + 0.00025 + 2 * 0.00125)
+    assert get_counter(f'llm_routing.other.{HAIKU}.calls') == calls + 1
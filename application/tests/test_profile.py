@@ -0,0 +1,110 @@
+import time
+
+import pytest
+
+from nlq.business.profile import ProfileManagement, get_profile_fingerprint, to_profile_info
+from nlq.data_access.dynamo_profile import ProfileConfigEntity
+from utils.cache import LRUCache
+
+
+class ProfileConfigDaoStub:
+    """
+    Stand for ProfileConfigDao, counting the reads that would reach DynamoDB
+    """
+
+    def __init__(self, *entities):
+        self.entities = {entity.profile_name: entity for entity in entities}
+        self.reads = 0
+
+    def get_by_name(self, profile_name):
+        self.reads += 1
+        return self.entities.get(profile_name)
+
+    def get_profile_list(self):
+        self.reads += 1
+        return list(self.entities.values())
+
+    def update_table_prompt_map(self, profile_name, prompt_map):
+        self.entities[profile_name].prompt_map = prompt_map
+
+    def update_max_rows(self, profile_name, max_rows):
+        self.entities[profile_name].max_rows = max_rows
+
+    def delete(self, profile_name):
+        del self.entities[profile_name]
+
+
+def profile_entity(profile_name, max_rows=None):
+    return ProfileConfigEntity(profile_name, 'conn', ['public'], ['sales'], '', {'sales': {}}, {'prompt': 'text'},
+                               max_rows)
+
+
+@pytest.fixture
+def profile_config_dao(monkeypatch):
+    dao = ProfileConfigDaoStub(profile_entity('sales'), profile_entity('finance'))
+    monkeypatch.setattr(ProfileManagement, 'profile_config_dao', dao)
+    monkeypatch.setattr(ProfileManagement, 'profile_cache', LRUCache(1024, ttl=60))
+    monkeypatch.setattr(ProfileManagement, 'profile_names_cache', LRUCache(1, ttl=60))
+    monkeypatch.setattr(ProfileManagement, 'profile_versions', {})
+    monkeypatch.setattr(ProfileManagement, 'profile_fingerprints', {})
+    return dao
+
+
+def test_profile_is_read_once(profile_config_dao):
+    profile_info = ProfileManagement.get_profile_info('sales')
+    assert profile_info['tables_info'] == {'sales': {}}
+    # callers get copies they may change
+    profile_info['db_url'] = 'sqlite://'
+    assert ProfileManagement.get_profile_info('sales')['db_url'] == ''
+    assert ProfileManagement.get_profile_info('missing') is None
+    assert ProfileManagement.get_profile_info('missing') is None
+    assert profile_config_dao.reads == 2
+
+
+def test_profile_list_fills_the_cache(profile_config_dao):
+    assert sorted(ProfileManagement.get_all_profiles_with_info()) == ['finance', 'sales']
+    assert sorted(ProfileManagement.get_all_profiles()) == ['finance', 'sales']
+    ProfileManagement.get_profile_info('sales')
+    assert profile_config_dao.reads == 1
+
+
+def test_change_invalidates_the_profile_and_its_version(profile_config_dao):
+    ProfileManagement.get_profile_info('sales')
+    version = ProfileManagement.get_profile_version('sales')
+    ProfileManagement.update_table_prompt_map('sales', {'prompt': 'new text'})
+    assert ProfileManagement.get_profile_version('sales') == version + 1
+    profile_info = ProfileManagement.get_profile_info('sales')
+    assert profile_info['prompt_map'] == {'prompt': 'new text'}
+    assert profile_info['profile_key'] == ('sales', version + 1)
+    assert ProfileManagement.get_profile_version('finance') == 0
+
+
+def test_deleted_profile_leaves_the_list(profile_config_dao):
+    assert sorted(ProfileManagement.get_all_profiles()) == ['finance', 'sales']
+    ProfileManagement.delete_profile('finance')
+    assert ProfileManagement.get_all_profiles() == ['sales']
+    assert ProfileManagement.get_profile_info('finance') is None
+
+
+def test_change_made_elsewhere_is_seen_after_the_refresh(profile_config_dao, monkeypatch):
+    monkeypatch.setattr(ProfileManagement, 'profile_cache', LRUCache(1024, ttl=0.05))
+    ProfileManagement.get_profile_info('sales')
+    time.sleep(0.1)
+    # reloaded unchanged, the version is kept
+    ProfileManagement.get_profile_info('sales')
+    assert ProfileManagement.get_profile_version('sales') == 0
+    # changed by another replica
+    profile_config_dao.update_max_rows('sales', 100)
+    assert ProfileManagement.get_profile_info('sales')['max_rows'] is None
+    time.sleep(0.1)
+    assert ProfileManagement.get_profile_info('sales')['max_rows'] == 100
+    assert ProfileManagement.get_profile_version('sales') == 1
+    assert ProfileManagement.get_profile_info('sales')['profile_key'] == ('sales', 1)
+    assert profile_config_dao.reads == 3
+
+
+def test_profile_fingerprint():
+    profile_info = to_profile_info(profile_entity('sales'))
+    assert get_profile_fingerprint(profile_info) == get_profile_fingerprint(dict(reversed(profile_info.items())))
+    assert get_profile_fingerprint(profile_info) != get_profile_fingerprint(to_profile_info(profile_entity('sales', 10)))
+    assert get_profile_fingerprint(None) is None
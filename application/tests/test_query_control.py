@@ -0,0 +1,101 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import sqlalchemy
+from sqlalchemy import text
+
+from utils import query_control
+from utils.query_control import QueryCancellation, QueryCancelled, QueryTimeout, add_statement_timeout_clause, \
+    get_statement_timeout, set_statement_timeout, statement_guard
+
+# never ends unless the statement is interrupted
+ENDLESS_QUERY = "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT COUNT(*) FROM c"
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'query_control.db'}")
+    yield engine
+    engine.dispose()
+
+
+def dialect_connection(name):
+    return SimpleNamespace(dialect=SimpleNamespace(name=name))
+
+
+def test_statement_timeout_by_database_type(monkeypatch):
+    monkeypatch.setattr(query_control, 'SQL_STATEMENT_TIMEOUT', 0)
+    monkeypatch.setattr(query_control, 'SQL_STATEMENT_TIMEOUTS', {'bigquery': 300})
+    assert get_statement_timeout('bigquery') == 300
+    assert get_statement_timeout('mysql') == 0
+
+
+def test_clickhouse_timeout_clause():
+    connection = dialect_connection('clickhouse')
+    assert add_statement_timeout_clause(connection, "SELECT * FROM sales;\n", 2.5) == \
+        "SELECT * FROM sales\nSETTINGS max_execution_time = 2"
+    assert add_statement_timeout_clause(connection, "SELECT 1", 0.1) == "SELECT 1\nSETTINGS max_execution_time = 1"
+    # the settings of the query are kept
+    sql = "SELECT * FROM sales SETTINGS max_threads = 4"
+    assert add_statement_timeout_clause(connection, sql, 10) == sql
+
+
+def test_timeout_clause_only_for_clickhouse():
+    assert add_statement_timeout_clause(dialect_connection('mysql'), "SELECT 1", 10) == "SELECT 1"
+
+
+def test_sqlite_has_no_session_timeout(engine):
+    with engine.connect() as connection:
+        assert set_statement_timeout(connection, 10) is None
+
+
+def test_guard_without_timeout_is_a_no_op(engine):
+    with engine.connect() as connection:
+        with statement_guard(connection, 0):
+            assert connection.execute(text("SELECT 1")).scalar() == 1
+        assert not connection.invalidated
+
+
+def test_guard_passes_query_errors_through(engine):
+    with engine.connect() as connection:
+        with pytest.raises(sqlalchemy.exc.OperationalError):
+            with statement_guard(connection, 10):
+                connection.execute(text("SELECT * FROM missing_table"))
+        assert not connection.invalidated
+
+
+def test_guard_interrupts_statement_after_timeout(engine, monkeypatch):
+    monkeypatch.setattr(query_control, 'SQL_CANCEL_GRACE_SECONDS', 0)
+    with engine.connect() as connection:
+        start_time = time.monotonic()
+        with pytest.raises(QueryTimeout):
+            with statement_guard(connection, 0.2):
+                connection.execute(text(ENDLESS_QUERY))
+        assert time.monotonic() - start_time < 5
+        assert connection.invalidated
+
+
+def test_guard_cancels_running_statement(engine):
+    cancellation = QueryCancellation()
+    timer = threading.Timer(0.2, cancellation.cancel)
+    timer.start()
+    try:
+        with engine.connect() as connection:
+            with pytest.raises(QueryCancelled):
+                with statement_guard(connection, 0, cancellation):
+                    connection.execute(text(ENDLESS_QUERY))
+            assert connection.invalidated
+    finally:
+        timer.cancel()
+    assert cancellation.callbacks == []
+
+
+def test_guard_rejects_cancelled_question(engine):
+    cancellation = QueryCancellation()
+    cancellation.cancel()
+    with engine.connect() as connection:
+        with pytest.raises(QueryCancelled):
+            with statement_guard(connection, 0, cancellation):
+                pytest.fail("the statement must not run")
@@ -0,0 +1,74 @@
+import threading
+import time
+
+import pytest
+
+from utils.rate_limit import ModelRateLimiter, RateLimitExceeded, estimate_tokens, PRIORITY_INTERACTIVE, \
+    PRIORITY_NORMAL, PRIORITY_OPTIONAL
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("a" * 40, None, "b" * 4) == 11
+
+
+def test_unlimited_limiter_admits_at_once():
+    rate_limiter = ModelRateLimiter()
+    assert rate_limiter.unlimited
+    for _ in range(1000):
+        rate_limiter.acquire(100000, timeout=0)
+    assert rate_limiter.expected_wait(100000) == 0.0
+
+
+def test_request_limit():
+    rate_limiter = ModelRateLimiter(rpm=60)
+    for _ in range(60):
+        rate_limiter.acquire(1, timeout=0.01)
+    with pytest.raises(RateLimitExceeded):
+        rate_limiter.acquire(1, timeout=0.05)
+
+
+def test_token_limit_and_release():
+    rate_limiter = ModelRateLimiter(tpm=6000)
+    rate_limiter.acquire(6000, timeout=0.01)
+    with pytest.raises(RateLimitExceeded):
+        rate_limiter.acquire(1000, timeout=0.05)
+    # the call used less than it reserved
+    rate_limiter.release(2000)
+    rate_limiter.acquire(1000, timeout=0.01)
+
+
+def test_optional_calls_are_shed():
+    rate_limiter = ModelRateLimiter(tpm=60)
+    rate_limiter.acquire(60, timeout=0.01)
+    start_time = time.monotonic()
+    with pytest.raises(RateLimitExceeded):
+        rate_limiter.acquire(60, priority=PRIORITY_OPTIONAL)
+    assert time.monotonic() - start_time < 1
+
+
+def test_throttled_drains_buckets():
+    rate_limiter = ModelRateLimiter(rpm=60, tpm=60000)
+    rate_limiter.throttled()
+    with pytest.raises(RateLimitExceeded):
+        rate_limiter.acquire(1, timeout=0.05)
+
+
+def test_higher_priority_is_admitted_first():
+    # a request every 0.1 second
+    rate_limiter = ModelRateLimiter(rpm=600)
+    rate_limiter.throttled()
+    admitted = []
+
+    def call(name, priority):
+        rate_limiter.acquire(1, priority=priority, timeout=5)
+        admitted.append(name)
+
+    normal = threading.Thread(target=call, args=('normal', PRIORITY_NORMAL))
+    normal.start()
+    time.sleep(0.02)
+    interactive = threading.Thread(target=call, args=('interactive', PRIORITY_INTERACTIVE))
+    interactive.start()
+    normal.join(5)
+    interactive.join(5)
+    assert admitted == ['interactive', 'normal']
+    assert rate_limiter.stats()['queue_depth'] == 0
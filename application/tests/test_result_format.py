@@ -0,0 +1,62 @@
+import base64
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+from utils.result_format import encode_columnar, encode_result, RESULT_FORMAT_COLUMNAR, RESULT_FORMAT_ROWS
+
+
+def decode_typed_array(column, dtype):
+    return np.frombuffer(base64.b64decode(column["values"]), dtype=f'<{dtype}')
+
+
+def test_encode_columnar():
+    result_df = pd.DataFrame({
+        "id": [1, 2, 3],
+        "amount": [1.5, None, 3.0],
+        "active": [True, False, True],
+        "created_at": pd.to_datetime(["2024-01-01", None, "2024-01-03"]),
+        "price": [Decimal("1.10"), None, Decimal("3.30")],
+        "name": ["a", None, "c"],
+    })
+    encoded = encode_columnar(result_df)
+    assert encoded["format"] == RESULT_FORMAT_COLUMNAR
+    assert encoded["row_count"] == 3
+    columns = {column["name"]: column for column in encoded["columns"]}
+    assert [column["name"] for column in encoded["columns"]] == list(result_df.columns)
+
+    assert columns["id"]["dtype"] == "int64"
+    assert decode_typed_array(columns["id"], "i8").tolist() == [1, 2, 3]
+
+    assert columns["amount"]["dtype"] == "float64"
+    amounts = decode_typed_array(columns["amount"], "f8")
+    assert amounts[0] == 1.5 and np.isnan(amounts[1]) and amounts[2] == 3.0
+
+    assert columns["active"]["dtype"] == "bool"
+    assert decode_typed_array(columns["active"], "u1").tolist() == [1, 0, 1]
+
+    assert columns["created_at"]["dtype"] == "timestamp_ms"
+    timestamps = decode_typed_array(columns["created_at"], "f8")
+    assert timestamps[0] == pd.Timestamp("2024-01-01").value / 1e6 and np.isnan(timestamps[1])
+
+    assert columns["price"]["dtype"] == "float64"
+    prices = decode_typed_array(columns["price"], "f8")
+    assert prices[0] == 1.1 and np.isnan(prices[1])
+
+    assert columns["name"] == {"dtype": "object", "encoding": "json", "values": ["a", None, "c"], "name": "name"}
+
+
+def test_integer_column_with_missing_values_is_float():
+    encoded = encode_columnar(pd.DataFrame({"count": pd.Series([1, None], dtype="Int64")}))
+    assert encoded["columns"][0]["dtype"] == "float64"
+
+
+def test_encode_empty_result():
+    encoded = encode_columnar(pd.DataFrame())
+    assert encoded["row_count"] == 0
+    assert encoded["columns"] == []
+
+
+def test_rows_format_is_not_encoded():
+    assert encode_result(pd.DataFrame({"a": [1]}), RESULT_FORMAT_ROWS) is None
@@ -0,0 +1,252 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from utils import text_search
+from utils.metrics import get_counter
+from utils.query_control import QueryCancelled, current_cancellation
+from utils.text_search import SpeculativeSearch, agent_text_search, normal_retrieve, normal_retrieve_async, \
+    normal_text_search, text_to_sql_with_early_execution
+
+PROFILE = {'tables_info': 'CREATE TABLE sales (id INTEGER, amount REAL)', 'hints': '', 'prompt_map': {},
+           'db_type': 'sqlite', 'db_url': 'sqlite://'}
+RESPONSE = ["<sql>SELECT SUM(amount) ", "FROM sales</sql>", "\nThe total of the sales."]
+
+
+def stream(chunks, error=None):
+    def text_to_sql_stream(*args, **kwargs):
+        yield from chunks
+        if error is not None:
+            raise error
+
+    return text_to_sql_stream
+
+
+def test_sql_is_executed_before_the_explanation_is_generated(monkeypatch):
+    executions = []
+    sql_executed = threading.Event()
+
+    def get_sql_result_tool(database_profile, sql, model_type, search_box):
+        executions.append((sql, model_type, search_box))
+        sql_executed.set()
+        return {"sql": sql, "status_code": 200}
+
+    def text_to_sql_stream(*args, **kwargs):
+        yield from RESPONSE[:2]
+        # the query runs while the explanation is still being generated
+        assert sql_executed.wait(5)
+        yield RESPONSE[2]
+
+    monkeypatch.setattr(text_search, 'text_to_sql_stream', text_to_sql_stream)
+    monkeypatch.setattr(text_search, 'get_sql_result_tool', get_sql_result_tool)
+    response, sql_result_future = text_to_sql_with_early_execution(PROFILE, 'total sales', 'model', [], [])
+    assert response == "".join(RESPONSE)
+    assert sql_result_future.result(timeout=5)["sql"] == "SELECT SUM(amount) FROM sales"
+    assert executions == [("SELECT SUM(amount) FROM sales", 'model', 'total sales')]
+
+
+def test_no_execution_without_sql(monkeypatch):
+    monkeypatch.setattr(text_search, 'text_to_sql_stream', stream(["I cannot answer this question."]))
+    monkeypatch.setattr(text_search, 'get_sql_result_tool', lambda *args: pytest.fail("nothing to execute"))
+    assert text_to_sql_with_early_execution(PROFILE, 'weather', 'model', [], []) == \
+        ("I cannot answer this question.", None)
+
+
+def test_execution_is_cancelled_when_the_response_fails(monkeypatch):
+    started = threading.Event()
+    cancelled = threading.Event()
+
+    def get_sql_result_tool(database_profile, sql, model_type, search_box):
+        # stands for statement_guard, which stops the statement when the token is cancelled
+        current_cancellation.get().register(cancelled.set)
+        started.set()
+        if not cancelled.wait(5):
+            return {"sql": sql, "status_code": 200}
+        raise QueryCancelled()
+
+    def text_to_sql_stream(*args, **kwargs):
+        yield from RESPONSE[:2]
+        assert started.wait(5)
+        raise RuntimeError("stream interrupted")
+
+    monkeypatch.setattr(text_search, 'text_to_sql_stream', text_to_sql_stream)
+    monkeypatch.setattr(text_search, 'get_sql_result_tool', get_sql_result_tool)
+    with pytest.raises(RuntimeError):
+        text_to_sql_with_early_execution(PROFILE, 'total sales', 'model', [], [])
+    assert cancelled.is_set()
+
+
+def retrieval_stub(results, barrier=None, delays=None):
+    """
+    Stand for get_retrieve_opensearch, the results and delays are keyed by the searched text
+    """
+    def get_retrieve_opensearch(opensearch_info, query, search_type, selected_profile, top_k, score_threshold):
+        if barrier is not None:
+            # every retrieval waits for the others, which only returns when they run concurrently
+            barrier.wait(timeout=5)
+        time.sleep((delays or {}).get(query, 0))
+        result = results[query]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return get_retrieve_opensearch
+
+
+def test_retrievals_run_concurrently_and_merge_in_order(monkeypatch):
+    results = {'region': [{'entity': 'region'}], 'product': [{'entity': 'product'}],
+               'sales by region and product': [{'question': 'sales by region'}]}
+    monkeypatch.setattr(text_search, 'get_retrieve_opensearch',
+                        retrieval_stub(results, barrier=threading.Barrier(3)))
+    entity_slot_retrieve, retrieve_result = normal_retrieve({}, 'sales by region and product',
+                                                            ['region', 'product'], 'profile', True)
+    assert entity_slot_retrieve == [{'entity': 'region'}, {'entity': 'product'}]
+    assert retrieve_result == [{'question': 'sales by region'}]
+
+
+def test_failed_and_late_retrievals_are_skipped(monkeypatch):
+    monkeypatch.setattr(text_search, 'RETRIEVAL_TIMEOUT', 0.2)
+    results = {'region': RuntimeError("index missing"), 'product': [{'entity': 'product'}],
+               'sales': [{'question': 'sales'}]}
+    monkeypatch.setattr(text_search, 'get_retrieve_opensearch', retrieval_stub(results, delays={'product': 1}))
+    start_time = time.monotonic()
+    assert normal_retrieve({}, 'sales', ['region', 'product'], 'profile', True) == ([], [{'question': 'sales'}])
+    assert time.monotonic() - start_time < 1
+
+
+def test_no_retrieval_without_rag(monkeypatch):
+    monkeypatch.setattr(text_search, 'get_retrieve_opensearch', lambda *args: pytest.fail("no retrieval"))
+    assert normal_retrieve({}, 'sales', ['region'], 'profile', False) == ([], [])
+
+
+def test_async_retrievals_run_concurrently(monkeypatch):
+    results = {'region': [{'entity': 'region'}], 'sales by region': [{'question': 'sales by region'}]}
+    monkeypatch.setattr(text_search, 'get_retrieve_opensearch',
+                        retrieval_stub(results, barrier=threading.Barrier(2)))
+    assert asyncio.run(normal_retrieve_async({}, 'sales by region', ['region'], 'profile', True)) == \
+        ([{'entity': 'region'}], [{'question': 'sales by region'}])
+
+
+AGENT_TASKS = {'task_1': 'sales by region', 'task_2': 'weather of the day', 'task_3': 'sales by product'}
+
+
+def agent_text_to_sql_stub(barrier=None, error=None):
+    def text_to_sql(ddl, hints, prompt_map, search_box, model_id=None, sql_examples=None, ner_example=None,
+                    dialect='mysql', model_provider=None, profile_key=None):
+        if barrier is not None:
+            # every sub-task waits for the others, which only returns when they run in parallel
+            barrier.wait(timeout=5)
+        if search_box == error:
+            raise RuntimeError("model unavailable")
+        if search_box.startswith('weather'):
+            return "The data cannot answer this question."
+        return f"<sql>SELECT '{search_box}'</sql>"
+
+    return text_to_sql
+
+
+def test_agent_sub_tasks_run_in_parallel_and_keep_their_order(monkeypatch):
+    monkeypatch.setattr(text_search, 'text_to_sql', agent_text_to_sql_stub(barrier=threading.Barrier(3)))
+    results = agent_text_search('sales overview', 'model', PROFILE, [], {}, 'profile', False, AGENT_TASKS)
+    # the sub-task without SQL is dropped
+    assert [(result['query'], result['sql']) for result in results] == \
+        [('sales by region', "SELECT 'sales by region'"), ('sales by product', "SELECT 'sales by product'")]
+
+
+def test_agent_sub_tasks_retrieve_their_examples(monkeypatch):
+    retrievals = []
+
+    def get_retrieve_opensearch(opensearch_info, query, search_type, selected_profile, top_k, score_threshold):
+        retrievals.append((query, search_type))
+        return [{'search_type': search_type}]
+
+    monkeypatch.setattr(text_search, 'get_retrieve_opensearch', get_retrieve_opensearch)
+    monkeypatch.setattr(text_search, 'text_to_sql', agent_text_to_sql_stub())
+    agent_text_search('sales overview', 'model', PROFILE, [], {}, 'profile', True, AGENT_TASKS)
+    assert sorted(retrievals) == sorted((query, search_type) for query in AGENT_TASKS.values()
+                                        for search_type in ('ner', 'query'))
+
+
+def test_failed_agent_sub_task_fails_the_search(monkeypatch):
+    monkeypatch.setattr(text_search, 'text_to_sql', agent_text_to_sql_stub(error='sales by product'))
+    assert agent_text_search('sales overview', 'model', PROFILE, [], {}, 'profile', False, AGENT_TASKS) == []
+
+
+def speculative_text_to_sql_stub(calls):
+    def text_to_sql(ddl, hints, prompt_map, search_box, model_id=None, sql_examples=None, ner_example=None,
+                    dialect='mysql', model_provider=None, profile_key=None):
+        calls.append((search_box, sql_examples, ner_example))
+        return "<sql>SELECT SUM(amount) FROM sales</sql>"
+
+    return text_to_sql
+
+
+def test_speculative_search_is_used_by_the_normal_search(monkeypatch):
+    retrieval_started = threading.Event()
+    calls = []
+
+    def get_retrieve_opensearch(opensearch_info, query, search_type, selected_profile, top_k, score_threshold):
+        retrieval_started.set()
+        return [{'question': query}]
+
+    monkeypatch.setattr(text_search, 'get_retrieve_opensearch', get_retrieve_opensearch)
+    monkeypatch.setattr(text_search, 'text_to_sql', speculative_text_to_sql_stub(calls))
+    hits = get_counter('speculation.hit')
+    speculative_search = SpeculativeSearch('total sales', 'model', PROFILE, {}, 'profile', True, with_sql=True)
+    # the work starts before the intent is known
+    assert retrieval_started.wait(5)
+    search_result = normal_text_search('total sales', 'model', PROFILE, [], {}, 'profile', True,
+                                       speculative_search=speculative_search)
+    assert search_result.sql == "SELECT SUM(amount) FROM sales"
+    assert search_result.retrieve_result == [{'question': 'total sales'}]
+    # the SQL was generated once, speculatively, with the speculative examples
+    assert calls == [('total sales', [{'question': 'total sales'}], [])]
+    assert get_counter('speculation.hit') == hits + 1
+    assert speculative_search.time_saved > 0
+
+
+def test_speculative_sql_is_not_used_with_entity_examples(monkeypatch):
+    calls = []
+    monkeypatch.setattr(text_search, 'get_retrieve_opensearch', retrieval_stub(
+        {'region': [{'entity': 'region'}], 'sales by region': [{'question': 'sales by region'}]}))
+    monkeypatch.setattr(text_search, 'text_to_sql', speculative_text_to_sql_stub(calls))
+    sql_misses = get_counter('speculation.sql_miss')
+    speculative_search = SpeculativeSearch('sales by region', 'model', PROFILE, {}, 'profile', True, with_sql=True)
+    speculative_search.response_future.result(timeout=5)
+    search_result = normal_text_search('sales by region', 'model', PROFILE, ['region'], {}, 'profile', True,
+                                       speculative_search=speculative_search)
+    assert search_result.entity_slot_retrieve == [{'entity': 'region'}]
+    assert get_counter('speculation.sql_miss') == sql_misses + 1
+    # the SQL is generated again with the entity examples
+    assert calls[-1] == ('sales by region', [{'question': 'sales by region'}], [{'entity': 'region'}])
+
+
+def test_failed_speculative_retrieval_is_run_again(monkeypatch):
+    attempts = []
+
+    def get_retrieve_opensearch(opensearch_info, query, search_type, selected_profile, top_k, score_threshold):
+        attempts.append(query)
+        if len(attempts) == 1:
+            raise RuntimeError("connection reset")
+        return [{'question': query}]
+
+    monkeypatch.setattr(text_search, 'get_retrieve_opensearch', get_retrieve_opensearch)
+    speculative_search = SpeculativeSearch('total sales', 'model', PROFILE, {}, 'profile', True)
+    assert speculative_search.get_retrieve_result() == [{'question': 'total sales'}]
+    assert attempts == ['total sales', 'total sales']
+
+
+def test_discarded_speculative_search_is_cancelled(monkeypatch):
+    monkeypatch.setattr(text_search, 'get_retrieve_opensearch', lambda *args: [])
+    misses = get_counter('speculation.miss')
+    speculative_search = SpeculativeSearch('hello', 'model', PROFILE, {}, 'profile', True)
+    speculative_search.retrieve_future.result(timeout=5)
+    # work still queued behind other questions is dropped
+    speculative_search.retrieve_future, speculative_search.response_future = Future(), Future()
+    speculative_search.discard()
+    assert speculative_search.retrieve_future.cancelled()
+    assert speculative_search.response_future.cancelled()
+    assert get_counter('speculation.miss') == misses + 1
@@ -0,0 +1,75 @@
+from utils.tool import GeneratedSQLStreamParser, get_generated_sql, get_generated_sql_explain, get_question_literals, \
+    limit_query, replace_generated_sql
+
+
+def test_get_generated_sql():
+    response = "<sql>SELECT 1</sql>\nThe query selects one."
+    assert get_generated_sql(response) == "SELECT 1"
+    assert get_generated_sql_explain(response) == "\nThe query selects one."
+    assert get_generated_sql("no sql") == ""
+
+
+def test_replace_generated_sql_keeps_explanation():
+    response = "<sql>SELECT * FROM sales</sql>\nThe query lists the sales."
+    assert replace_generated_sql(response, "SELECT * FROM sales WHERE year = 2024") == \
+        "<sql>SELECT * FROM sales WHERE year = 2024</sql>\nThe query lists the sales."
+    assert replace_generated_sql("no sql", "SELECT 1") == "no sql"
+
+
+def test_get_question_literals():
+    assert get_question_literals("sales in 2023") != get_question_literals("sales in 2024")
+    assert get_question_literals("What were the sales in 2023?") == get_question_literals("sales of 2023")
+    assert get_question_literals("top 10 products of 'Acme' in 2023") == ("10", "2023", "acme")
+    assert get_question_literals('orders of "East Coast"') == ("east coast",)
+    # apostrophes are not quotes
+    assert get_question_literals("the customer's orders and the store's sales") == ()
+
+
+def test_stream_parser_completes_sql_across_chunks():
+    parser = GeneratedSQLStreamParser()
+    assert not parser.feed("<sql>SELECT name ")
+    assert not parser.feed("FROM users</s")
+    assert not parser.sql_ready
+    assert parser.feed("ql>\nThe query lists ")
+    assert parser.sql_ready
+    assert parser.sql == "SELECT name FROM users"
+    # the SQL is only reported complete once
+    assert not parser.feed("the users.")
+    assert parser.response == "<sql>SELECT name FROM users</sql>\nThe query lists the users."
+
+
+def test_stream_parser_without_sql():
+    parser = GeneratedSQLStreamParser()
+    for chunk in ["I cannot ", "answer this."]:
+        assert not parser.feed(chunk)
+    assert parser.sql is None
+
+
+def test_limit_query_appends_limit():
+    assert limit_query("SELECT * FROM sales", 100) == "SELECT * FROM sales\nLIMIT 101"
+    assert limit_query("SELECT * FROM sales;\n", 100) == "SELECT * FROM sales\nLIMIT 101"
+
+
+def test_limit_query_without_limit():
+    assert limit_query("SELECT * FROM sales", 0) == "SELECT * FROM sales"
+
+
+def test_limit_query_strips_trailing_comment():
+    assert limit_query("SELECT * FROM sales -- all sales", 10) == "SELECT * FROM sales\nLIMIT 11"
+
+
+def test_limit_query_keeps_top_level_limit():
+    sql = "SELECT * FROM sales ORDER BY amount DESC LIMIT 5"
+    assert limit_query(sql, 100) == sql
+    sql = "SELECT * FROM sales FETCH FIRST 5 ROWS ONLY"
+    assert limit_query(sql, 100) == sql
+
+
+def test_limit_query_limits_outer_query_of_limited_subquery():
+    sql = "SELECT * FROM (SELECT * FROM sales LIMIT 5) AS top_sales"
+    assert limit_query(sql, 100) == sql + "\nLIMIT 101"
+
+
+def test_limit_query_skips_other_statements():
+    for sql in ["UPDATE sales SET amount = 0", "SELECT 1; SELECT 2", ""]:
+        assert limit_query(sql, 100) == sql
@@ -0,0 +1,56 @@
+import json
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from utils.visualization import classify_chart_type, evaluate_chart_type_classifier
+
+SAMPLES_PATH = Path(__file__).parent / 'fixtures' / 'chart_type_samples.json'
+
+
+@pytest.fixture(scope='module')
+def labelled_samples():
+    with open(SAMPLES_PATH) as f:
+        return json.load(f)
+
+
+def test_classifier_agrees_with_the_labels(labelled_samples):
+    evaluation = evaluate_chart_type_classifier(labelled_samples)
+    assert evaluation['samples'] == len(labelled_samples)
+    assert evaluation['fast_path_rate'] >= 0.75
+    assert evaluation['fast_path_accuracy'] >= 0.95
+    assert evaluation['model_agreement'] is None
+
+
+def test_ambiguous_shapes_fall_back_to_the_model():
+    # repeated categories, two measures, and more than two columns
+    assert classify_chart_type("Revenue by country",
+                               pd.DataFrame([["France", 1], ["France", 2]], columns=["country", "revenue"])) is None
+    assert classify_chart_type("Price and quantity",
+                               pd.DataFrame([[9.99, 3], [4.5, 12]], columns=["price", "quantity"])) is None
+    assert classify_chart_type("Revenue and cost by region",
+                               pd.DataFrame([["North", 5, 3]], columns=["region", "revenue", "cost"])) is None
+
+
+def test_pie_needs_few_non_negative_parts():
+    data = pd.DataFrame([["a", 10], ["b", -2]], columns=["account", "balance"])
+    assert classify_chart_type("share of the balance by account", data) is None
+    assert classify_chart_type("balance by account", data) == {"show_type": "bar",
+                                                               "format_data": [["account", "balance"]]}
+
+
+def test_agreement_with_the_model(labelled_samples, monkeypatch):
+    from utils import llm
+    labels = {sample['question']: sample['show_type'] for sample in labelled_samples}
+    calls = []
+
+    def select_data_visualization_type(model_id, search_box, search_data, prompt_map):
+        calls.append(model_id)
+        # the model answers like the labels, except for the pies it shows as bars
+        return {"show_type": "bar" if labels[search_box] == "pie" else labels[search_box]}
+
+    monkeypatch.setattr(llm, 'select_data_visualization_type', select_data_visualization_type)
+    evaluation = evaluate_chart_type_classifier(labelled_samples, model_id='model')
+    assert len(calls) == 13
+    assert evaluation['model_agreement'] == pytest.approx(10 / 13)
@@ -1,35 +1,63 @@
 import sqlalchemy as db
 from sqlalchemy import text
-from utils.env_var import RDS_MYSQL_HOST, RDS_MYSQL_PORT, RDS_MYSQL_USERNAME, RDS_MYSQL_PASSWORD, RDS_MYSQL_DBNAME, RDS_PQ_SCHEMA
+from utils.env_var import RDS_MYSQL_HOST, RDS_MYSQL_PORT, RDS_MYSQL_USERNAME, RDS_MYSQL_PASSWORD, RDS_MYSQL_DBNAME, RDS_PQ_SCHEMA, \
+    SQL_MAX_ROWS, SQL_FETCH_CHUNK_ROWS, SQL_TOTAL_COUNT, RESULT_CACHE_TTL, SQL_COST_GUARD
 import pandas as pd
 import logging
 import sqlparse
 from nlq.business.connection import ConnectionManagement
+from nlq.data_access.database import RelationDatabase
+from utils.result_cache import get_cached_result, put_cached_result
+from utils.query_control import QUERY_STATUS_SUCCEEDED, QUERY_STATUS_FAILED, QUERY_STATUS_TIMEOUT, \
+    QUERY_STATUS_CANCELLED, QUERY_STATUS_REJECTED, QueryTimeout, QueryCancelled, current_cancellation, get_statement_timeout, \
+    statement_guard, add_statement_timeout_clause
+from utils.cost_guard import COST_GUARD_REJECT, COST_GUARD_REWRITE, QueryCostExceeded, check_query_cost, \
+    guard_query_cost
+from utils.tool import limit_query
 
 logger = logging.getLogger(__name__)
 
 ALLOWED_QUERY_TYPES = ['SELECT']
+
+
+def resolve_db_url(p_db_url):
+    """
+    Fill in the credentials of the sample RDS database URL template
+    """
+    if isinstance(p_db_url, str) and '{RDS_MYSQL_USERNAME}' in p_db_url:
+        return p_db_url.format(
+            RDS_MYSQL_HOST=RDS_MYSQL_HOST,
+            RDS_MYSQL_PORT=RDS_MYSQL_PORT,
+            RDS_MYSQL_USERNAME=RDS_MYSQL_USERNAME,
+            RDS_MYSQL_PASSWORD=RDS_MYSQL_PASSWORD,
+            RDS_MYSQL_DBNAME=RDS_MYSQL_DBNAME,
+        )
+    return p_db_url
+
+
+def get_engine(p_db_url):
+    """
+    Get the shared pooled engine of a DB URL
+    """
+    return RelationDatabase.get_engine(resolve_db_url(p_db_url))
+
+
 def query_from_database(p_db_url: str, query, schema=None):
     """
     Query the database
     """
     try:
-        if '{RDS_MYSQL_USERNAME}' in p_db_url:
-            engine = db.create_engine(p_db_url.format(
-                RDS_MYSQL_HOST=RDS_MYSQL_HOST,
-                RDS_MYSQL_PORT=RDS_MYSQL_PORT,
-                RDS_MYSQL_USERNAME=RDS_MYSQL_USERNAME,
-                RDS_MYSQL_PASSWORD=RDS_MYSQL_PASSWORD,
-                RDS_MYSQL_DBNAME=RDS_MYSQL_DBNAME,
-            ))
-        else:
-            engine = db.create_engine(p_db_url)
+        engine = get_engine(p_db_url)
         with engine.connect() as connection:
             logger.info(f'{query=}')
             sanitized_query = sqlparse.format(query, strip_comments=True)
             query_type = sqlparse.parse(sanitized_query)[0].get_type()
             if query_type not in ALLOWED_QUERY_TYPES:
                 return {"status": "error", "message": f"Query type '{query_type}' is not allowed."}
+            if SQL_COST_GUARD in (COST_GUARD_REJECT, COST_GUARD_REWRITE):
+                cost_overrun = check_query_cost(connection, sanitized_query)
+                if cost_overrun is not None:
+                    return {"status": "error", "message": f"Query is too expensive to run: {cost_overrun}"}
             # if schema and 'postgres' in p_db_url:
             #     query = f'SET search_path TO {schema}; {query}'
             cursor = connection.execute(text(sanitized_query))
@@ -46,56 +74,189 @@ def query_from_database(p_db_url: str, query, schema=None):
     }
 
 
-def query_from_sql_pd(p_db_url: str, query, schema=None):
+def get_profile_max_rows(profile):
+    max_rows = profile.get('max_rows')
+    return int(max_rows) if max_rows else SQL_MAX_ROWS
+
+
+def fetch_dataframe(connection, sql, max_rows, cancellation=None):
+    """
+    Fetch at most max_rows rows in chunks through a server-side cursor where the driver supports it
+    :param max_rows: rows returned at most, 0 for all the rows
+    :param cancellation: QueryCancellation checked between the chunks
+    :return: DataFrame, and whether the query returned more rows than max_rows
+    """
+    if max_rows <= 0:
+        max_rows = float('inf')
+    connection = connection.execution_options(stream_results=True, max_row_buffer=SQL_FETCH_CHUNK_ROWS)
+    chunk_iterator = pd.read_sql_query(text(sql), connection, chunksize=int(min(SQL_FETCH_CHUNK_ROWS, max_rows + 1)))
+    chunks = []
+    row_count = 0
+    try:
+        for chunk in chunk_iterator:
+            if cancellation is not None and cancellation.cancelled:
+                raise QueryCancelled("query cancelled by the client")
+            chunks.append(chunk)
+            row_count += len(chunk)
+            if row_count > max_rows:
+                break
+    finally:
+        chunk_iterator.close()
+    if not chunks:
+        return pd.DataFrame(), False
+    result_df = pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+    if row_count > max_rows:
+        return result_df.iloc[:max_rows], True
+    return result_df, False
+
+
+def count_query_rows(connection, sql, statement_timeout=0):
+    """
+    Count the rows a query returns without its row limit, a full scan of the query run only when SQL_TOTAL_COUNT
+    is enabled
+    """
+    count_sql = sqlparse.format(sql, strip_comments=True).strip().rstrip(';').strip()
+    count_sql = add_statement_timeout_clause(connection, f"SELECT COUNT(*) FROM ({count_sql}) AS total_count_query",
+                                             statement_timeout)
+    return int(connection.execute(text(count_sql)).scalar())
+
+
+def count_truncated_rows(connection, sql, statement_timeout=0, cancellation=None):
+    """
+    Count the rows of a truncated result within the statement timeout
+    :return: row count, None if the count failed or timed out
+    :raise QueryCancelled: the query was cancelled
+    """
+    try:
+        with statement_guard(connection, statement_timeout, cancellation):
+            return count_query_rows(connection, sql, statement_timeout)
+    except QueryCancelled:
+        raise
+    except Exception as e:
+        logger.warning(f"count_query_rows is error: {e}")
+        return None
+
+
+def get_profile_result_cache_ttl(profile):
+    result_cache_ttl = profile.get('result_cache_ttl')
+    return int(result_cache_ttl) if result_cache_ttl is not None else RESULT_CACHE_TTL
+
+
+def get_profile_statement_timeout(profile):
+    return get_statement_timeout(profile.get('db_type'))
+
+
+def get_cached_query_result(p_db_url, sql, max_rows=SQL_MAX_ROWS, result_cache_ttl=0):
+    """
+    Get the result of a query from the query result cache
+    :param result_cache_ttl: seconds the results are cached, 0 when the cache is off
+    :return: dict as returned by fetch_query_result, None if the result is not cached
+    """
+    if result_cache_ttl <= 0:
+        return None
+    cached_result = get_cached_result(RelationDatabase.get_engine_key(resolve_db_url(p_db_url)), sql, max_rows)
+    if cached_result is not None:
+        logger.info(f"Query result cache hit for {sql=}")
+    return cached_result
+
+
+def fetch_query_result(p_db_url, sql, max_rows=SQL_MAX_ROWS, result_cache_ttl=0, with_total_count=False,
+                       statement_timeout=0, cancellation=None):
+    """
+    Execute a query with a row limit, or serve its result from the query result cache
+    :param result_cache_ttl: seconds the result is cached, 0 to always execute the query
+    :param with_total_count: count the rows of a truncated result without the limit
+    :param statement_timeout: seconds the query may run, 0 for no timeout
+    :param cancellation: QueryCancellation cancelling the running query
+    :raise QueryTimeout: the query ran longer than statement_timeout
+    :raise QueryCancelled: the query was cancelled
+    :return: dict with the DataFrame, whether it was truncated and the total count
+    """
+    cached_result = get_cached_query_result(p_db_url, sql, max_rows, result_cache_ttl)
+    if cached_result is not None:
+        return cached_result
+
+    db_url = resolve_db_url(p_db_url)
+    result = {"data": pd.DataFrame(), "truncated": False, "total_count": None}
+    with RelationDatabase.get_engine(db_url).connect() as connection:
+        logger.info(f'{sql=}')
+        with statement_guard(connection, statement_timeout, cancellation):
+            limited_sql = add_statement_timeout_clause(connection, limit_query(sql, max_rows), statement_timeout)
+            result["data"], result["truncated"] = fetch_dataframe(connection, limited_sql, max_rows, cancellation)
+        if result["truncated"]:
+            logger.info(f"Result of {sql=} truncated to {max_rows} rows")
+            if with_total_count:
+                result["total_count"] = count_truncated_rows(connection, sql, statement_timeout, cancellation)
+    if result_cache_ttl > 0:
+        put_cached_result(RelationDatabase.get_engine_key(db_url), sql, max_rows, result, result_cache_ttl)
+    return result
+
+
+def query_from_sql_pd(p_db_url: str, query, schema=None, max_rows=SQL_MAX_ROWS, result_cache_ttl=0):
     """
     Query the database
     """
-    if '{RDS_MYSQL_USERNAME}' in p_db_url:
-        engine = db.create_engine(p_db_url.format(
-            RDS_MYSQL_HOST=RDS_MYSQL_HOST,
-            RDS_MYSQL_PORT=RDS_MYSQL_PORT,
-            RDS_MYSQL_USERNAME=RDS_MYSQL_USERNAME,
-            RDS_MYSQL_PASSWORD=RDS_MYSQL_PASSWORD,
-            RDS_MYSQL_DBNAME=RDS_MYSQL_DBNAME,
-        ))
-    else:
-        engine = db.create_engine(p_db_url)
-
-    with engine.connect() as connection:
-        logger.info(f'{query=}')
-        res = pd.DataFrame()
-        try:
-            res = pd.read_sql_query(text(query), connection)
-        except Exception as e:
-            logger.error("query_from_sql_pd is error")
-            logger.error(e)
-        return res
-
-
-def get_sql_result_tool(profile, sql):
-    result_dict = {"data": pd.DataFrame(), "sql": sql, "status_code": 200, "error_info": ""}
+    res = pd.DataFrame()
+    try:
+        res = fetch_query_result(p_db_url, query, max_rows, result_cache_ttl)["data"]
+    except Exception as e:
+        logger.error("query_from_sql_pd is error")
+        logger.error(e)
+    return res
+
+
+def get_sql_result_tool(profile, sql, model_id=None, search_box=None):
+    """
+    Execute the generated SQL of a profile, returning at most the max rows of the profile. The query runs within
+    the statement timeout of the database type and is cancelled with the question being answered. With the cost
+    guard enabled, it is checked with EXPLAIN first and may be rewritten into a cheaper query.
+    :param model_id: model rewriting a query over the cost budget
+    :param search_box: question answered by the query, a query over the budget is rejected without it
+    :return: dict with the executed SQL, whether it was rewritten, the DataFrame, whether it was truncated and, if
+    so, the row count without the limit, and the query status, one of the QUERY_STATUS_* values
+    """
+    result_dict = {"data": pd.DataFrame(), "sql": sql, "status_code": 200, "error_info": "", "truncated": False,
+                   "total_count": None, "status": QUERY_STATUS_SUCCEEDED, "rewritten": False}
     try:
         p_db_url = profile['db_url']
         if not p_db_url:
             conn_name = profile['conn_name']
             p_db_url = ConnectionManagement.get_db_url_by_name(conn_name)
 
-        if '{RDS_MYSQL_USERNAME}' in p_db_url:
-            engine = db.create_engine(p_db_url.format(
-                RDS_MYSQL_HOST=RDS_MYSQL_HOST,
-                RDS_MYSQL_PORT=RDS_MYSQL_PORT,
-                RDS_MYSQL_USERNAME=RDS_MYSQL_USERNAME,
-                RDS_MYSQL_PASSWORD=RDS_MYSQL_PASSWORD,
-                RDS_MYSQL_DBNAME=RDS_MYSQL_DBNAME,
-            ))
+        max_rows = get_profile_max_rows(profile)
+        result_cache_ttl = get_profile_result_cache_ttl(profile)
+        # a cached result is served without the EXPLAIN, and the model rewrite, of the cost guard
+        cached_result = get_cached_query_result(p_db_url, sql, max_rows, result_cache_ttl)
+        if cached_result is not None:
+            result_dict.update(cached_result)
         else:
-            engine = db.create_engine(p_db_url)
-        with engine.connect() as connection:
-            logger.info(f'{sql=}')
-            executed_result_df = pd.read_sql_query(text(sql), connection)
-            result_dict["data"] = executed_result_df
+            statement_timeout = get_profile_statement_timeout(profile)
+            cancellation = current_cancellation.get()
+            executed_sql = guard_query_cost(resolve_db_url(p_db_url), profile, sql, model_id, search_box,
+                                            statement_timeout, cancellation)
+            if executed_sql != sql:
+                result_dict["sql"] = sql = executed_sql
+                result_dict["rewritten"] = True
+            result_dict.update(fetch_query_result(p_db_url, sql, max_rows, result_cache_ttl, SQL_TOTAL_COUNT,
+                                                  statement_timeout, cancellation))
+    except QueryCostExceeded as e:
+        logger.warning(f"get_sql_result rejected: {e}")
+        result_dict["error_info"] = e
+        result_dict["status_code"] = 500
+        result_dict["status"] = QUERY_STATUS_REJECTED
+    except QueryTimeout as e:
+        logger.warning(f"get_sql_result timed out: {e}")
+        result_dict["error_info"] = e
+        result_dict["status_code"] = 500
+        result_dict["status"] = QUERY_STATUS_TIMEOUT
+    except QueryCancelled as e:
+        logger.info(f"get_sql_result cancelled: {e}")
+        result_dict["error_info"] = e
+        result_dict["status_code"] = 500
+        result_dict["status"] = QUERY_STATUS_CANCELLED
     except Exception as e:
         logger.error("get_sql_result is error: {}".format(e))
         result_dict["error_info"] = e
         result_dict["status_code"] = 500
+        result_dict["status"] = QUERY_STATUS_FAILED
     return result_dict
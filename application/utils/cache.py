@@ -0,0 +1,223 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory cache with LRU eviction, optional TTL and optional size budget.
+    Concurrent misses on the same key are computed once by get_or_compute.
+    """
+
+    def __init__(self, max_entries=1024, ttl=None, max_bytes=None, size_of=sys.getsizeof):
+        """
+        :param max_entries: max number of entries, 0 disables the cache
+        :param ttl: seconds an entry stays valid, None keeps it until evicted
+        :param max_bytes: max total size of the values, None for no budget
+        :param size_of: function estimating the size in bytes of a value
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.current_bytes = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._get_locked(key, default)
+
+    def _get_locked(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        value, expire_at, size = entry
+        if expire_at is not None and expire_at < time.monotonic():
+            self._remove_locked(key)
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, ttl=None):
+        """
+        Store a value, values larger than the whole size budget are not cached
+        :param ttl: seconds this entry stays valid, overrides the cache TTL
+        """
+        if not self.enabled:
+            return
+        size = self.size_of(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        ttl = ttl if ttl is not None else self.ttl
+        expire_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove_locked(key)
+            self._entries[key] = (value, expire_at, size)
+            self.current_bytes += size
+            while len(self._entries) > self.max_entries or (
+                    self.max_bytes is not None and self.current_bytes > self.max_bytes):
+                oldest_key = next(iter(self._entries))
+                self._remove_locked(oldest_key)
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute, ttl=None):
+        """
+        Get the value of a key, computing and storing it on a miss. Concurrent callers of a missing key wait for
+        the first caller instead of computing the same value again.
+        """
+        if not self.enabled:
+            return compute()
+        with self._lock:
+            value = self._get_locked(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            value = compute()
+            self.put(key, value, ttl)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove_locked(key)
+
+    def invalidate_where(self, predicate):
+        """
+        Remove every entry whose key matches the predicate
+        """
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                self._remove_locked(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def _remove_locked(self, key):
+        value, expire_at, size = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'evictions': self.evictions,
+                'bytes': self.current_bytes,
+            }
+
+
+class SQLiteCache:
+    """
+    Persistent string cache in a SQLite file with LRU eviction by last access, optional TTL and entry limit.
+    The file can be shared by processes and survives restarts.
+    """
+
+    def __init__(self, path, max_entries=100000, ttl=None):
+        """
+        :param path: SQLite file path
+        :param max_entries: max number of entries, the least recently used ones are evicted first
+        :param ttl: seconds an entry stays valid, None keeps it until evicted
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                           'expire_at REAL, accessed_at REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)')
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT value, expire_at FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return default
+            value, expire_at = row
+            if expire_at is not None and expire_at < now:
+                self._conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+                self.misses += 1
+                return default
+            self._conn.execute('UPDATE cache SET accessed_at = ? WHERE key = ?', (now, key))
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        now = time.time()
+        ttl = ttl if ttl is not None else self.ttl
+        expire_at = now + ttl if ttl is not None else None
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO cache (key, value, expire_at, accessed_at) VALUES (?, ?, ?, ?)',
+                               (key, value, expire_at, now))
+            count = self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute('DELETE FROM cache WHERE key IN '
+                                   '(SELECT key FROM cache ORDER BY accessed_at LIMIT ?)', (count - self.max_entries,))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM cache')
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,215 @@
+import logging
+import math
+import re
+from dataclasses import dataclass
+
+import sqlparse
+from sqlalchemy import text
+
+from nlq.data_access.database import RelationDatabase
+from utils.env_var import SQL_COST_GUARD, SQL_COST_MAX_ROWS, SQL_COST_MAX_COST, SQL_COST_MAX_BYTES, \
+    SQL_COST_REWRITE_ATTEMPTS
+from utils.executor import submit
+from utils.llm import rewrite_expensive_sql
+from utils.metrics import incr
+from utils.query_control import statement_guard
+from utils.tool import get_generated_sql
+
+try:
+    from google.cloud import bigquery
+except ImportError:
+    bigquery = None
+
+logger = logging.getLogger(__name__)
+
+# Modes of the pre-flight EXPLAIN of the generated queries, see SQL_COST_GUARD
+COST_GUARD_OFF = 'off'
+COST_GUARD_REJECT = 'reject'
+COST_GUARD_REWRITE = 'rewrite'
+
+POSTGRES_PLAN_COST_PATTERN = re.compile(r'cost=[\d.]+\.\.([\d.]+) rows=(\d+)')
+STARROCKS_CARDINALITY_PATTERN = re.compile(r'cardinality[=:]\s*(\d+)', re.IGNORECASE)
+SQLITE_SCAN_PATTERN = re.compile(r'^SCAN (?:TABLE )?("?)([\w.]+)\1(?:\s|$)')
+TABLE_ALIAS_PATTERN = re.compile(r'(?:\bFROM|\bJOIN|,)\s+("?)([\w.]+)\1(?:\s+AS)?\s+(\w+)', re.IGNORECASE)
+
+
+class QueryCostExceeded(Exception):
+    pass
+
+
+@dataclass
+class QueryCost:
+    """
+    Estimates of the database for a query, None where the dialect does not estimate it
+    """
+    rows: float = None
+    cost: float = None
+    bytes: int = None
+
+
+def explain_postgresql(connection, sql):
+    # PostgreSQL and Redshift, the scans below a LIMIT or an aggregate are the expensive nodes, so the largest node
+    # estimates are kept rather than those of the root node
+    plan = [row[0] for row in connection.execute(text(f"EXPLAIN {sql}"))]
+    estimates = [(float(match.group(1)), float(match.group(2)))
+                 for match in (POSTGRES_PLAN_COST_PATTERN.search(line) for line in plan) if match]
+    if not estimates:
+        return QueryCost()
+    return QueryCost(rows=max(rows for cost, rows in estimates), cost=max(cost for cost, rows in estimates))
+
+
+def explain_mysql(connection, sql):
+    # rows examined by the nested loop join of each SELECT, the product of the rows examined per table, and by
+    # the query, the sum over its SELECTs, e.g. the members of a UNION, the derived tables and the subqueries
+    select_rows = {}
+    for row in connection.execute(text(f"EXPLAIN {sql}")):
+        row_count = row._mapping.get('rows')
+        if row_count is not None:
+            select_rows.setdefault(row._mapping.get('id'), []).append(float(row_count))
+    if not select_rows:
+        return QueryCost()
+    return QueryCost(rows=sum(math.prod(rows) for rows in select_rows.values()))
+
+
+def explain_starrocks(connection, sql):
+    plan = "\n".join(str(row[0]) for row in connection.execute(text(f"EXPLAIN COSTS {sql}")))
+    cardinalities = [float(cardinality) for cardinality in STARROCKS_CARDINALITY_PATTERN.findall(plan)]
+    return QueryCost(rows=max(cardinalities) if cardinalities else None)
+
+
+def explain_clickhouse(connection, sql):
+    # rows read from the parts selected by the primary key and the partitions
+    rows = [row._mapping['rows'] for row in connection.execute(text(f"EXPLAIN ESTIMATE {sql}"))]
+    return QueryCost(rows=float(sum(rows)))
+
+
+def explain_bigquery(connection, sql):
+    if bigquery is None:
+        return QueryCost()
+    # a dry run through the DB-API cursor of the connection, whose execute accepts the job config of the query
+    cursor = connection.connection.dbapi_connection.cursor()
+    try:
+        cursor.execute(sql, job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False))
+        return QueryCost(bytes=cursor.query_job.total_bytes_processed)
+    finally:
+        cursor.close()
+
+
+def explain_sqlite(connection, sql):
+    """
+    SQLite does not estimate rows, the rows joined are estimated as the product of the sizes of the fully scanned
+    tables, the tables searched through an index are assumed selective
+    """
+    aliases = {alias.lower(): table for quote, table, alias in TABLE_ALIAS_PATTERN.findall(sql)}
+    rows = None
+    for row in connection.execute(text(f"EXPLAIN QUERY PLAN {sql}")):
+        match = SQLITE_SCAN_PATTERN.match(row[-1])
+        if not match or match.group(2).upper() in ('CONSTANT', 'SUBQUERY'):
+            continue
+        table = aliases.get(match.group(2).lower(), match.group(2))
+        try:
+            # the largest rowid is read from the end of the table b-tree, without a scan
+            table_rows = connection.execute(text(f'SELECT MAX(_rowid_) FROM "{table}"')).scalar() or 0
+        except Exception:
+            # a CTE, a view or a table without rowid
+            continue
+        rows = (rows or 1) * max(1, table_rows)
+    return QueryCost(rows=rows)
+
+
+cost_explainers = {
+    'postgresql': explain_postgresql,
+    'mysql': explain_mysql,
+    'starrocks': explain_starrocks,
+    'clickhouse': explain_clickhouse,
+    'bigquery': explain_bigquery,
+    'sqlite': explain_sqlite,
+}
+
+
+def explain_query_cost(connection, sql):
+    """
+    Estimate the cost of a query with the EXPLAIN of its dialect, without executing it
+    :param connection: sqlalchemy Connection
+    :return: QueryCost, None if the dialect has no estimates or the EXPLAIN failed
+    """
+    explain = cost_explainers.get(connection.dialect.name)
+    if explain is None:
+        return None
+    sql = sqlparse.format(sql, strip_comments=True).strip().rstrip(';').strip()
+    try:
+        return explain(connection, sql)
+    except Exception as e:
+        # e.g. a syntax error, reported when the query is executed
+        logger.warning(f"EXPLAIN of {sql=} failed: {e}")
+        return None
+
+
+def get_cost_overrun(query_cost, max_rows=None, max_cost=None, max_bytes=None):
+    """
+    :param max_rows: row budget, SQL_COST_MAX_ROWS if None
+    :param max_cost: planner cost budget, SQL_COST_MAX_COST if None
+    :param max_bytes: bytes budget, SQL_COST_MAX_BYTES if None
+    :return: why a query is over the budget, None if it is within the budget or was not estimated
+    """
+    if query_cost is None:
+        return None
+    max_rows = SQL_COST_MAX_ROWS if max_rows is None else max_rows
+    max_cost = SQL_COST_MAX_COST if max_cost is None else max_cost
+    max_bytes = SQL_COST_MAX_BYTES if max_bytes is None else max_bytes
+    if max_rows > 0 and query_cost.rows is not None and query_cost.rows > max_rows:
+        return f"an estimated {query_cost.rows:,.0f} rows are scanned or joined, the budget is {max_rows:,.0f} rows"
+    if max_cost > 0 and query_cost.cost is not None and query_cost.cost > max_cost:
+        return f"the estimated planner cost is {query_cost.cost:,.0f}, the budget is {max_cost:,.0f}"
+    if max_bytes > 0 and query_cost.bytes is not None and query_cost.bytes > max_bytes:
+        return f"an estimated {query_cost.bytes:,} bytes are processed, the budget is {max_bytes:,} bytes"
+    return None
+
+
+def check_query_cost(connection, sql):
+    """
+    :return: why the query is over the budget, None if it is within the budget
+    """
+    cost_overrun = get_cost_overrun(explain_query_cost(connection, sql))
+    incr('sql.cost_guard.over_budget' if cost_overrun is not None else 'sql.cost_guard.within_budget')
+    return cost_overrun
+
+
+def guard_query_cost(db_url, profile, sql, model_id=None, search_box=None, statement_timeout=0, cancellation=None):
+    """
+    Check the estimated cost of a query with EXPLAIN before it is executed. When SQL_COST_GUARD is rewrite and the
+    question is known, a query over the budget is generated again by the model, asking for a cheaper query.
+    :param db_url: database URL of the profile
+    :param profile: profile of the query, its schema is given to the model rewriting the query
+    :param model_id: model generating the rewrite
+    :param search_box: question answered by the query
+    :param statement_timeout: seconds an EXPLAIN may run, 0 for no timeout
+    :param cancellation: QueryCancellation cancelling the running EXPLAIN
+    :return: the SQL to execute, the given SQL or its rewrite
+    :raise QueryCostExceeded: the query, or its last rewrite, is over the budget
+    """
+    if SQL_COST_GUARD not in (COST_GUARD_REJECT, COST_GUARD_REWRITE):
+        return sql
+    rewrite_attempts = 0
+    if SQL_COST_GUARD == COST_GUARD_REWRITE and model_id and search_box:
+        rewrite_attempts = SQL_COST_REWRITE_ATTEMPTS
+    for attempt in range(rewrite_attempts + 1):
+        # the connection is not held while the model rewrites the query
+        with RelationDatabase.get_engine(db_url).connect() as connection:
+            # a query whose EXPLAIN fails or times out is not estimated, its execution has the same timeout
+            with statement_guard(connection, statement_timeout, cancellation):
+                cost_overrun = check_query_cost(connection, sql)
+        if cost_overrun is None:
+            return sql
+        logger.info(f"{sql=} is over the cost budget: {cost_overrun}")
+        if attempt == rewrite_attempts:
+            break
+        incr('sql.cost_guard.rewrite')
+        # the model is called within the concurrency of the llm stage, not of the database stage running the guard
+        rewrite_response = submit("llm", rewrite_expensive_sql, profile['tables_info'], profile['prompt_map'],
+                                  search_box, sql, cost_overrun, model_id, profile['db_type']).result()
+        rewritten_sql = get_generated_sql(rewrite_response)
+        if not rewritten_sql.strip():
+            break
+        sql = rewritten_sql
+    raise QueryCostExceeded(f"query too expensive to run, {cost_overrun}")
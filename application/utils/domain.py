@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Any
 
 
 @dataclass
@@ -8,3 +9,5 @@ class SearchTextSqlResult:
     retrieve_result: list
     response: str
     sql: str
+    # execution of the SQL started while the explanation was still being generated, if any
+    sql_result_future: Any = None
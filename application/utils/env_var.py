@@ -108,4 +108,135 @@ opensearch_info = {
     'embedding_dimension': EMBEDDING_DIMENSION
 }
 
-bedrock_ak_sk_info = get_bedrock_parameter()
\ No newline at end of file
+bedrock_ak_sk_info = get_bedrock_parameter()
+# Concurrency limits of the blocking stages executed off the event loop
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', '32'))
+RETRIEVAL_CONCURRENCY = int(os.getenv('RETRIEVAL_CONCURRENCY', '32'))
+DATABASE_CONCURRENCY = int(os.getenv('DATABASE_CONCURRENCY', '16'))
+DEFAULT_CONCURRENCY = int(os.getenv('DEFAULT_CONCURRENCY', '32'))
+# Background work kept off the stages of the questions, e.g. the embeddings of the intent classifier index
+BACKGROUND_CONCURRENCY = int(os.getenv('BACKGROUND_CONCURRENCY', '2'))
+# Max agent sub-tasks processed in parallel
+AGENT_TASK_PARALLELISM = int(os.getenv('AGENT_TASK_PARALLELISM', '8'))
+
+# Shared deadline in seconds for the concurrent RAG retrievals of one question
+RETRIEVAL_TIMEOUT = float(os.getenv('RETRIEVAL_TIMEOUT', '30'))
+
+# Speculative work started while the intent is classified: 'off', 'retrieval' or 'sql' (retrieval and SQL generation)
+SPECULATIVE_SEARCH = os.getenv('SPECULATIVE_SEARCH', 'off').lower()
+# Max seconds waited for the speculative work when it is needed, it is then done again without speculation
+SPECULATIVE_TIMEOUT = float(os.getenv('SPECULATIVE_TIMEOUT', '30'))
+
+# Process-wide embedding cache, EMBEDDING_CACHE_SIZE=0 disables it
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', '10000'))
+EMBEDDING_CACHE_TTL = int(os.getenv('EMBEDDING_CACHE_TTL', '86400'))
+EMBEDDING_CACHE_FLOAT32 = os.getenv('EMBEDDING_CACHE_FLOAT32', 'true').lower() == 'true'
+
+# Micro-batching of SageMaker embedding requests, EMBEDDING_BATCH_WINDOW_MS=0 disables it
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv('EMBEDDING_BATCH_WINDOW_MS', '5'))
+EMBEDDING_MAX_BATCH_SIZE = int(os.getenv('EMBEDDING_MAX_BATCH_SIZE', '32'))
+EMBEDDING_BATCH_CONCURRENCY = int(os.getenv('EMBEDDING_BATCH_CONCURRENCY', '4'))
+
+# Shared OpenSearch clients: connections kept alive per endpoint, request timeout, domain endpoint cache TTL
+OPENSEARCH_POOL_MAXSIZE = int(os.getenv('OPENSEARCH_POOL_MAXSIZE', '32'))
+OPENSEARCH_TIMEOUT = int(os.getenv('OPENSEARCH_TIMEOUT', '10'))
+OPENSEARCH_ENDPOINT_CACHE_TTL = int(os.getenv('OPENSEARCH_ENDPOINT_CACHE_TTL', '3600'))
+
+# Pooled SQLAlchemy engines shared per database URL
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+
+# Seconds a cached data profile is served before it is reloaded from DynamoDB
+PROFILE_CACHE_REFRESH_SECONDS = int(os.getenv('PROFILE_CACHE_REFRESH_SECONDS', '60'))
+
+# Seconds a resolved database connection is served before it is reloaded from DynamoDB
+CONNECTION_CACHE_REFRESH_SECONDS = int(os.getenv('CONNECTION_CACHE_REFRESH_SECONDS', '300'))
+
+# Per-profile semantic cache of generated SQL, questions at least SEMANTIC_CACHE_THRESHOLD cosine similar reuse it
+SEMANTIC_CACHE_ENABLED = os.getenv('SEMANTIC_CACHE_ENABLED', 'false').lower() == 'true'
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.95'))
+SEMANTIC_CACHE_TTL = int(os.getenv('SEMANTIC_CACHE_TTL', '3600'))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv('SEMANTIC_CACHE_MAX_ENTRIES', '1000'))
+SEMANTIC_CACHE_WITH_RESULT = os.getenv('SEMANTIC_CACHE_WITH_RESULT', 'false').lower() == 'true'
+
+# Cache of non-stream LLM responses by model and prompt, in memory and optionally in a SQLite file
+LLM_CACHE_ENABLED = os.getenv('LLM_CACHE_ENABLED', 'true').lower() == 'true'
+LLM_CACHE_SIZE = int(os.getenv('LLM_CACHE_SIZE', '2000'))
+LLM_CACHE_MAX_BYTES = int(os.getenv('LLM_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+LLM_CACHE_TTL = int(os.getenv('LLM_CACHE_TTL', '86400'))
+LLM_CACHE_DISK_PATH = os.getenv('LLM_CACHE_DISK_PATH', '')
+LLM_CACHE_DISK_SIZE = int(os.getenv('LLM_CACHE_DISK_SIZE', '100000'))
+
+# Stream the text-to-SQL tokens to WebSocket clients as they are generated
+WS_STREAM_SQL = os.getenv('WS_STREAM_SQL', 'false').lower() == 'true'
+
+# Start executing the generated SQL as soon as </sql> is generated, while the explanation is still being generated
+EARLY_SQL_EXECUTION = os.getenv('EARLY_SQL_EXECUTION', 'false').lower() == 'true'
+
+# Choose obvious chart types with rules instead of the model, and compare a sample of them with the model choice
+VISUALIZATION_FAST_PATH = os.getenv('VISUALIZATION_FAST_PATH', 'true').lower() == 'true'
+VISUALIZATION_SHADOW_RATE = float(os.getenv('VISUALIZATION_SHADOW_RATE', '0'))
+
+# Classify the intent locally by nearest neighbours over the logged queries, the uncertain ones go to the model
+INTENT_CLASSIFIER_ENABLED = os.getenv('INTENT_CLASSIFIER_ENABLED', 'false').lower() == 'true'
+INTENT_CLASSIFIER_THRESHOLD = float(os.getenv('INTENT_CLASSIFIER_THRESHOLD', '0.9'))
+INTENT_CLASSIFIER_SLOT_THRESHOLD = float(os.getenv('INTENT_CLASSIFIER_SLOT_THRESHOLD', '0.97'))
+INTENT_CLASSIFIER_TOP_K = int(os.getenv('INTENT_CLASSIFIER_TOP_K', '5'))
+INTENT_CLASSIFIER_MIN_VOTES = int(os.getenv('INTENT_CLASSIFIER_MIN_VOTES', '3'))
+INTENT_CLASSIFIER_MAX_EXAMPLES = int(os.getenv('INTENT_CLASSIFIER_MAX_EXAMPLES', '5000'))
+INTENT_CLASSIFIER_REFRESH_SECONDS = int(os.getenv('INTENT_CLASSIFIER_REFRESH_SECONDS', '3600'))
+
+# Client-side scheduling of the Bedrock calls per model id, e.g. {"anthropic.claude-3-sonnet-20240229-v1:0":
+# {"rpm": 100, "tpm": 200000}}. Models not listed use the defaults, 0 means no limit.
+LLM_RATE_LIMITS = json.loads(os.getenv('LLM_RATE_LIMITS', '{}'))
+LLM_DEFAULT_RPM = int(os.getenv('LLM_DEFAULT_RPM', '0'))
+LLM_DEFAULT_TPM = int(os.getenv('LLM_DEFAULT_TPM', '0'))
+# Max seconds a call waits in the queue, and expected wait above which optional calls are shed
+LLM_QUEUE_TIMEOUT = float(os.getenv('LLM_QUEUE_TIMEOUT', '120'))
+LLM_SHED_WAIT_SECONDS = float(os.getenv('LLM_SHED_WAIT_SECONDS', '5'))
+# Retries of a throttled Bedrock call by botocore, the scheduler backs off the model as well
+BEDROCK_MAX_ATTEMPTS = int(os.getenv('BEDROCK_MAX_ATTEMPTS', '10'))
+
+# Per-stage model routing, e.g. {"intent": "anthropic.claude-3-haiku-20240307-v1:0"}, stages not listed use the model
+# chosen by the user. Fallback models by model id are used when a model is throttled or its queue wait is longer
+# than LLM_FALLBACK_WAIT_SECONDS. LLM_MODEL_PRICES overrides the USD prices per 1000 input and output tokens.
+LLM_STAGE_MODELS = json.loads(os.getenv('LLM_STAGE_MODELS', '{}'))
+LLM_FALLBACK_MODELS = json.loads(os.getenv('LLM_FALLBACK_MODELS', '{}'))
+LLM_FALLBACK_WAIT_SECONDS = float(os.getenv('LLM_FALLBACK_WAIT_SECONDS', '10'))
+LLM_MODEL_PRICES = json.loads(os.getenv('LLM_MODEL_PRICES', '{}'))
+
+# Cached static part (schema, dialect and guidance) of the text-to-SQL prompts per profile, model and dialect
+PROMPT_CACHE_SIZE = int(os.getenv('PROMPT_CACHE_SIZE', '256'))
+
+# Max rows returned by a generated query, 0 for no limit, overridden by the max_rows of a profile, fetched in chunks of
+# SQL_FETCH_CHUNK_ROWS rows. A truncated result is flagged as having more than the max rows, its rows are only
+# counted when SQL_TOTAL_COUNT is enabled, which runs the query without the limit.
+SQL_MAX_ROWS = int(os.getenv('SQL_MAX_ROWS', '0'))
+SQL_FETCH_CHUNK_ROWS = int(os.getenv('SQL_FETCH_CHUNK_ROWS', '1000'))
+SQL_TOTAL_COUNT = os.getenv('SQL_TOTAL_COUNT', 'false').lower() == 'true'
+
+# Cache of the query results by connection and normalized SQL. RESULT_CACHE_TTL is the default of the profiles,
+# 0 disables the cache unless a profile sets its own result_cache_ttl.
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', '0'))
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', '1000'))
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+RESULT_CACHE_MAX_ENTRY_BYTES = int(os.getenv('RESULT_CACHE_MAX_ENTRY_BYTES', str(16 * 1024 * 1024)))
+
+# Timeout in seconds of the generated queries, by database type of the profile in SQL_STATEMENT_TIMEOUTS, e.g.
+# {"bigquery": 300}, else SQL_STATEMENT_TIMEOUT, 0 for no timeout. A statement still running SQL_CANCEL_GRACE_SECONDS
+# after its timeout, e.g. where the database has no server-side timeout, is cancelled by the client.
+SQL_STATEMENT_TIMEOUT = float(os.getenv('SQL_STATEMENT_TIMEOUT', '0'))
+SQL_STATEMENT_TIMEOUTS = json.loads(os.getenv('SQL_STATEMENT_TIMEOUTS', '{}'))
+SQL_CANCEL_GRACE_SECONDS = float(os.getenv('SQL_CANCEL_GRACE_SECONDS', '5'))
+
+# Pre-flight EXPLAIN of the generated queries: off, reject the queries estimated above the budget, or rewrite them
+# with the model up to SQL_COST_REWRITE_ATTEMPTS times before rejecting them. The row budget applies to the
+# estimated rows scanned or joined, the cost budget to the planner cost of PostgreSQL and Redshift, the bytes budget
+# to the BigQuery dry runs, 0 for no budget.
+SQL_COST_GUARD = os.getenv('SQL_COST_GUARD', 'off').lower()
+SQL_COST_MAX_ROWS = float(os.getenv('SQL_COST_MAX_ROWS', '100000000'))
+SQL_COST_MAX_COST = float(os.getenv('SQL_COST_MAX_COST', '0'))
+SQL_COST_MAX_BYTES = int(os.getenv('SQL_COST_MAX_BYTES', str(100 * 1024 ** 3)))
+SQL_COST_REWRITE_ATTEMPTS = int(os.getenv('SQL_COST_REWRITE_ATTEMPTS', '1'))
@@ -0,0 +1,161 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+
+from utils.env_var import LLM_CONCURRENCY, RETRIEVAL_CONCURRENCY, DATABASE_CONCURRENCY, DEFAULT_CONCURRENCY, \
+    AGENT_TASK_PARALLELISM, BACKGROUND_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+# Each blocking stage (Bedrock/SageMaker, OpenSearch, SQL databases, DynamoDB and other glue code) runs
+# in its own bounded thread pool, so a slow backend only exhausts its own stage and never the event loop.
+# The agent stage runs whole sub-task pipelines, which in turn submit their calls to the other stages.
+# The background stage runs bulk work, e.g. index builds, with a small pool so it never starves the questions.
+stage_concurrency_map = {
+    'llm': LLM_CONCURRENCY,
+    'retrieval': RETRIEVAL_CONCURRENCY,
+    'database': DATABASE_CONCURRENCY,
+    'default': DEFAULT_CONCURRENCY,
+    'agent': AGENT_TASK_PARALLELISM,
+    'background': BACKGROUND_CONCURRENCY,
+}
+
+_stage_executors = {}
+_stage_executors_lock = threading.Lock()
+
+
+def get_stage_executor(stage):
+    """
+    Get the thread pool of a stage, creating it on first use
+    :param stage: stage name, see stage_concurrency_map
+    :return: ThreadPoolExecutor
+    """
+    executor = _stage_executors.get(stage)
+    if executor is None:
+        with _stage_executors_lock:
+            executor = _stage_executors.get(stage)
+            if executor is None:
+                max_workers = stage_concurrency_map.get(stage, DEFAULT_CONCURRENCY)
+                executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'genbi-{stage}')
+                _stage_executors[stage] = executor
+    return executor
+
+
+def bind_context(func):
+    """
+    Bind a call to the context variables of the caller, e.g. the cancellation token of the question being answered
+    """
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+def submit(stage, func, *args, **kwargs):
+    """
+    Submit a blocking call to the thread pool of a stage
+    :return: concurrent.futures.Future
+    """
+    return get_stage_executor(stage).submit(bind_context(func), *args, **kwargs)
+
+
+async def run_blocking(stage, func, *args, **kwargs):
+    """
+    Run a blocking call in the thread pool of a stage without blocking the event loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_stage_executor(stage), functools.partial(bind_context(func), *args, **kwargs))
+
+
+def gather(stage, calls, timeout=None, default=None):
+    """
+    Run independent blocking calls concurrently in the thread pool of a stage with a shared deadline
+    :param stage: stage name
+    :param calls: list of zero-argument callables, e.g. functools.partial
+    :param timeout: shared deadline in seconds for all calls, None waits for all of them
+    :param default: value used for calls that failed or did not finish before the deadline
+    :return: results in the same order as calls
+    """
+    futures = [submit(stage, call) for call in calls]
+    wait_futures(futures, timeout=timeout)
+    results = []
+    for future in futures:
+        if not future.done():
+            future.cancel()
+            logger.warning(f"{stage} call did not finish within {timeout}s, skipped")
+            results.append(default)
+        elif future.exception() is not None:
+            logger.error(f"{stage} call failed: {future.exception()}")
+            results.append(default)
+        else:
+            results.append(future.result())
+    return results
+
+
+async def gather_blocking(stage, calls, timeout=None, default=None):
+    """
+    Async version of gather, awaiting the calls without blocking the event loop
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_stage_executor(stage)
+    futures = [loop.run_in_executor(executor, bind_context(call)) for call in calls]
+    if not futures:
+        return []
+    await asyncio.wait(futures, timeout=timeout)
+    results = []
+    for future in futures:
+        if not future.done():
+            future.cancel()
+            logger.warning(f"{stage} call did not finish within {timeout}s, skipped")
+            results.append(default)
+        elif future.exception() is not None:
+            logger.error(f"{stage} call failed: {future.exception()}")
+            results.append(default)
+        else:
+            results.append(future.result())
+    return results
+
+
+async def iterate_blocking(stage, func, *args, **kwargs):
+    """
+    Iterate a blocking generator in the thread pool of a stage, yielding its items to the event loop as they arrive
+    :param stage: stage name
+    :param func: function returning an iterator, called with args and kwargs in the thread pool
+    """
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in func(*args, **kwargs):
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(items.put_nowait, (item, None))
+        except BaseException as e:
+            loop.call_soon_threadsafe(items.put_nowait, (done, e))
+        else:
+            loop.call_soon_threadsafe(items.put_nowait, (done, None))
+
+    producer = loop.run_in_executor(get_stage_executor(stage), produce)
+    try:
+        while True:
+            item, error = await items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                break
+            yield item
+    finally:
+        # the consumer may stop early, let the producer thread finish without pushing more items
+        stop.set()
+    await producer
+
+
+def shutdown_executors(wait=True):
+    with _stage_executors_lock:
+        for stage, executor in _stage_executors.items():
+            logger.info(f"Shutting down {stage} executor")
+            executor.shutdown(wait=wait)
+        _stage_executors.clear()
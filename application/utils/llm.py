@@ -1,6 +1,17 @@
+import hashlib
 import json
+import queue
+import random
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import boto3
 from botocore.config import Config
+from botocore.exceptions import ClientError
 
 from utils.prompt import POSTGRES_DIALECT_PROMPT_CLAUDE3, MYSQL_DIALECT_PROMPT_CLAUDE3, \
     DEFAULT_DIALECT_PROMPT, SEARCH_INTENT_PROMPT_CLAUDE3, AWS_REDSHIFT_DIALECT_PROMPT_CLAUDE3, BIGQUERY_DIALECT_PROMPT_CLAUDE3
@@ -13,7 +24,18 @@ from utils.prompts.generate_prompt import generate_llm_prompt, generate_sagemake
     generate_agent_analyse_prompt, generate_data_summary_prompt, generate_suggest_question_prompt, \
     generate_query_rewrite_prompt
 
-from utils.env_var import bedrock_ak_sk_info, BEDROCK_REGION, BEDROCK_EMBEDDING_MODEL
+from utils.env_var import bedrock_ak_sk_info, BEDROCK_REGION, BEDROCK_EMBEDDING_MODEL, EMBEDDING_CACHE_SIZE, \
+    EMBEDDING_CACHE_TTL, EMBEDDING_CACHE_FLOAT32, EMBEDDING_BATCH_WINDOW_MS, EMBEDDING_MAX_BATCH_SIZE, \
+    EMBEDDING_BATCH_CONCURRENCY, LLM_CACHE_ENABLED, LLM_CACHE_SIZE, LLM_CACHE_MAX_BYTES, LLM_CACHE_TTL, \
+    LLM_CACHE_DISK_PATH, LLM_CACHE_DISK_SIZE, VISUALIZATION_FAST_PATH, VISUALIZATION_SHADOW_RATE, BEDROCK_MAX_ATTEMPTS, \
+    LLM_FALLBACK_WAIT_SECONDS
+from utils.executor import submit
+from utils.cache import LRUCache, SQLiteCache
+from utils.metrics import register_gauge, incr, observe, get_counter
+from utils.model_routing import route_model, get_fallback_model, record_model_call
+from utils.rate_limit import get_rate_limiter, estimate_tokens, RateLimitExceeded, PRIORITY_INTERACTIVE, \
+    PRIORITY_NORMAL, PRIORITY_OPTIONAL
+from utils.visualization import classify_chart_type
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -21,7 +43,7 @@ config = Config(
     region_name=BEDROCK_REGION,
     signature_version='v4',
     retries={
-        'max_attempts': 10,
+        'max_attempts': BEDROCK_MAX_ATTEMPTS,
         'mode': 'standard'
     },
     read_timeout=600
@@ -249,13 +271,124 @@ def generate_prompt(ddl, hints, search_box, sql_examples=None, ner_example=None,
     return claude_prompt, dialect_prompt
 
 
-def invoke_llm_model(model_id, system_prompt, user_prompt, max_tokens=2048, with_response_stream=False):
+# The models run at temperature 0.01, so a response is reused for an identical model and prompt. The memory tier
+# is backed by an optional SQLite file that survives restarts, e.g. to replay load tests without calling Bedrock.
+llm_response_cache = LRUCache(LLM_CACHE_SIZE if LLM_CACHE_ENABLED else 0, ttl=LLM_CACHE_TTL,
+                              max_bytes=LLM_CACHE_MAX_BYTES)
+llm_response_disk_cache = SQLiteCache(LLM_CACHE_DISK_PATH, max_entries=LLM_CACHE_DISK_SIZE, ttl=LLM_CACHE_TTL) \
+    if LLM_CACHE_ENABLED and LLM_CACHE_DISK_PATH else None
+register_gauge('llm_cache', llm_response_cache.stats)
+if llm_response_disk_cache is not None:
+    register_gauge('llm_cache.disk', llm_response_disk_cache.stats)
+
+
+def get_llm_cache_key(model_id, system_prompt, user_prompt, max_tokens):
+    content = json.dumps([model_id, system_prompt, user_prompt, max_tokens], ensure_ascii=False)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def invoke_llm_model(model_id, system_prompt, user_prompt, max_tokens=2048, with_response_stream=False,
+                     use_cache=True, priority=PRIORITY_INTERACTIVE, stage='other'):
+    """
+    Invoke a Bedrock model, non-stream responses are served from the LLM response cache when possible
+    :param use_cache: False to always call the model, e.g. for call sites that need a fresh answer
+    :param priority: scheduling priority of the call when the model is rate limited
+    :param stage: stage of the answer the latency and cost of the call are counted in, see LLM_STAGES
+    """
+    if with_response_stream or not use_cache or not llm_response_cache.enabled:
+        return invoke_llm_model_uncached(model_id, system_prompt, user_prompt, max_tokens, with_response_stream,
+                                         priority, stage)
+    key = get_llm_cache_key(model_id, system_prompt, user_prompt, max_tokens)
+    response = llm_response_cache.get(key)
+    if response is None and llm_response_disk_cache is not None:
+        response = llm_response_disk_cache.get(key)
+        if response is not None:
+            llm_response_cache.put(key, response)
+    if response is not None:
+        incr('llm_cache.hit')
+        return response
+    incr('llm_cache.miss')
+    response, response_model_id = invoke_with_fallback(model_id, system_prompt, user_prompt, max_tokens,
+                                                       estimate_tokens(system_prompt, user_prompt) + max_tokens,
+                                                       priority, stage)
+    # failed invocations return an empty or non-text response, which must not be cached, nor the response of a
+    # fallback model under the key of model_id
+    if isinstance(response, str) and response and response_model_id == model_id:
+        llm_response_cache.put(key, response)
+        if llm_response_disk_cache is not None:
+            llm_response_disk_cache.put(key, response)
+    return response
+
+
+def choose_model(model_id, reserved_tokens, priority, stage):
+    """
+    Use the fallback model of model_id when the queue of model_id is longer than LLM_FALLBACK_WAIT_SECONDS
+    """
+    fallback_model_id = get_fallback_model(model_id)
+    if fallback_model_id is not None and \
+            get_rate_limiter(model_id).expected_wait(reserved_tokens, priority) > LLM_FALLBACK_WAIT_SECONDS:
+        incr(f'llm_routing.{stage}.fallback')
+        logger.info(f"{model_id} is saturated, {stage} uses {fallback_model_id}")
+        return fallback_model_id
+    return model_id
+
+
+def invoke_llm_model_uncached(model_id, system_prompt, user_prompt, max_tokens=2048, with_response_stream=False,
+                              priority=PRIORITY_INTERACTIVE, stage='other'):
+    """
+    Invoke a Bedrock model through its scheduler. A non-stream call falls back to the fallback model of model_id
+    when model_id is saturated or throttled, a stream is always read with the parser of model_id.
+    """
+    # the output tokens are reserved up to max_tokens, the unused ones are given back once the response is known
+    reserved_tokens = estimate_tokens(system_prompt, user_prompt) + max_tokens
+    if with_response_stream:
+        response, throttled = invoke_scheduled_model(model_id, system_prompt, user_prompt, max_tokens,
+                                                     reserved_tokens, priority, stage, with_response_stream=True)
+        return response
+    response, response_model_id = invoke_with_fallback(model_id, system_prompt, user_prompt, max_tokens,
+                                                       reserved_tokens, priority, stage)
+    return response
+
+
+def invoke_with_fallback(model_id, system_prompt, user_prompt, max_tokens, reserved_tokens, priority, stage):
+    """
+    :return: the response and the model that generated it
+    """
+    chosen_model_id = choose_model(model_id, reserved_tokens, priority, stage)
+    response, throttled = invoke_scheduled_model(chosen_model_id, system_prompt, user_prompt, max_tokens,
+                                                 reserved_tokens, priority, stage)
+    fallback_model_id = get_fallback_model(model_id) if chosen_model_id == model_id else None
+    if throttled and fallback_model_id is not None:
+        incr(f'llm_routing.{stage}.fallback')
+        logger.info(f"{model_id} is throttled, {stage} uses {fallback_model_id}")
+        response, throttled = invoke_scheduled_model(fallback_model_id, system_prompt, user_prompt, max_tokens,
+                                                     reserved_tokens, priority, stage)
+        chosen_model_id = fallback_model_id
+    return response, chosen_model_id
+
+
+def invoke_scheduled_model(model_id, system_prompt, user_prompt, max_tokens, reserved_tokens, priority, stage,
+                           with_response_stream=False):
+    """
+    :return: the response, "" if the call failed, and whether the model was throttled
+    """
     # Prompt with user turn only.
     user_message = {"role": "user", "content": user_prompt}
     messages = [user_message]
     logger.info(f'{system_prompt=}')
     logger.info(f'{messages=}')
     response = ""
+    rate_limiter = get_rate_limiter(model_id)
+    try:
+        rate_limiter.acquire(reserved_tokens, priority)
+    except RateLimitExceeded as e:
+        logger.warning(f"invoke_llm_model skipped {model_id}: {e}")
+        return response, True
+    start_time = time.perf_counter()
+    input_tokens = estimate_tokens(system_prompt, user_prompt)
+    # the reserved tokens the call did not use are given back once its usage is known, a failed call gives back
+    # its output tokens
+    unused_tokens = reserved_tokens - input_tokens
     try:
         if model_id.startswith('anthropic.claude-3'):
             response = invoke_model_claude3(model_id, system_prompt, messages, max_tokens, with_response_stream)
@@ -264,27 +397,167 @@ def invoke_llm_model(model_id, system_prompt, user_prompt, max_tokens=2048, with
         elif model_id.startswith('meta.llama3-70b'):
             response = invoke_llama_70b(model_id, system_prompt, user_prompt, max_tokens, with_response_stream)
         if with_response_stream:
-            return response
+            if response:
+                # the usage of a stream is only known once it is consumed, the stream gives back the tokens then
+                response['body'] = meter_response_stream(model_id, response['body'], rate_limiter,
+                                                         reserved_tokens, input_tokens, stage, start_time)
+                unused_tokens = 0
+            return response, False
         else:
             if model_id.startswith('meta.llama3-70b'):
-                return response["generation"]
+                final_response = response["generation"]
             else:
                 final_response = response.get("content")[0].get("text")
-                return final_response
+            output_tokens = estimate_tokens(final_response)
+            if isinstance(response, dict) and 'usage' in response:
+                input_tokens = response['usage'].get('input_tokens', input_tokens)
+                output_tokens = response['usage'].get('output_tokens', output_tokens)
+            unused_tokens = reserved_tokens - input_tokens - output_tokens
+            record_model_call(stage, model_id, time.perf_counter() - start_time, input_tokens, output_tokens)
+            return final_response, False
     except Exception as e:
         logger.error("invoke_llm_model error {}".format(e))
-    return response
+        if isinstance(e, ClientError) and e.response['Error']['Code'] == 'ThrottlingException':
+            # the buckets are drained, nothing is given back
+            unused_tokens = 0
+            rate_limiter.throttled()
+            return "", True
+    finally:
+        rate_limiter.release(unused_tokens)
+    return response, False
+
+
+def meter_response_stream(model_id, events, rate_limiter, reserved_tokens, input_tokens, stage, start_time):
+    """
+    Pass the events of a Bedrock response stream through, and give back the reserved tokens the call did not use
+    once the stream is consumed, closed or failed. The usage is read from the invocation metrics of the last
+    event, and estimated from the text of the response otherwise.
+    """
+    pieces = []
+    metrics = None
+    try:
+        for event in events:
+            chunk = json.loads(event['chunk']['bytes'].decode('utf8'))
+            pieces.append(get_stream_chunk_text(model_id, chunk))
+            metrics = chunk.get('amazon-bedrock-invocationMetrics', metrics)
+            yield event
+    finally:
+        output_tokens = estimate_tokens(*pieces)
+        if metrics is not None:
+            input_tokens = metrics.get('inputTokenCount', input_tokens)
+            output_tokens = metrics.get('outputTokenCount', output_tokens)
+        rate_limiter.release(reserved_tokens - input_tokens - output_tokens)
+        record_model_call(stage, model_id, time.perf_counter() - start_time, input_tokens, output_tokens)
+
+
+def get_stream_chunk_text(model_id, chunk):
+    """
+    Text of a chunk of a Bedrock response stream, "" for the chunks without text
+    """
+    if model_id.startswith('anthropic.claude-3'):
+        if chunk.get('type') == 'content_block_delta':
+            return chunk['delta'].get('text', '')
+    elif model_id.startswith('meta.llama3-70b'):
+        return chunk.get('generation', '')
+    elif model_id.startswith('mistral.mixtral-8x7b'):
+        return ''.join(output.get('text', '') for output in chunk.get('outputs', []))
+    return ''
+
+
+def iter_response_stream_text(model_id, response):
+    """
+    Yield the text chunks of a Bedrock response stream
+    :param model_id:
+    :param response: response of invoke_model_with_response_stream
+    """
+    if not response:
+        return
+    for event in response['body']:
+        chunk = json.loads(event['chunk']['bytes'].decode('utf8'))
+        text = get_stream_chunk_text(model_id, chunk)
+        if text:
+            yield text
+
+
+def invoke_llm_model_stream(model_id, system_prompt, user_prompt, max_tokens=2048, use_cache=True,
+                            priority=PRIORITY_INTERACTIVE, stage='other'):
+    """
+    Invoke a Bedrock model and yield the text of the response as it is generated. A cached response is yielded
+    at once, and a completed response is stored in the LLM response cache.
+    """
+    use_cache = use_cache and llm_response_cache.enabled
+    key = get_llm_cache_key(model_id, system_prompt, user_prompt, max_tokens) if use_cache else None
+    if use_cache:
+        cached_response = llm_response_cache.get(key)
+        if cached_response is None and llm_response_disk_cache is not None:
+            cached_response = llm_response_disk_cache.get(key)
+        if cached_response is not None:
+            incr('llm_cache.hit')
+            yield cached_response
+            return
+        incr('llm_cache.miss')
+    response_model_id = choose_model(model_id, estimate_tokens(system_prompt, user_prompt) + max_tokens, priority,
+                                     stage)
+    # the stream gives back the tokens it did not use once it is consumed
+    response = invoke_llm_model_uncached(response_model_id, system_prompt, user_prompt, max_tokens,
+                                         with_response_stream=True, priority=priority, stage=stage)
+    pieces = []
+    for text in iter_response_stream_text(response_model_id, response):
+        pieces.append(text)
+        yield text
+    final_response = ''.join(pieces)
+    if use_cache and final_response and response_model_id == model_id:
+        llm_response_cache.put(key, final_response)
+        if llm_response_disk_cache is not None:
+            llm_response_disk_cache.put(key, final_response)
 
 
 def text_to_sql(ddl, hints, prompt_map, search_box, sql_examples=None, ner_example=None, model_id=None, dialect='mysql',
-                model_provider=None, with_response_stream=False):
+                model_provider=None, with_response_stream=False, profile_key=None):
+    """
+    :param profile_key: profile_key of the data profile, caches the static part of the prompt
+    """
+    # a raw response stream is parsed by the caller with the model it asked for
+    if not with_response_stream:
+        model_id = route_model('sql', model_id)
     user_prompt, system_prompt = generate_llm_prompt(ddl, hints, prompt_map, search_box, sql_examples, ner_example,
-                                                     model_id, dialect=dialect)
+                                                     model_id, dialect=dialect, profile_key=profile_key)
     max_tokens = 4096
-    response = invoke_llm_model(model_id, system_prompt, user_prompt, max_tokens, with_response_stream)
+    response = invoke_llm_model(model_id, system_prompt, user_prompt, max_tokens, with_response_stream, stage='sql')
     return response
 
 
+def text_to_sql_stream(ddl, hints, prompt_map, search_box, sql_examples=None, ner_example=None, model_id=None,
+                       dialect='mysql', model_provider=None, profile_key=None):
+    """
+    Same as text_to_sql, yielding the text of the response as it is generated
+    """
+    model_id = route_model('sql', model_id)
+    user_prompt, system_prompt = generate_llm_prompt(ddl, hints, prompt_map, search_box, sql_examples, ner_example,
+                                                     model_id, dialect=dialect, profile_key=profile_key)
+    max_tokens = 4096
+    return invoke_llm_model_stream(model_id, system_prompt, user_prompt, max_tokens, stage='sql')
+
+
+def rewrite_expensive_sql(ddl, prompt_map, search_box, sql, cost_overrun, model_id=None, dialect='mysql'):
+    """
+    Generate the SQL of a question again, asking for a cheaper query than the one over the cost budget
+    :param sql: SQL over the budget
+    :param cost_overrun: why the SQL is over the budget, e.g. its estimated rows
+    :return: response of the model, the SQL is extracted with get_generated_sql
+    """
+    model_id = route_model('sql', model_id)
+    rewrite_question = (f"{search_box}\n\nThe following SQL answers the question but is too expensive to run, "
+                        f"{cost_overrun}:\n{sql}\nWrite a cheaper SQL answering the same question, e.g. with "
+                        f"selective filters on the indexed or partition columns, aggregations instead of detail rows "
+                        f"and no join without a join condition.")
+    user_prompt, system_prompt = generate_llm_prompt(ddl, "", prompt_map, rewrite_question, model_id=model_id,
+                                                     dialect=dialect)
+    max_tokens = 4096
+    # a cached response would return the same expensive SQL
+    return invoke_llm_model(model_id, system_prompt, user_prompt, max_tokens, False, use_cache=False, stage='sql')
+
+
 def sagemaker_to_explain(endpoint_name: str, sql: str, with_response_stream=False):
     body = json.dumps({"query": generate_sagemaker_explain_prompt(sql),
                        "stream": with_response_stream, })
@@ -320,6 +593,7 @@ LIMIT 10;</query>'''
 
 def get_agent_cot_task(model_id, prompt_map, search_box, ddl, agent_cot_example=None):
     default_agent_cot_task = {"task_1": search_box}
+    model_id = route_model('agent', model_id)
     user_prompt, system_prompt = generate_agent_cot_system_prompt(ddl, prompt_map, search_box, model_id,
                                                                   agent_cot_example)
     try:
@@ -334,7 +608,7 @@ def get_agent_cot_task(model_id, prompt_map, search_box, ddl, agent_cot_example=
             return intent_result_dict
         else:
             max_tokens = 2048
-            final_response = invoke_llm_model(model_id, system_prompt, user_prompt, max_tokens, False)
+            final_response = invoke_llm_model(model_id, system_prompt, user_prompt, max_tokens, False, stage='agent')
             logger.info(f'{final_response=}')
             intent_result_dict = json_parse.parse(final_response)
             return intent_result_dict
@@ -344,13 +618,15 @@ def get_agent_cot_task(model_id, prompt_map, search_box, ddl, agent_cot_example=
 
 
 def data_analyse_tool(model_id, prompt_map, search_box, sql_data, search_type):
+    model_id = route_model('data_analyse', model_id)
     try:
         max_tokens = 2048
         if search_type == "agent":
             user_prompt, system_prompt = generate_agent_analyse_prompt(prompt_map, search_box, model_id, sql_data)
         else:
             user_prompt, system_prompt = generate_data_summary_prompt(prompt_map, search_box, model_id, sql_data)
-        final_response = invoke_llm_model(model_id, system_prompt, user_prompt, max_tokens, False)
+        final_response = invoke_llm_model(model_id, system_prompt, user_prompt, max_tokens, False,
+                                          priority=PRIORITY_NORMAL, stage='data_analyse')
         logger.info(f'{final_response=}')
         return final_response
     except Exception as e:
@@ -360,6 +636,7 @@ def data_analyse_tool(model_id, prompt_map, search_box, sql_data, search_type):
 
 def get_query_intent(model_id, search_box, prompt_map):
     default_intent = {"intent": "normal_search"}
+    model_id = route_model('intent', model_id)
     try:
         intent_endpoint = os.getenv("SAGEMAKER_ENDPOINT_INTENT")
         if intent_endpoint:
@@ -373,7 +650,7 @@ def get_query_intent(model_id, search_box, prompt_map):
         else:
             user_prompt, system_prompt = generate_intent_prompt(prompt_map, search_box, model_id)
             max_tokens = 2048
-            final_response = invoke_llm_model(model_id, system_prompt, user_prompt, max_tokens, False)
+            final_response = invoke_llm_model(model_id, system_prompt, user_prompt, max_tokens, False, stage='intent')
             logger.info(f'{final_response=}')
             intent_result_dict = json_parse.parse(final_response)
             return intent_result_dict
@@ -384,6 +661,7 @@ def get_query_intent(model_id, search_box, prompt_map):
 
 def get_query_rewrite(model_id, search_box, prompt_map, chat_history):
     query_rewrite = {"query_rewrite": search_box}
+    model_id = route_model('query_rewrite', model_id)
     history_query = ""
     for item in chat_history:
         history_query = history_query + "user : " + item + "\n"
@@ -400,7 +678,8 @@ def get_query_rewrite(model_id, search_box, prompt_map, chat_history):
         else:
             user_prompt, system_prompt = generate_query_rewrite_prompt(prompt_map, search_box, model_id, history_query)
             max_tokens = 2048
-            final_response = invoke_llm_model(model_id, system_prompt, user_prompt, max_tokens, False)
+            final_response = invoke_llm_model(model_id, system_prompt, user_prompt, max_tokens, False,
+                                              stage='query_rewrite')
             logger.info(f'{final_response=}')
             return final_response
     except Exception as e:
@@ -409,25 +688,28 @@ def get_query_rewrite(model_id, search_box, prompt_map, chat_history):
 
 
 def knowledge_search(model_id, search_box, prompt_map):
+    model_id = route_model('knowledge', model_id)
     try:
         user_prompt, system_prompt = generate_knowledge_prompt(prompt_map, search_box, model_id)
         max_tokens = 2048
-        final_response = invoke_llm_model(model_id, system_prompt, user_prompt, max_tokens, False)
+        final_response = invoke_llm_model(model_id, system_prompt, user_prompt, max_tokens, False, stage='knowledge')
         return final_response
     except Exception as e:
         logger.error("knowledge_search is error")
     return ""
 
 
-def select_data_visualization_type(model_id, search_box, search_data, prompt_map):
+def select_data_visualization_type(model_id, search_box, search_data, prompt_map, priority=PRIORITY_NORMAL):
     default_data_visualization = {
         "show_type": "table",
         "format_data": []
     }
+    model_id = route_model('visualization', model_id)
     try:
         user_prompt, system_prompt = generate_data_visualization_prompt(prompt_map, search_box, search_data, model_id)
         max_tokens = 2048
-        final_response = invoke_llm_model(model_id, system_prompt, user_prompt, max_tokens, False)
+        final_response = invoke_llm_model(model_id, system_prompt, user_prompt, max_tokens, False, priority=priority,
+                                          stage='visualization')
         data_visualization_dict = json_parse.parse(final_response)
         return data_visualization_dict
     except Exception as e:
@@ -435,21 +717,63 @@ def select_data_visualization_type(model_id, search_box, search_data, prompt_map
         return default_data_visualization
 
 
-def data_visualization(model_id, search_box, search_data, prompt_map):
+def select_chart_type(model_id, search_box, search_data, search_data_sample, prompt_map):
+    """
+    Choose the chart type with the rule based classifier, and with the model only for ambiguous result shapes
+    """
+    model_select_type_dict = classify_chart_type(search_box, search_data) if VISUALIZATION_FAST_PATH else None
+    if model_select_type_dict is None:
+        incr('visualization.llm')
+        return select_data_visualization_type(model_id, search_box, search_data_sample, prompt_map)
+    incr('visualization.fast_path')
+    if VISUALIZATION_SHADOW_RATE > 0 and random.random() < VISUALIZATION_SHADOW_RATE:
+        # compare with the model in the background to measure the agreement of the classifier
+        submit("llm", compare_chart_type_with_model, model_id, search_box, search_data_sample, prompt_map,
+               model_select_type_dict['show_type'])
+    return model_select_type_dict
+
+
+def compare_chart_type_with_model(model_id, search_box, search_data_sample, prompt_map, show_type):
+    model_select_type_dict = select_data_visualization_type(model_id, search_box, search_data_sample, prompt_map,
+                                                            priority=PRIORITY_OPTIONAL)
+    if model_select_type_dict.get('show_type') == show_type:
+        incr('visualization.shadow_agree')
+    else:
+        incr('visualization.shadow_disagree')
+        logger.info(f"Chart type {show_type} differs from the model choice {model_select_type_dict.get('show_type')} "
+                    f"for {search_box!r}")
+
+
+def get_visualization_stats():
+    fast_path = get_counter('visualization.fast_path')
+    total = fast_path + get_counter('visualization.llm')
+    agree = get_counter('visualization.shadow_agree')
+    compared = agree + get_counter('visualization.shadow_disagree')
+    return {
+        'fast_path_rate': fast_path / total if total else 0.0,
+        'shadow_agreement': agree / compared if compared else None,
+    }
+
+
+register_gauge('visualization', get_visualization_stats)
+
+
+def data_visualization(model_id, search_box, search_data, prompt_map, with_rows=True):
+    """
+    :param with_rows: False to return only the column names as the table data, when the rows are sent in a
+    columnar format
+    """
     search_data = search_data.fillna("")
     columns = list(search_data.columns)
-    data_list = search_data.values.tolist()
-    all_columns_data = [columns] + data_list
+    all_columns_data = [columns] + search_data.values.tolist() if with_rows else [columns]
     try:
         if len(all_columns_data) < 1:
             return "table", all_columns_data, "-1", []
         else:
-            if len(all_columns_data) > 10:
-                all_columns_data_sample = all_columns_data[0:5]
-            else:
-                all_columns_data_sample = all_columns_data
-            model_select_type_dict = select_data_visualization_type(model_id, search_box, all_columns_data_sample,
-                                                                    prompt_map)
+            sample_rows = 4 if len(search_data) > 9 else len(search_data)
+            all_columns_data_sample = [columns] + search_data.head(sample_rows).values.tolist()
+            model_select_type_dict = select_chart_type(model_id, search_box, search_data, all_columns_data_sample,
+                                                       prompt_map)
             model_select_type = model_select_type_dict["show_type"]
             model_select_type_columns = model_select_type_dict["format_data"][0]
             data_list = search_data[model_select_type_columns].values.tolist()
@@ -473,7 +797,45 @@ def data_visualization(model_id, search_box, search_data, prompt_map):
         return "table", all_columns_data, "-1", []
 
 
-def create_vector_embedding_with_bedrock(text, index_name):
+def get_embedding_size(vector):
+    if isinstance(vector, array):
+        return sys.getsizeof(vector)
+    # list of python float objects
+    return sys.getsizeof(vector) + len(vector) * sys.getsizeof(0.0)
+
+
+embedding_cache = LRUCache(EMBEDDING_CACHE_SIZE, ttl=EMBEDDING_CACHE_TTL, size_of=get_embedding_size)
+register_gauge('embedding_cache', embedding_cache.stats)
+
+
+def normalize_embedding_text(text):
+    return " ".join(unicodedata.normalize("NFKC", str(text)).split())
+
+
+def to_cache_vector(vector):
+    if EMBEDDING_CACHE_FLOAT32:
+        return array('f', vector)
+    return vector
+
+
+def from_cache_vector(vector):
+    return vector.tolist() if isinstance(vector, array) else list(vector)
+
+
+def get_cached_embedding(model_id, text, compute):
+    """
+    Get the embedding of a text from the process-wide cache, keyed by (model id, normalized text)
+    :param model_id: embedding model id or endpoint name
+    :param text: text to embed
+    :param compute: function returning the embedding as a list of floats on a cache miss
+    :return: embedding as a list of floats
+    """
+    vector = embedding_cache.get_or_compute((model_id, normalize_embedding_text(text)),
+                                            lambda: to_cache_vector(compute()))
+    return from_cache_vector(vector)
+
+
+def invoke_bedrock_embedding(text):
     payload = {"inputText": f"{text}"}
     body = json.dumps(payload)
     modelId = BEDROCK_EMBEDDING_MODEL
@@ -485,29 +847,127 @@ def create_vector_embedding_with_bedrock(text, index_name):
     )
     response_body = json.loads(response.get("body").read())
 
-    embedding = response_body.get("embedding")
-    return {"_index": index_name, "text": text, "vector_field": embedding}
+    return response_body.get("embedding")
 
 
-def create_vector_embedding_with_sagemaker(endpoint_name, text, index_name):
+def invoke_sagemaker_embedding_batch(endpoint_name, texts):
+    """
+    Embed a list of sentences with one invocation of the BGE-M3 SageMaker endpoint
+    :return: list of dense vectors, in the order of texts
+    """
     model_kwargs = {}
     model_kwargs["batch_size"] = 12
     model_kwargs["max_length"] = 512
     model_kwargs["return_type"] = "dense"
-    body = json.dumps({"inputs": [text], **model_kwargs})
+    body = json.dumps({"inputs": list(texts), **model_kwargs})
     response = invoke_model_sagemaker_endpoint(endpoint_name, body)
+    incr('embedding.sagemaker_invocations')
+    observe('embedding.sagemaker_batch_size', len(texts))
     embeddings = response["sentence_embeddings"]
-    return {"_index": index_name, "text": text, "vector_field": embeddings["dense_vecs"][0]}
+    return embeddings["dense_vecs"]
+
+
+class EmbeddingMicroBatcher:
+    """
+    Collect the concurrent single-sentence embedding requests of a SageMaker endpoint during a short window and
+    send them as one batch invocation.
+    """
+
+    def __init__(self, endpoint_name, window_ms=EMBEDDING_BATCH_WINDOW_MS, max_batch_size=EMBEDDING_MAX_BATCH_SIZE,
+                 max_concurrency=EMBEDDING_BATCH_CONCURRENCY):
+        self.endpoint_name = endpoint_name
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.requests = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='genbi-embedding')
+        self.thread = threading.Thread(target=self.collect, name=f'embedding-batcher-{endpoint_name}', daemon=True)
+        self.thread.start()
+
+    def embed(self, text):
+        future = Future()
+        self.requests.put((text, future))
+        return future.result()
+
+    def collect(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.executor.submit(self.dispatch, batch)
+
+    def dispatch(self, batch):
+        try:
+            vectors = invoke_sagemaker_embedding_batch(self.endpoint_name, [text for text, future in batch])
+            if len(vectors) != len(batch):
+                raise ValueError(f"expected {len(batch)} embeddings, got {len(vectors)}")
+            for (text, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+        except Exception as e:
+            logger.error(f"embedding batch of {len(batch)} sentences failed: {e}")
+            for text, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+embedding_batchers = {}
+embedding_batchers_lock = threading.Lock()
+
+
+def get_embedding_batcher(endpoint_name):
+    batcher = embedding_batchers.get(endpoint_name)
+    if batcher is None:
+        with embedding_batchers_lock:
+            batcher = embedding_batchers.get(endpoint_name)
+            if batcher is None:
+                batcher = embedding_batchers[endpoint_name] = EmbeddingMicroBatcher(endpoint_name)
+    return batcher
+
+
+def invoke_sagemaker_embedding(endpoint_name, text):
+    if EMBEDDING_BATCH_WINDOW_MS > 0:
+        return get_embedding_batcher(endpoint_name).embed(text)
+    return invoke_sagemaker_embedding_batch(endpoint_name, [text])[0]
+
+
+def create_vector_embedding_with_bedrock(text, index_name):
+    embedding = get_cached_embedding(BEDROCK_EMBEDDING_MODEL, text, lambda: invoke_bedrock_embedding(text))
+    return {"_index": index_name, "text": text, "vector_field": embedding}
+
+
+def create_vector_embedding_with_sagemaker(endpoint_name, text, index_name):
+    embedding = get_cached_embedding(endpoint_name, text, lambda: invoke_sagemaker_embedding(endpoint_name, text))
+    return {"_index": index_name, "text": text, "vector_field": embedding}
+
+
+def create_vector_embeddings_with_sagemaker(endpoint_name, texts, index_name):
+    """
+    Embed a list of sentences, sentences missing from the embedding cache are sent in batches of
+    EMBEDDING_MAX_BATCH_SIZE
+    :return: list of records, in the order of texts
+    """
+    embeddings = [embedding_cache.get((endpoint_name, normalize_embedding_text(text))) for text in texts]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    for start in range(0, len(missing), EMBEDDING_MAX_BATCH_SIZE):
+        batch = missing[start:start + EMBEDDING_MAX_BATCH_SIZE]
+        vectors = invoke_sagemaker_embedding_batch(endpoint_name, [texts[i] for i in batch])
+        for i, vector in zip(batch, vectors):
+            embeddings[i] = to_cache_vector(vector)
+            embedding_cache.put((endpoint_name, normalize_embedding_text(texts[i])), embeddings[i])
+    return [{"_index": index_name, "text": text, "vector_field": from_cache_vector(embedding)}
+            for text, embedding in zip(texts, embeddings)]
 
 
 def generate_suggested_question(prompt_map, search_box, model_id=None):
     max_tokens = 2048
+    model_id = route_model('suggested_question', model_id)
     user_prompt, system_prompt = generate_suggest_question_prompt(prompt_map, search_box, model_id)
-    user_message = {"role": "user", "content": user_prompt}
-    messages = [user_message]
-    logger.info(f'{system_prompt=}')
-    logger.info(f'{messages=}')
-    response = invoke_model_claude3(model_id, system_prompt, messages, max_tokens)
-    final_response = response.get("content")[0].get("text")
-
-    return final_response
+    # suggestions are optional, they are dropped rather than delaying the answers when the model is saturated
+    return invoke_llm_model_uncached(model_id, system_prompt, user_prompt, max_tokens, priority=PRIORITY_OPTIONAL,
+                                     stage='suggested_question')
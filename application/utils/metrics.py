@@ -0,0 +1,81 @@
+import threading
+import time
+from collections import defaultdict
+
+# Process-wide counters and timing summaries, exposed by the /qa/metrics endpoint
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_timings = {}
+_gauges = {}
+
+
+def incr(name, value=1):
+    """
+    Increase a counter
+    :param name: metric name, dot separated
+    :param value: increment
+    """
+    with _lock:
+        _counters[name] += value
+
+
+def get_counter(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def observe(name, value):
+    """
+    Record one observation, e.g. a latency in seconds, in a count/sum/max summary
+    :param name: metric name, dot separated
+    :param value: observed value
+    """
+    with _lock:
+        summary = _timings.get(name)
+        if summary is None:
+            summary = _timings[name] = {'count': 0, 'sum': 0.0, 'max': 0.0}
+        summary['count'] += 1
+        summary['sum'] += value
+        summary['max'] = max(summary['max'], value)
+
+
+def register_gauge(name, func):
+    """
+    Register a callable evaluated when the metrics are read, e.g. the stats of a cache
+    :param name: metric name, dot separated
+    :param func: zero-argument callable returning a number or a dict
+    """
+    with _lock:
+        _gauges[name] = func
+
+
+class Timer:
+    """Context manager observing the elapsed seconds of its block"""
+
+    def __init__(self, name):
+        self.name = name
+        self.start_time = None
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.elapsed = time.perf_counter() - self.start_time
+        observe(self.name, self.elapsed)
+        return False
+
+
+def get_metrics():
+    with _lock:
+        counters = dict(_counters)
+        timings = {}
+        for name, summary in _timings.items():
+            timings[name] = dict(summary, avg=summary['sum'] / summary['count'] if summary['count'] else 0.0)
+        gauges = dict(_gauges)
+    return {
+        'counters': counters,
+        'timings': timings,
+        'gauges': {name: func() for name, func in gauges.items()},
+    }
@@ -0,0 +1,76 @@
+import logging
+
+from utils.env_var import LLM_STAGE_MODELS, LLM_FALLBACK_MODELS, LLM_MODEL_PRICES
+from utils.metrics import incr, observe, get_counter, register_gauge
+from utils.prompts.generate_prompt import support_model_ids_map
+
+logger = logging.getLogger(__name__)
+
+# Stages of an answer invoking a model, each can be routed to its own model with LLM_STAGE_MODELS
+LLM_STAGES = ('sql', 'intent', 'query_rewrite', 'knowledge', 'agent', 'data_analyse', 'visualization',
+              'suggested_question', 'other')
+
+# USD per 1000 input and output tokens on demand, overridden or extended by LLM_MODEL_PRICES
+default_model_prices = {
+    "anthropic.claude-3-haiku-20240307-v1:0": {"input": 0.00025, "output": 0.00125},
+    "anthropic.claude-3-sonnet-20240229-v1:0": {"input": 0.003, "output": 0.015},
+    "anthropic.claude-3-5-sonnet-20240620-v1:0": {"input": 0.003, "output": 0.015},
+    "mistral.mixtral-8x7b-instruct-v0:1": {"input": 0.00045, "output": 0.0007},
+    "meta.llama3-70b-instruct-v1:0": {"input": 0.00265, "output": 0.0035},
+}
+model_prices = dict(default_model_prices, **LLM_MODEL_PRICES)
+
+
+def route_model(stage, model_id):
+    """
+    Get the model of a stage, the model chosen by the user unless the routing table overrides it
+    :param stage: one of LLM_STAGES
+    :param model_id: model chosen by the user
+    :return: model id
+    """
+    routed_model_id = LLM_STAGE_MODELS.get(stage)
+    if not routed_model_id or routed_model_id == model_id:
+        return model_id
+    if routed_model_id not in support_model_ids_map:
+        logger.warning(f"Model {routed_model_id} of stage {stage} has no prompts, using {model_id}")
+        return model_id
+    return routed_model_id
+
+
+def get_fallback_model(model_id):
+    """
+    Get the model used when model_id is throttled or saturated. The prompt generated for model_id is sent as is,
+    so the fallback should be of the same model family.
+    """
+    return LLM_FALLBACK_MODELS.get(model_id)
+
+
+def record_model_call(stage, model_id, seconds, input_tokens, output_tokens):
+    """
+    Count the latency, tokens and estimated cost of a model call by stage
+    """
+    observe(f'llm_routing.{stage}.seconds', seconds)
+    incr(f'llm_routing.{stage}.calls')
+    incr(f'llm_routing.{stage}.{model_id}.calls')
+    incr(f'llm_routing.{stage}.input_tokens', input_tokens)
+    incr(f'llm_routing.{stage}.output_tokens', output_tokens)
+    prices = model_prices.get(model_id)
+    if prices is not None:
+        incr(f'llm_routing.{stage}.cost', (input_tokens * prices['input'] + output_tokens * prices['output']) / 1000)
+
+
+def get_model_routing_stats():
+    stats = {}
+    for stage in LLM_STAGES:
+        calls = get_counter(f'llm_routing.{stage}.calls')
+        if calls:
+            stats[stage] = {
+                'calls': calls,
+                'fallbacks': get_counter(f'llm_routing.{stage}.fallback'),
+                'cost': get_counter(f'llm_routing.{stage}.cost'),
+                'cost_per_call': get_counter(f'llm_routing.{stage}.cost') / calls,
+            }
+    return stats
+
+
+register_gauge('llm_routing', get_model_routing_stats)
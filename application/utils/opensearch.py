@@ -1,12 +1,55 @@
+import threading
+
 import boto3
 from opensearchpy import OpenSearch, RequestsHttpConnection
 from opensearchpy.helpers import bulk
 import logging
-from utils.llm import create_vector_embedding_with_bedrock, create_vector_embedding_with_sagemaker
-from utils.env_var import opensearch_info, SAGEMAKER_ENDPOINT_EMBEDDING
+from utils.cache import LRUCache
+from utils.llm import create_vector_embedding_with_bedrock, create_vector_embedding_with_sagemaker, \
+    create_vector_embeddings_with_sagemaker
+from utils.env_var import opensearch_info, SAGEMAKER_ENDPOINT_EMBEDDING, OPENSEARCH_POOL_MAXSIZE, OPENSEARCH_TIMEOUT, \
+    OPENSEARCH_ENDPOINT_CACHE_TTL
 
 logger = logging.getLogger(__name__)
 
+# OpenSearch clients are thread-safe and keep a pool of keep-alive connections, so one client is shared per
+# endpoint and credentials instead of paying the TLS handshake on every retrieval
+opensearch_clients = {}
+opensearch_clients_lock = threading.Lock()
+opensearch_endpoint_cache = LRUCache(128, ttl=OPENSEARCH_ENDPOINT_CACHE_TTL)
+
+
+def get_opensearch_client(host, port, opensearch_user, opensearch_password):
+    """
+    Get the shared OpenSearch client of an endpoint and credentials, creating it on first use
+    :param host:
+    :param port:
+    :param opensearch_user:
+    :param opensearch_password:
+    :return:
+    """
+    key = (host, str(port), opensearch_user, opensearch_password)
+    opensearch_client = opensearch_clients.get(key)
+    if opensearch_client is None:
+        with opensearch_clients_lock:
+            opensearch_client = opensearch_clients.get(key)
+            if opensearch_client is None:
+                logger.info(f"Creating OpenSearch client for {host}:{port}")
+                # Create the client with SSL/TLS enabled, but hostname verification disabled.
+                opensearch_client = OpenSearch(
+                    hosts=[{'host': host, 'port': port}],
+                    http_compress=True,  # enables gzip compression for request bodies
+                    http_auth=(opensearch_user, opensearch_password),
+                    use_ssl=True,
+                    verify_certs=False,
+                    ssl_assert_hostname=False,
+                    ssl_show_warn=False,
+                    pool_maxsize=OPENSEARCH_POOL_MAXSIZE,
+                    timeout=OPENSEARCH_TIMEOUT
+                )
+                opensearch_clients[key] = opensearch_client
+    return opensearch_client
+
 
 def get_opensearch_cluster_client(domain, host, port, opensearch_user, opensearch_password, region_name):
     """
@@ -19,35 +62,26 @@ def get_opensearch_cluster_client(domain, host, port, opensearch_user, opensearc
     :param region_name:
     :return:
     """
-    auth = (opensearch_user, opensearch_password)
     if len(host) == 0:
         host = get_opensearch_endpoint(domain, region_name)
-
-    # Create the client with SSL/TLS enabled, but hostname verification disabled.
-    opensearch_client = OpenSearch(
-        hosts=[{'host': host, 'port': port}],
-        http_compress=True,  # enables gzip compression for request bodies
-        http_auth=auth,
-        use_ssl=True,
-        verify_certs=False,
-        ssl_assert_hostname=False,
-        ssl_show_warn=False
-    )
-    return opensearch_client
+    return get_opensearch_client(host, port, opensearch_user, opensearch_password)
 
 
 def get_opensearch_endpoint(domain, region):
     """
-    Get OpenseSearch endpoint
+    Get OpenseSearch endpoint, the result is cached for OPENSEARCH_ENDPOINT_CACHE_TTL seconds
     :param domain:
     :param region:
     :return:
     """
-    client = boto3.client('es', region_name=region)
-    response = client.describe_elasticsearch_domain(
-        DomainName=domain
-    )
-    return response['DomainStatus']['Endpoint']
+    def describe_endpoint():
+        client = boto3.client('es', region_name=region)
+        response = client.describe_elasticsearch_domain(
+            DomainName=domain
+        )
+        return response['DomainStatus']['Endpoint']
+
+    return opensearch_endpoint_cache.get_or_compute((domain, region), describe_endpoint)
 
 
 def put_bulk_in_opensearch(list, client):
@@ -136,6 +170,34 @@ def delete_opensearch_index(opensearch_client, index_name):
         return True
 
 
+def get_query_embedding(query, index_name=''):
+    """
+    Get the embedding of a query with the model used by the retrieval indexes
+    :param query:
+    :param index_name:
+    :return: embedding vector
+    """
+    if SAGEMAKER_ENDPOINT_EMBEDDING is not None and SAGEMAKER_ENDPOINT_EMBEDDING != "":
+        records_with_embedding = create_vector_embedding_with_sagemaker(SAGEMAKER_ENDPOINT_EMBEDDING, query, index_name=index_name)
+    else:
+        records_with_embedding = create_vector_embedding_with_bedrock(query, index_name=index_name)
+    return records_with_embedding['vector_field']
+
+
+def get_query_embeddings(queries, index_name=''):
+    """
+    Get the embeddings of a list of queries, in batches with SageMaker, one by one with Bedrock
+    :return: list of embedding vectors, in the order of queries
+    """
+    if SAGEMAKER_ENDPOINT_EMBEDDING is not None and SAGEMAKER_ENDPOINT_EMBEDDING != "":
+        records_with_embedding = create_vector_embeddings_with_sagemaker(SAGEMAKER_ENDPOINT_EMBEDDING, queries,
+                                                                         index_name=index_name)
+    else:
+        records_with_embedding = [create_vector_embedding_with_bedrock(query, index_name=index_name)
+                                  for query in queries]
+    return [record['vector_field'] for record in records_with_embedding]
+
+
 def get_retrieve_opensearch(opensearch_info, query, search_type, selected_profile, top_k, score_threshold=0.7):
     if search_type == "query":
         index_name = opensearch_info['sql_index']
@@ -144,10 +206,7 @@ def get_retrieve_opensearch(opensearch_info, query, search_type, selected_profil
     else:
         index_name = opensearch_info['agent_index']
 
-    if SAGEMAKER_ENDPOINT_EMBEDDING is not None and SAGEMAKER_ENDPOINT_EMBEDDING != "":
-        records_with_embedding = create_vector_embedding_with_sagemaker(SAGEMAKER_ENDPOINT_EMBEDDING, query, index_name=index_name)
-    else:
-        records_with_embedding = create_vector_embedding_with_bedrock(query, index_name=index_name)
+    query_embedding = get_query_embedding(query, index_name=index_name)
     retrieve_result = retrieve_results_from_opensearch(
         index_name=index_name,
         region_name=opensearch_info['region'],
@@ -156,7 +215,7 @@ def get_retrieve_opensearch(opensearch_info, query, search_type, selected_profil
         opensearch_password=opensearch_info['password'],
         host=opensearch_info['host'],
         port=opensearch_info['port'],
-        query_embedding=records_with_embedding['vector_field'],
+        query_embedding=query_embedding,
         top_k=top_k,
         profile_name=selected_profile)
 
@@ -228,19 +287,8 @@ def opensearch_index_init():
     :return:
     """
     try:
-        auth = (opensearch_info["username"], opensearch_info["password"])
-        host = opensearch_info["host"]
-        port = opensearch_info["port"]
-        # Create the client with SSL/TLS enabled, but hostname verification disabled.
-        opensearch_client = OpenSearch(
-            hosts=[{'host': host, 'port': port}],
-            http_compress=True,  # enables gzip compression for request bodies
-            http_auth=auth,
-            use_ssl=True,
-            verify_certs=False,
-            ssl_assert_hostname=False,
-            ssl_show_warn=False
-        )
+        opensearch_client = get_opensearch_client(opensearch_info["host"], opensearch_info["port"],
+                                                  opensearch_info["username"], opensearch_info["password"])
         index_list = [opensearch_info['sql_index'], opensearch_info['ner_index'], opensearch_info['agent_index']]
         dimension = opensearch_info['embedding_dimension']
         index_create_success = True
@@ -2,7 +2,13 @@ from utils.prompt import POSTGRES_DIALECT_PROMPT_CLAUDE3, MYSQL_DIALECT_PROMPT_C
     DEFAULT_DIALECT_PROMPT, AGENT_COT_EXAMPLE, AWS_REDSHIFT_DIALECT_PROMPT_CLAUDE3, STARROCKS_DIALECT_PROMPT_CLAUDE3, CLICKHOUSE_DIALECT_PROMPT_CLAUDE3, BIGQUERY_DIALECT_PROMPT_CLAUDE3
 from utils.prompts import guidance_prompt
 from utils.prompts import table_prompt
+from utils.cache import LRUCache
+from utils.env_var import PROMPT_CACHE_SIZE
+from utils.metrics import register_gauge
 import logging
+import string
+import sys
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -1886,47 +1892,73 @@ table_prompt_mapper = table_prompt.TablePromptMapper()
 guidance_prompt_mapper = guidance_prompt.GuidancePromptMapper()
 
 
-def generate_llm_prompt(ddl, hints, prompt_map, search_box, sql_examples=None, ner_example=None, model_id=None,
-                        dialect='mysql'):
-    long_string = ""
+class PromptTemplate:
+    """
+    A str.format template split once into literal text and fields, with some fields bound in advance, so that
+    rendering only splices in the remaining fields
+    """
+
+    def __init__(self, template, **bound_values):
+        formatter = string.Formatter()
+        self.parts = []
+        literal = []
+        for literal_text, field_name, format_spec, conversion in formatter.parse(template):
+            literal.append(literal_text)
+            if field_name is None:
+                continue
+            if not field_name.isidentifier() or '{' in format_spec:
+                raise ValueError(f"unsupported field {field_name!r} in prompt template")
+            if field_name in bound_values:
+                value = formatter.convert_field(bound_values[field_name], conversion)
+                literal.append(formatter.format_field(value, format_spec))
+            else:
+                self.parts.append(''.join(literal))
+                literal = []
+                self.parts.append((field_name, conversion, format_spec))
+        self.parts.append(''.join(literal))
+
+    def render(self, **values):
+        formatter = string.Formatter()
+        return ''.join(part if isinstance(part, str) else
+                       formatter.format_field(formatter.convert_field(values[part[0]], part[1]), part[2])
+                       for part in self.parts)
+
+
+def generate_schema_prompt(ddl):
+    schema_parts = []
     for table_name, table_data in ddl.items():
         ddl_string = table_data["col_a"] if 'col_a' in table_data else table_data["ddl"]
-        long_string += "{}: {}\n".format(table_name, table_data["tbl_a"] if 'tbl_a' in table_data else table_data[
-            "description"])
-        long_string += ddl_string
-        long_string += "\n \n"
+        schema_parts.append("{}: {}\n".format(table_name, table_data["tbl_a"] if 'tbl_a' in table_data else table_data[
+            "description"]))
+        schema_parts.append(ddl_string)
+        schema_parts.append("\n \n")
+    return ''.join(schema_parts)
 
-    # trying CREATE TABLE ddl
-    # long_string = generate_create_table_ddl(long_string)
-    ddl = long_string
 
-    logger.info(f'{dialect=}')
+def get_dialect_prompt(dialect):
     if dialect == 'postgresql':
-        dialect_prompt = POSTGRES_DIALECT_PROMPT_CLAUDE3
+        return POSTGRES_DIALECT_PROMPT_CLAUDE3
     elif dialect == 'mysql':
-        dialect_prompt = MYSQL_DIALECT_PROMPT_CLAUDE3
+        return MYSQL_DIALECT_PROMPT_CLAUDE3
     elif dialect == 'redshift':
-        dialect_prompt = AWS_REDSHIFT_DIALECT_PROMPT_CLAUDE3
+        return AWS_REDSHIFT_DIALECT_PROMPT_CLAUDE3
     elif dialect == 'starrocks':
-        dialect_prompt = STARROCKS_DIALECT_PROMPT_CLAUDE3
+        return STARROCKS_DIALECT_PROMPT_CLAUDE3
     elif dialect == 'clickhouse':
-        dialect_prompt = CLICKHOUSE_DIALECT_PROMPT_CLAUDE3
+        return CLICKHOUSE_DIALECT_PROMPT_CLAUDE3
     elif dialect == 'bigquery':
-        dialect_prompt = BIGQUERY_DIALECT_PROMPT_CLAUDE3
+        return BIGQUERY_DIALECT_PROMPT_CLAUDE3
     else:
-        dialect_prompt = DEFAULT_DIALECT_PROMPT
+        return DEFAULT_DIALECT_PROMPT
 
-    example_sql_prompt = ""
-    example_ner_prompt = ""
-    if sql_examples:
-        for item in sql_examples:
-            example_sql_prompt += "Q: " + item['_source']['text'] + "\n"
-            example_sql_prompt += "A: ```sql\n" + item['_source']['sql'] + "```\n"
 
-    if ner_example:
-        for item in ner_example:
-            example_ner_prompt += "ner: " + item['_source']['entity'] + "\n"
-            example_ner_prompt += "ner info:" + item['_source']['comment'] + "\n"
+def generate_static_llm_prompt(ddl, prompt_map, model_id, dialect):
+    """
+    The part of the text-to-SQL prompt that does not depend on the question: the system prompt, and the user prompt
+    template with the schema, dialect and guidance bound
+    :return: system prompt, PromptTemplate of the user prompt, or the raw user template if it cannot be split
+    """
+    long_string = generate_schema_prompt(ddl)
 
     name = support_model_ids_map[model_id]
     system_prompt = prompt_map.get('text2sql', {}).get('system_prompt', {}).get(name)
@@ -1942,13 +1974,90 @@ def generate_llm_prompt(ddl, hints, prompt_map, search_box, sql_examples=None, n
     else:
         system_prompt = system_prompt.format(dialect=dialect)
 
-    user_prompt = user_prompt.format(dialect_prompt=dialect_prompt, sql_schema=table_prompt,
-                                     sql_guidance=guidance_prompt, examples=example_sql_prompt,
-                                     ner_info=example_ner_prompt, question=search_box)
+    bound_values = dict(dialect_prompt=get_dialect_prompt(dialect), sql_schema=table_prompt,
+                        sql_guidance=guidance_prompt)
+    try:
+        user_template = PromptTemplate(user_prompt, **bound_values)
+    except ValueError as e:
+        logger.warning(f"text2sql prompt of {name} is formatted on every call: {e}")
+        user_template = (user_prompt, bound_values)
+    return system_prompt, user_template
+
+
+# The static part of the text-to-SQL prompt per profile version, model and dialect. The version of a profile is
+# increased on every change of its tables or prompts, so an entry is never served for a changed profile.
+static_llm_prompt_cache = LRUCache(PROMPT_CACHE_SIZE, size_of=lambda value: sys.getsizeof(value[0]))
+register_gauge('prompt_cache', static_llm_prompt_cache.stats)
+
+
+def get_static_llm_prompt(ddl, prompt_map, model_id, dialect, profile_key=None):
+    """
+    :param profile_key: (profile name, profile version) of the profile ddl and prompt_map belong to, None to
+    assemble the prompt without caching it
+    """
+    if profile_key is None:
+        return generate_static_llm_prompt(ddl, prompt_map, model_id, dialect)
+    return static_llm_prompt_cache.get_or_compute((*profile_key, model_id, dialect),
+                                                  lambda: generate_static_llm_prompt(ddl, prompt_map, model_id,
+                                                                                     dialect))
+
+
+def generate_llm_prompt(ddl, hints, prompt_map, search_box, sql_examples=None, ner_example=None, model_id=None,
+                        dialect='mysql', profile_key=None):
+    logger.info(f'{dialect=}')
+    system_prompt, user_template = get_static_llm_prompt(ddl, prompt_map, model_id, dialect, profile_key)
+
+    example_sql_prompt = []
+    example_ner_prompt = []
+    if sql_examples:
+        for item in sql_examples:
+            example_sql_prompt.append("Q: " + item['_source']['text'] + "\n")
+            example_sql_prompt.append("A: ```sql\n" + item['_source']['sql'] + "```\n")
+
+    if ner_example:
+        for item in ner_example:
+            example_ner_prompt.append("ner: " + item['_source']['entity'] + "\n")
+            example_ner_prompt.append("ner info:" + item['_source']['comment'] + "\n")
+
+    request_values = dict(examples=''.join(example_sql_prompt), ner_info=''.join(example_ner_prompt),
+                          question=search_box)
+    if isinstance(user_template, PromptTemplate):
+        user_prompt = user_template.render(**request_values)
+    else:
+        user_prompt, bound_values = user_template
+        user_prompt = user_prompt.format(**bound_values, **request_values)
 
     return user_prompt, system_prompt
 
 
+def benchmark_generate_llm_prompt(table_count=500, column_count=30, iterations=200, model_id=None):
+    """
+    Compare the cached prompt assembly with the assembly from scratch on a synthetic schema
+    :return: dict with the average seconds per prompt of both
+    """
+    model_id = model_id or "anthropic.claude-3-sonnet-20240229-v1:0"
+    ddl = {}
+    for table_index in range(table_count):
+        columns = ",\n".join(f"  column_{column_index} VARCHAR(255) COMMENT 'column {column_index} of table "
+                              f"{table_index}'" for column_index in range(column_count))
+        ddl[f"table_{table_index}"] = {"description": f"table {table_index}",
+                                       "ddl": f"CREATE TABLE table_{table_index} (\n{columns}\n);"}
+    sql_examples = [{"_source": {"text": f"question {i}", "sql": f"SELECT * FROM table_{i}"}} for i in range(5)]
+    results = {'tables': table_count, 'schema_chars': len(generate_schema_prompt(ddl))}
+
+    start_time = time.perf_counter()
+    for i in range(iterations):
+        generate_llm_prompt(ddl, "", prompt_map_dict, f"question {i}", sql_examples, model_id=model_id)
+    results['uncached_seconds'] = (time.perf_counter() - start_time) / iterations
+
+    start_time = time.perf_counter()
+    for i in range(iterations):
+        generate_llm_prompt(ddl, "", prompt_map_dict, f"question {i}", sql_examples, model_id=model_id,
+                            profile_key=('benchmark', 0))
+    results['cached_seconds'] = (time.perf_counter() - start_time) / iterations
+    return results
+
+
 # TODO Must modify prompt
 def generate_sagemaker_intent_prompt(
         query: str,
@@ -2153,3 +2262,8 @@ def generate_suggest_question_prompt(prompt_map, search_box, model_id):
     user_prompt = user_prompt.format(question=search_box)
 
     return user_prompt, system_prompt
+
+
+if __name__ == '__main__':
+    # python -m utils.prompts.generate_prompt [table_count]
+    print(benchmark_generate_llm_prompt(int(sys.argv[1]) if len(sys.argv) > 1 else 500))
@@ -0,0 +1,225 @@
+import contextvars
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import sqlalchemy
+from sqlalchemy import event, text
+from sqlalchemy.pool import NullPool
+
+from utils.env_var import SQL_STATEMENT_TIMEOUT, SQL_STATEMENT_TIMEOUTS, SQL_CANCEL_GRACE_SECONDS
+from utils.metrics import incr
+
+logger = logging.getLogger(__name__)
+
+# Status of a generated query in the result of get_sql_result_tool and in the query log
+QUERY_STATUS_SUCCEEDED = 'succeeded'
+QUERY_STATUS_FAILED = 'failed'
+QUERY_STATUS_TIMEOUT = 'timeout'
+QUERY_STATUS_CANCELLED = 'cancelled'
+# rejected by the cost guard before it was executed
+QUERY_STATUS_REJECTED = 'rejected'
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+class QueryCancelled(Exception):
+    pass
+
+
+class QueryCancellation:
+    """
+    Cancellation token of the queries run to answer one question. Cancelling it, e.g. when the client cancels the
+    question or disconnects, cancels the statements still running on the database.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def register(self, callback):
+        """
+        Call callback when the token is cancelled, at once if it is already cancelled
+        """
+        with self.lock:
+            if not self.cancelled:
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def unregister(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def cancel(self):
+        """
+        Cancel the running statements, blocking while the databases are asked to cancel them
+        """
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f"Failed to cancel a query: {e}")
+
+
+# Cancellation token of the question being answered, propagated to the stage thread pools by utils.executor
+current_cancellation = contextvars.ContextVar('current_cancellation', default=None)
+
+
+def get_statement_timeout(db_type):
+    """
+    :param db_type: database type of the profile, e.g. redshift
+    :return: timeout in seconds, 0 for no timeout
+    """
+    return float(SQL_STATEMENT_TIMEOUTS.get(db_type, SQL_STATEMENT_TIMEOUT))
+
+
+def set_statement_timeout(connection, seconds):
+    """
+    Set the server-side timeout of the next statements of a connection
+    :return: SQL restoring the previous timeout, None if the dialect has no session timeout
+    """
+    dialect = connection.dialect.name
+    if dialect == 'mysql':
+        # only applies to SELECT statements, as are the generated queries
+        connection.execute(text(f"SET SESSION MAX_EXECUTION_TIME = {int(seconds * 1000)}"))
+        return "SET SESSION MAX_EXECUTION_TIME = DEFAULT"
+    if dialect == 'postgresql':
+        # PostgreSQL and Redshift
+        connection.execute(text(f"SET statement_timeout = {int(seconds * 1000)}"))
+        return "RESET statement_timeout"
+    if dialect == 'starrocks':
+        previous_timeout = connection.execute(text("SELECT @@query_timeout")).scalar()
+        connection.execute(text(f"SET query_timeout = {max(1, int(seconds))}"))
+        return f"SET query_timeout = {int(previous_timeout)}"
+    return None
+
+
+def add_statement_timeout_clause(connection, sql, seconds):
+    """
+    Add the timeout to the statement itself for the dialects without session variables, ClickHouse over HTTP
+    """
+    if connection.dialect.name != 'clickhouse' or re.search(r'\bSETTINGS\b', sql, re.IGNORECASE):
+        return sql
+    return f"{sql.strip().rstrip(';')}\nSETTINGS max_execution_time = {max(1, int(seconds))}"
+
+
+@contextmanager
+def statement_canceller(connection):
+    """
+    Get a function cancelling the running statement of a connection from another thread
+    :return: context manager of the function, None if the driver cannot cancel a statement, e.g. ClickHouse over
+    HTTP where the server-side timeout applies
+    """
+    dialect = connection.dialect.name
+    dbapi_connection = connection.connection.dbapi_connection
+    if dialect == 'postgresql':
+        yield dbapi_connection.cancel
+    elif dialect in ('mysql', 'starrocks'):
+        connection_id = int(dbapi_connection.thread_id())
+        url = connection.engine.url
+
+        def kill_query():
+            # a dedicated connection, the pool of the engine may be exhausted by the queries to cancel
+            kill_engine = sqlalchemy.create_engine(url, poolclass=NullPool)
+            try:
+                with kill_engine.connect() as kill_connection:
+                    kill_connection.execute(text(f"KILL QUERY {connection_id}"))
+            finally:
+                kill_engine.dispose()
+        yield kill_query
+    elif dialect == 'bigquery':
+        # the DB-API cursors of the statements are recorded to cancel their query jobs
+        cursors = []
+
+        def record_cursor(conn, cursor, statement, parameters, context, executemany):
+            cursors.append(cursor)
+
+        def cancel_jobs():
+            for cursor in list(cursors):
+                query_job = cursor.query_job
+                if query_job is not None and not query_job.done():
+                    query_job.cancel()
+
+        event.listen(connection, 'before_cursor_execute', record_cursor)
+        try:
+            yield cancel_jobs
+        finally:
+            event.remove(connection, 'before_cursor_execute', record_cursor)
+    elif dialect == 'sqlite':
+        yield dbapi_connection.interrupt
+    else:
+        yield None
+
+
+def restore_statement_timeout(connection, restore_sql):
+    if restore_sql is None or connection.invalidated:
+        return
+    try:
+        connection.execute(text(restore_sql))
+    except Exception as e:
+        # e.g. the transaction of a failed PostgreSQL statement is aborted, the session is dropped instead
+        logger.warning(f"Failed to restore the statement timeout: {e}")
+        connection.invalidate()
+
+
+@contextmanager
+def statement_guard(connection, timeout, cancellation=None):
+    """
+    Run the statements of a connection within a timeout and cancellable by a cancellation token. The timeout is
+    enforced by the database where it supports one, and by cancelling the statement SQL_CANCEL_GRACE_SECONDS later
+    otherwise. The connection is invalidated after a timeout or a cancel, its session may still be busy, and its
+    session timeout is restored after any other outcome.
+    :param connection: sqlalchemy Connection
+    :param timeout: seconds, 0 for no timeout
+    :param cancellation: QueryCancellation or None
+    :raise QueryTimeout: a statement ran longer than timeout
+    :raise QueryCancelled: the token was cancelled
+    """
+    if cancellation is not None and cancellation.cancelled:
+        raise QueryCancelled("query cancelled before it started")
+    with statement_canceller(connection) as cancel_statement:
+        restore_sql = set_statement_timeout(connection, timeout) if timeout > 0 else None
+        timed_out = threading.Event()
+        watchdog = None
+        if timeout > 0 and cancel_statement is not None:
+            def cancel_on_timeout():
+                timed_out.set()
+                cancel_statement()
+            watchdog = threading.Timer(timeout + SQL_CANCEL_GRACE_SECONDS, cancel_on_timeout)
+            watchdog.daemon = True
+            watchdog.start()
+        if cancellation is not None and cancel_statement is not None:
+            cancellation.register(cancel_statement)
+        start_time = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            elapsed = time.monotonic() - start_time
+            if cancellation is not None and cancellation.cancelled:
+                incr('sql.cancelled')
+                connection.invalidate()
+                raise QueryCancelled("query cancelled by the client") from e
+            if timed_out.is_set() or 0 < timeout <= elapsed:
+                incr('sql.timeout')
+                connection.invalidate()
+                raise QueryTimeout(f"query timed out after {elapsed:.1f} seconds, the timeout is {timeout} "
+                                   f"seconds") from e
+            raise
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            if cancellation is not None and cancel_statement is not None:
+                cancellation.unregister(cancel_statement)
+            restore_statement_timeout(connection, restore_sql)
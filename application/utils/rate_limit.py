@@ -0,0 +1,196 @@
+import heapq
+import itertools
+import threading
+import time
+
+from utils.env_var import LLM_RATE_LIMITS, LLM_DEFAULT_RPM, LLM_DEFAULT_TPM, LLM_QUEUE_TIMEOUT, LLM_SHED_WAIT_SECONDS
+from utils.metrics import incr, observe, register_gauge
+
+# Priorities of the model calls, lower first. Interactive calls are on the critical path of an answer, normal calls
+# post-process it, optional calls may be dropped when the model is saturated.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_OPTIONAL = 2
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+def estimate_tokens(*texts):
+    # rough estimate of 4 characters per token, the buckets only need the order of magnitude
+    return sum(len(text) for text in texts if text) // 4
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at a per-minute rate, holding at most one minute of tokens.
+    Not thread-safe, guarded by the lock of its ModelRateLimiter.
+    """
+
+    def __init__(self, rate_per_minute):
+        """
+        :param rate_per_minute: tokens added per minute, 0 for no limit
+        """
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60.0
+        self.available = float(rate_per_minute)
+        self.updated_at = time.monotonic()
+
+    @property
+    def unlimited(self):
+        return self.capacity <= 0
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount):
+        """
+        Seconds until amount tokens are available, a request larger than the bucket waits for a full bucket
+        """
+        if self.unlimited:
+            return 0.0
+        self.refill()
+        return max(0.0, (min(amount, self.capacity) - self.available) / self.rate)
+
+    def take(self, amount):
+        if not self.unlimited:
+            self.refill()
+            self.available -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        if not self.unlimited and amount > 0:
+            self.refill()
+            self.available = min(self.capacity, self.available + amount)
+
+    def drain(self):
+        if not self.unlimited:
+            self.refill()
+            self.available = min(self.available, 0.0)
+
+
+class ModelRateLimiter:
+    """
+    Client-side scheduler of the calls to one model, admitting them by priority within the requests per minute
+    and tokens per minute of the model. Optional calls are shed when the expected wait is too long.
+    """
+
+    def __init__(self, rpm=0, tpm=0):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+    @property
+    def unlimited(self):
+        return self.requests.unlimited and self.tokens.unlimited
+
+    def acquire(self, tokens, priority=PRIORITY_INTERACTIVE, timeout=LLM_QUEUE_TIMEOUT):
+        """
+        Wait until a call of tokens tokens can be sent to the model
+        :param tokens: estimated tokens of the call, input and max output
+        :param priority: PRIORITY_INTERACTIVE, PRIORITY_NORMAL or PRIORITY_OPTIONAL
+        :param timeout: max seconds waited in the queue
+        :raise RateLimitExceeded: the call was shed or waited longer than timeout
+        """
+        if self.unlimited:
+            return
+        start_time = time.monotonic()
+        with self.condition:
+            if priority >= PRIORITY_OPTIONAL and self.estimate_wait_locked(tokens, priority) > LLM_SHED_WAIT_SECONDS:
+                incr('llm_scheduler.shed')
+                raise RateLimitExceeded("model saturated, optional call shed")
+            ticket = (priority, next(self.sequence), tokens)
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    wait = None
+                    if self.waiting[0] is ticket:
+                        wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                        if wait <= 0:
+                            self.requests.take(1)
+                            self.tokens.take(tokens)
+                            break
+                    remaining = start_time + timeout - time.monotonic()
+                    if remaining <= 0:
+                        incr('llm_scheduler.timeout')
+                        raise RateLimitExceeded(f"waited more than {timeout} seconds for the model")
+                    self.condition.wait(min(wait, remaining) if wait is not None else remaining)
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+        observe('llm_scheduler.wait_seconds', time.monotonic() - start_time)
+
+    def expected_wait(self, tokens, priority=PRIORITY_INTERACTIVE):
+        """
+        Expected seconds a call would wait in the queue, behind the calls of the same or a higher priority
+        """
+        if self.unlimited:
+            return 0.0
+        with self.condition:
+            return self.estimate_wait_locked(tokens, priority)
+
+    def estimate_wait_locked(self, tokens, priority):
+        ahead = [ticket for ticket in self.waiting if ticket[0] <= priority]
+        return max(self.requests.wait_time(len(ahead) + 1),
+                   self.tokens.wait_time(sum(ticket[2] for ticket in ahead) + tokens))
+
+    def release(self, tokens):
+        """
+        Give back the reserved tokens a call did not use
+        """
+        if tokens > 0 and not self.unlimited:
+            with self.condition:
+                self.tokens.give_back(tokens)
+                self.condition.notify_all()
+
+    def throttled(self):
+        """
+        The model throttled a call despite the buckets, e.g. the quota is shared with other clients, so stop
+        admitting calls until the buckets refill
+        """
+        incr('llm_scheduler.throttled')
+        with self.condition:
+            self.requests.drain()
+            self.tokens.drain()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'queue_depth': len(self.waiting),
+                'requests_available': None if self.requests.unlimited else self.requests.available,
+                'tokens_available': None if self.tokens.unlimited else self.tokens.available,
+            }
+
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model_id):
+    """
+    Get the scheduler of a model, its limits are read from LLM_RATE_LIMITS or the LLM_DEFAULT_RPM/TPM defaults
+    """
+    rate_limiter = rate_limiters.get(model_id)
+    if rate_limiter is None:
+        with rate_limiters_lock:
+            rate_limiter = rate_limiters.get(model_id)
+            if rate_limiter is None:
+                limits = LLM_RATE_LIMITS.get(model_id, {})
+                rate_limiter = ModelRateLimiter(rpm=limits.get('rpm', LLM_DEFAULT_RPM),
+                                                tpm=limits.get('tpm', LLM_DEFAULT_TPM))
+                rate_limiters[model_id] = rate_limiter
+    return rate_limiter
+
+
+def get_rate_limiter_stats():
+    with rate_limiters_lock:
+        items = list(rate_limiters.items())
+    return {model_id: rate_limiter.stats() for model_id, rate_limiter in items if not rate_limiter.unlimited}
+
+
+register_gauge('llm_scheduler', get_rate_limiter_stats)
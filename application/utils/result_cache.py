@@ -0,0 +1,117 @@
+import hashlib
+import logging
+
+import sqlparse
+
+from utils.cache import LRUCache
+from utils.env_var import RESULT_CACHE_SIZE, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_MAX_ENTRY_BYTES
+from utils.metrics import incr, register_gauge
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_sql(sql):
+    """
+    Canonical form of a query for the cache key: no comments, upper case keywords, collapsed whitespace.
+    Identifiers and literals are kept as is, they may be case-sensitive.
+    """
+    return sqlparse.format(sql, strip_comments=True, keyword_case='upper', strip_whitespace=True).strip().rstrip(';') \
+        .strip()
+
+
+def get_connection_hash(connection_key):
+    # the connection key is a DB URL with its password, only its hash is kept
+    return hashlib.sha256(connection_key.encode('utf-8')).hexdigest()
+
+
+def get_result_cache_key(connection_key, sql, max_rows):
+    return (get_connection_hash(connection_key), max_rows,
+            hashlib.sha256(normalize_sql(sql).encode('utf-8')).hexdigest())
+
+
+def serialize_dataframe(result_df):
+    """
+    Serialize a result as a compressed Arrow IPC stream, or keep the DataFrame itself without pyarrow
+    """
+    if pa is None:
+        return result_df.copy()
+    table = pa.Table.from_pandas(result_df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    try:
+        options = pa.ipc.IpcWriteOptions(compression='zstd')
+    except (pa.ArrowException, ValueError):
+        options = None
+    with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def deserialize_dataframe(payload):
+    if isinstance(payload, bytes):
+        return pa.ipc.open_stream(payload).read_pandas()
+    return payload.copy()
+
+
+def get_payload_size(payload):
+    if isinstance(payload, bytes):
+        return len(payload)
+    return int(payload.memory_usage(index=True, deep=True).sum())
+
+
+def get_cached_result_size(value):
+    return get_payload_size(value[0])
+
+
+# Results of the generated queries by connection, normalized SQL and row limit, each entry expires after the
+# result cache TTL of its profile
+query_result_cache = LRUCache(RESULT_CACHE_SIZE, max_bytes=RESULT_CACHE_MAX_BYTES, size_of=get_cached_result_size)
+register_gauge('result_cache', query_result_cache.stats)
+
+
+def get_cached_result(connection_key, sql, max_rows):
+    """
+    :return: dict with data, truncated and total_count in the format of fetch_query_result, None on a miss
+    """
+    if not query_result_cache.enabled:
+        return None
+    value = query_result_cache.get(get_result_cache_key(connection_key, sql, max_rows))
+    if value is None:
+        return None
+    payload, truncated, total_count = value
+    return {"data": deserialize_dataframe(payload), "truncated": truncated, "total_count": total_count}
+
+
+def put_cached_result(connection_key, sql, max_rows, result, ttl):
+    """
+    Cache a query result for ttl seconds, unless its serialized size is above RESULT_CACHE_MAX_ENTRY_BYTES
+    """
+    if not query_result_cache.enabled:
+        return
+    try:
+        payload = serialize_dataframe(result["data"])
+    except Exception as e:
+        # e.g. object columns mixing types Arrow cannot convert
+        logger.info(f"Query result not cached: {e}")
+        return
+    if get_payload_size(payload) > RESULT_CACHE_MAX_ENTRY_BYTES:
+        incr('result_cache.too_large')
+        return
+    query_result_cache.put(get_result_cache_key(connection_key, sql, max_rows),
+                           (payload, result["truncated"], result["total_count"]), ttl=ttl)
+
+
+def invalidate_connection_results(connection_key):
+    """
+    Drop the cached results of a connection, e.g. after its data was reloaded or the connection changed
+    """
+    connection_hash = get_connection_hash(connection_key)
+    query_result_cache.invalidate_where(lambda key: key[0] == connection_hash)
+
+
+def invalidate_query_result(connection_key, sql, max_rows):
+    query_result_cache.invalidate(get_result_cache_key(connection_key, sql, max_rows))
@@ -0,0 +1,95 @@
+import base64
+import logging
+
+import numpy as np
+import pandas as pd
+
+from utils.visualization import is_numeric_column
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+# Wire formats of the query results in the answers. 'rows' is the list of rows in sql_data, the others fill
+# sql_data_columnar and leave only the column names in sql_data.
+RESULT_FORMAT_ROWS = 'rows'
+RESULT_FORMAT_COLUMNAR = 'columnar'
+RESULT_FORMAT_ARROW = 'arrow'
+RESULT_FORMATS = (RESULT_FORMAT_ROWS, RESULT_FORMAT_COLUMNAR, RESULT_FORMAT_ARROW)
+
+
+def encode_typed_array(values, dtype):
+    # little-endian buffers, read by the client with the typed array of the same dtype, e.g. Float64Array
+    return {"dtype": dtype, "encoding": "base64",
+            "values": base64.b64encode(np.ascontiguousarray(values, dtype=f'<{np.dtype(dtype).str[1:]}')
+                                       .tobytes()).decode('ascii')}
+
+
+def encode_column(series):
+    """
+    Encode a column as a typed array when it is numeric, boolean or a timestamp, else as a JSON list
+    """
+    if pd.api.types.is_bool_dtype(series):
+        column = encode_typed_array(series.to_numpy(dtype=np.uint8), 'uint8')
+        column["dtype"] = "bool"
+    elif pd.api.types.is_integer_dtype(series) and not series.isna().any():
+        column = encode_typed_array(series.to_numpy(dtype=np.int64), 'int64')
+    elif pd.api.types.is_datetime64_any_dtype(series):
+        if getattr(series.dt, 'tz', None) is not None:
+            series = series.dt.tz_convert('UTC').dt.tz_localize(None)
+        timestamps = series.to_numpy(dtype='datetime64[ns]')
+        milliseconds = np.where(np.isnat(timestamps), np.nan, timestamps.astype(np.int64) / 1e6)
+        column = encode_typed_array(milliseconds, 'float64')
+        column["dtype"] = "timestamp_ms"
+    elif pd.api.types.is_numeric_dtype(series) or is_numeric_column(series):
+        # e.g. DECIMAL columns are returned as objects, missing values become NaN
+        column = encode_typed_array(pd.to_numeric(series, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan),
+                                    'float64')
+    else:
+        values = [value if value is None or isinstance(value, (str, int, float, bool)) else str(value)
+                  for value in series.astype(object).where(series.notna(), None)]
+        column = {"dtype": "object", "encoding": "json", "values": values}
+    column["name"] = str(series.name)
+    return column
+
+
+def encode_columnar(result_df):
+    return {
+        "format": RESULT_FORMAT_COLUMNAR,
+        "row_count": len(result_df),
+        "columns": [encode_column(result_df.iloc[:, index]) for index in range(result_df.shape[1])],
+    }
+
+
+def encode_arrow(result_df):
+    table = pa.Table.from_pandas(result_df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return {
+        "format": RESULT_FORMAT_ARROW,
+        "row_count": len(result_df),
+        "encoding": "base64",
+        "data": base64.b64encode(sink.getvalue().to_pybytes()).decode('ascii'),
+    }
+
+
+def encode_result(result_df, result_format):
+    """
+    Encode a query result in a columnar wire format, once and without a Python object per numeric cell
+    :param result_df: query result DataFrame
+    :param result_format: RESULT_FORMAT_COLUMNAR or RESULT_FORMAT_ARROW, Arrow IPC needs pyarrow and falls back
+    to the columnar JSON format without it or for columns Arrow cannot convert
+    :return: dict, None for RESULT_FORMAT_ROWS
+    """
+    if result_format == RESULT_FORMAT_ROWS or result_df is None:
+        return None
+    if result_format == RESULT_FORMAT_ARROW and pa is not None:
+        try:
+            return encode_arrow(result_df)
+        except (pa.ArrowException, ValueError, TypeError) as e:
+            logger.warning(f"Arrow encoding failed, using the columnar format: {e}")
+    return encode_columnar(result_df)
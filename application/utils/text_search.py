@@ -1,17 +1,275 @@
+import asyncio
+import functools
 import logging
+import time
 
 from nlq.business.connection import ConnectionManagement
 from utils.domain import SearchTextSqlResult
-from utils.llm import text_to_sql
+from utils.apis import get_sql_result_tool
+from utils.env_var import RETRIEVAL_TIMEOUT, SPECULATIVE_TIMEOUT
+from utils.executor import gather, gather_blocking, submit, run_blocking
+from utils.llm import text_to_sql, text_to_sql_stream
+from utils.metrics import incr, observe, register_gauge, get_counter
 from utils.opensearch import get_retrieve_opensearch
-from utils.tool import get_generated_sql
+from utils.query_control import QueryCancellation, current_cancellation
+from utils.tool import get_generated_sql, GeneratedSQLStreamParser
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
+def timed_call(func, *args, **kwargs):
+    result = func(*args, **kwargs)
+    return result, time.perf_counter()
+
+
+class SpeculativeSearch:
+    """
+    Start the query few-shot retrieval, and optionally the SQL generation, of a normal search while the intent
+    is still being classified. The work is consumed by normal_text_search, or discarded for any other intent.
+    The speculative futures are only waited for by the caller or the event loop, never from a worker of the pool
+    running them, and are replaced by a fresh call when they fail or take longer than SPECULATIVE_TIMEOUT.
+    """
+
+    def __init__(self, search_box, model_type, database_profile, opensearch_info, selected_profile, use_rag,
+                 with_sql=False, model_provider=None):
+        self.start_time = time.perf_counter()
+        self.time_saved = 0.0
+        self.search_box = search_box
+        self.opensearch_info = opensearch_info
+        self.selected_profile = selected_profile
+        self.retrieve_future = None
+        self.response_future = None
+        if use_rag:
+            self.retrieve_future = submit("retrieval", timed_call, get_retrieve_opensearch, opensearch_info,
+                                          search_box, "query", selected_profile, 3, 0.5)
+        if with_sql:
+            self.response_future = submit("llm", timed_call, self.speculative_text_to_sql, search_box,
+                                          model_type, database_profile, model_provider)
+
+    def speculative_text_to_sql(self, search_box, model_type, database_profile, model_provider):
+        # the intent slots are unknown yet, so the SQL is generated without NER examples. The retrieval runs in
+        # another pool, so waiting for it from the llm pool cannot deadlock.
+        sql_examples = []
+        if self.retrieve_future is not None:
+            try:
+                sql_examples = self.retrieve_future.result(timeout=SPECULATIVE_TIMEOUT)[0] or []
+            except Exception as e:
+                logger.warning(f"Speculative retrieval not used for the speculative SQL: {e!r}")
+        return text_to_sql(database_profile['tables_info'],
+                           database_profile['hints'],
+                           database_profile['prompt_map'],
+                           search_box,
+                           model_id=model_type,
+                           sql_examples=sql_examples,
+                           ner_example=[],
+                           dialect=database_profile['db_type'],
+                           model_provider=model_provider,
+                           profile_key=database_profile.get('profile_key'))
+
+    def record_time_saved(self, ready_time):
+        # the speculative work saved the time it ran before the result was actually needed
+        self.time_saved = max(self.time_saved, min(ready_time, time.perf_counter()) - self.start_time)
+
+    def consume(self, future):
+        """
+        Wait for a speculative result on the calling thread
+        :return: the result, None if it failed or timed out
+        """
+        try:
+            result, ready_time = future.result(timeout=SPECULATIVE_TIMEOUT)
+        except Exception as e:
+            future.cancel()
+            incr('speculation.error')
+            logger.warning(f"Speculative work not used: {e!r}")
+            return None
+        self.record_time_saved(ready_time)
+        return result
+
+    async def consume_async(self, future):
+        """
+        Same as consume, awaited on the event loop
+        """
+        try:
+            result, ready_time = await asyncio.wait_for(asyncio.wrap_future(future), timeout=SPECULATIVE_TIMEOUT)
+        except Exception as e:
+            future.cancel()
+            incr('speculation.error')
+            logger.warning(f"Speculative work not used: {e!r}")
+            return None
+        self.record_time_saved(ready_time)
+        return result
+
+    def retrieve(self):
+        return get_retrieve_opensearch(self.opensearch_info, self.search_box, "query", self.selected_profile, 3, 0.5)
+
+    def get_retrieve_result(self):
+        if self.retrieve_future is None:
+            return []
+        result = self.consume(self.retrieve_future)
+        if result is None:
+            result = self.retrieve()
+        return result or []
+
+    async def get_retrieve_result_async(self):
+        if self.retrieve_future is None:
+            return []
+        result = await self.consume_async(self.retrieve_future)
+        if result is None:
+            result = await run_blocking("retrieval", self.retrieve)
+        return result or []
+
+    def use_response(self, entity_slot_retrieve):
+        if self.response_future is None:
+            return False
+        if entity_slot_retrieve:
+            self.response_future.cancel()
+            incr('speculation.sql_miss')
+            return False
+        incr('speculation.sql_hit')
+        return True
+
+    def get_response(self, entity_slot_retrieve):
+        """
+        Get the speculative text-to-SQL response, only valid when no NER example was retrieved for the question
+        :return: the response, None to generate the SQL without speculation
+        """
+        if not self.use_response(entity_slot_retrieve):
+            return None
+        return self.consume(self.response_future)
+
+    async def get_response_async(self, entity_slot_retrieve):
+        if not self.use_response(entity_slot_retrieve):
+            return None
+        return await self.consume_async(self.response_future)
+
+    def commit(self):
+        incr('speculation.hit')
+        observe('speculation.time_saved_seconds', self.time_saved)
+
+    def discard(self):
+        for future in (self.retrieve_future, self.response_future):
+            if future is not None:
+                future.cancel()
+        incr('speculation.miss')
+
+
+def get_speculation_hit_rate():
+    hit = get_counter('speculation.hit')
+    total = hit + get_counter('speculation.miss')
+    return hit / total if total else 0.0
+
+
+register_gauge('speculation.hit_rate', get_speculation_hit_rate)
+
+
+def get_normal_retrieve_calls(opensearch_info, search_box, entity_slot, selected_profile, use_rag,
+                              speculative_search=None):
+    """
+    Build the independent retrievals of a normal search: one NER lookup per entity, then the query few-shot lookup
+    """
+    calls = []
+    if use_rag:
+        for each_entity in entity_slot:
+            calls.append(functools.partial(get_retrieve_opensearch, opensearch_info, each_entity, "ner",
+                                           selected_profile, 1, 0.7))
+        # the speculative query retrieval is awaited by the caller, not from the retrieval pool running it
+        if speculative_search is None:
+            calls.append(functools.partial(get_retrieve_opensearch, opensearch_info, search_box, "query",
+                                           selected_profile, 3, 0.5))
+    return calls
+
+
+def merge_normal_retrieve_results(results):
+    """
+    Merge the retrieval results in call order, the last result belongs to the query few-shot lookup
+    """
+    entity_slot_retrieve = []
+    retrieve_result = []
+    if results:
+        for entity_retrieve in results[:-1]:
+            if entity_retrieve:
+                entity_slot_retrieve.extend(entity_retrieve)
+        retrieve_result = results[-1] or []
+    return entity_slot_retrieve, retrieve_result
+
+
+def normal_retrieve(opensearch_info, search_box, entity_slot, selected_profile, use_rag, speculative_search=None):
+    calls = get_normal_retrieve_calls(opensearch_info, search_box, entity_slot, selected_profile, use_rag,
+                                      speculative_search)
+    results = gather("retrieval", calls, timeout=RETRIEVAL_TIMEOUT)
+    if use_rag and speculative_search is not None:
+        results.append(speculative_search.get_retrieve_result())
+    return merge_normal_retrieve_results(results)
+
+
+async def normal_retrieve_async(opensearch_info, search_box, entity_slot, selected_profile, use_rag,
+                                speculative_search=None):
+    calls = get_normal_retrieve_calls(opensearch_info, search_box, entity_slot, selected_profile, use_rag,
+                                      speculative_search)
+    results = await gather_blocking("retrieval", calls, timeout=RETRIEVAL_TIMEOUT)
+    if use_rag and speculative_search is not None:
+        results.append(await speculative_search.get_retrieve_result_async())
+    return merge_normal_retrieve_results(results)
+
+
+def get_early_sql_result(cancellation, database_profile, sql, model_type, search_box):
+    """
+    Execute the SQL of a response still being generated with its own cancellation token, cancelled with the
+    question being answered, or when the response fails
+    """
+    question_cancellation = current_cancellation.get()
+    if question_cancellation is not None:
+        question_cancellation.register(cancellation.cancel)
+    current_cancellation.set(cancellation)
+    try:
+        return get_sql_result_tool(database_profile, sql, model_type, search_box)
+    finally:
+        if question_cancellation is not None:
+            question_cancellation.unregister(cancellation.cancel)
+
+
+def text_to_sql_with_early_execution(database_profile, search_box, model_type, retrieve_result, entity_slot_retrieve,
+                                     model_provider=None):
+    """
+    Generate the SQL with a streamed response and start executing it as soon as </sql> is generated,
+    while the explanation is still being generated. The execution is cancelled if the response fails.
+    :return: the complete response and the future of the get_sql_result_tool result, None if no SQL was generated
+    """
+    parser = GeneratedSQLStreamParser()
+    sql_result_future = None
+    cancellation = QueryCancellation()
+    completed = False
+    try:
+        for text in text_to_sql_stream(database_profile['tables_info'],
+                                       database_profile['hints'],
+                                       database_profile['prompt_map'],
+                                       search_box,
+                                       model_id=model_type,
+                                       sql_examples=retrieve_result,
+                                       ner_example=entity_slot_retrieve,
+                                       dialect=database_profile['db_type'],
+                                       model_provider=model_provider,
+                                       profile_key=database_profile.get('profile_key')):
+            if parser.feed(text):
+                sql_result_future = submit("database", get_early_sql_result, cancellation, database_profile,
+                                           parser.sql, model_type, search_box)
+        completed = True
+    finally:
+        if not completed and sql_result_future is not None:
+            # nobody waits for the result, the query is dropped from the queue or stopped on the database
+            sql_result_future.cancel()
+            cancellation.cancel()
+    return parser.response, sql_result_future
+
+
 def normal_text_search(search_box, model_type, database_profile, entity_slot, opensearch_info, selected_profile, use_rag,
-                       model_provider=None):
+                       model_provider=None, speculative_search=None, early_execution=False):
+    """
+    :param early_execution: start executing the SQL while the explanation is being generated, the execution is
+    returned in the sql_result_future of the result
+    """
+    sql_result_future = None
     entity_slot_retrieve = []
     retrieve_result = []
     response = ""
@@ -19,32 +277,30 @@ def normal_text_search(search_box, model_type, database_profile, entity_slot, op
     search_result = SearchTextSqlResult(search_query=search_box, entity_slot_retrieve=entity_slot_retrieve,
                                         retrieve_result=retrieve_result, response=response, sql=sql)
     try:
-        if database_profile['db_url'] == '':
-            conn_name = database_profile['conn_name']
-            db_url = ConnectionManagement.get_db_url_by_name(conn_name)
-            database_profile['db_url'] = db_url
-            database_profile['db_type'] = ConnectionManagement.get_db_type_by_name(conn_name)
-
-        if len(entity_slot) > 0 and use_rag:
-            for each_entity in entity_slot:
-                entity_retrieve = get_retrieve_opensearch(opensearch_info, each_entity, "ner",
-                                                          selected_profile, 1, 0.7)
-                if len(entity_retrieve) > 0:
-                    entity_slot_retrieve.extend(entity_retrieve)
+        ConnectionManagement.resolve_profile_connection(database_profile)
 
-        if use_rag:
-            retrieve_result = get_retrieve_opensearch(opensearch_info, search_box, "query",
-                                                      selected_profile, 3, 0.5)
-
-        response = text_to_sql(database_profile['tables_info'],
-                               database_profile['hints'],
-                               database_profile['prompt_map'],
-                               search_box,
-                               model_id=model_type,
-                               sql_examples=retrieve_result,
-                               ner_example=entity_slot_retrieve,
-                               dialect=database_profile['db_type'],
-                               model_provider=model_provider)
+        entity_slot_retrieve, retrieve_result = normal_retrieve(opensearch_info, search_box, entity_slot,
+                                                                selected_profile, use_rag, speculative_search)
+
+        response = None
+        if speculative_search is not None:
+            response = speculative_search.get_response(entity_slot_retrieve)
+            speculative_search.commit()
+        if response is None and early_execution:
+            response, sql_result_future = text_to_sql_with_early_execution(database_profile, search_box, model_type,
+                                                                           retrieve_result, entity_slot_retrieve,
+                                                                           model_provider)
+        elif response is None:
+            response = text_to_sql(database_profile['tables_info'],
+                                   database_profile['hints'],
+                                   database_profile['prompt_map'],
+                                   search_box,
+                                   model_id=model_type,
+                                   sql_examples=retrieve_result,
+                                   ner_example=entity_slot_retrieve,
+                                   dialect=database_profile['db_type'],
+                                   model_provider=model_provider,
+                                   profile_key=database_profile.get('profile_key'))
         sql = get_generated_sql(response)
         search_result = SearchTextSqlResult(search_query=search_box, entity_slot_retrieve=entity_slot_retrieve,
                                             retrieve_result=retrieve_result, response=response, sql="")
@@ -52,11 +308,39 @@ def normal_text_search(search_box, model_type, database_profile, entity_slot, op
         search_result.retrieve_result = retrieve_result
         search_result.response = response
         search_result.sql = sql
+        search_result.sql_result_future = sql_result_future
     except Exception as e:
         logger.error(e)
     return search_result
 
 
+def agent_task_text_search(each_task_query, model_type, database_profile, opensearch_info, selected_profile, use_rag):
+    each_res_dict = {"query": each_task_query}
+    entity_slot_retrieve = []
+    retrieve_result = []
+    if use_rag:
+        calls = [functools.partial(get_retrieve_opensearch, opensearch_info, each_task_query, "ner",
+                                   selected_profile, 3, 0.5),
+                 functools.partial(get_retrieve_opensearch, opensearch_info, each_task_query, "query",
+                                   selected_profile, 3, 0.5)]
+        entity_slot_retrieve, retrieve_result = [result or [] for result in
+                                                 gather("retrieval", calls, timeout=RETRIEVAL_TIMEOUT)]
+    each_task_response = text_to_sql(database_profile['tables_info'],
+                                     database_profile['hints'],
+                                     database_profile['prompt_map'],
+                                     each_task_query,
+                                     model_id=model_type,
+                                     sql_examples=retrieve_result,
+                                     ner_example=entity_slot_retrieve,
+                                     dialect=database_profile['db_type'],
+                                     model_provider=None,
+                                     profile_key=database_profile.get('profile_key'))
+    each_task_sql = get_generated_sql(each_task_response)
+    each_res_dict["response"] = each_task_response
+    each_res_dict["sql"] = each_task_sql
+    return each_res_dict
+
+
 def agent_text_search(search_box, model_type, database_profile, entity_slot, opensearch_info, selected_profile, use_rag,
                       agent_cot_task_result):
     agent_search_results = []
@@ -66,30 +350,12 @@ def agent_text_search(search_box, model_type, database_profile, entity_slot, ope
     default_each_res_dict["response"] = ""
     default_each_res_dict["sql"] = "-1"
     try:
-        for each_task in agent_cot_task_result:
-            each_res_dict = {}
-            each_task_query = agent_cot_task_result[each_task]
-            each_res_dict["query"] = each_task_query
-            entity_slot_retrieve = []
-            retrieve_result = []
-            if use_rag:
-                entity_slot_retrieve = get_retrieve_opensearch(opensearch_info, each_task_query, "ner",
-                                                               selected_profile, 3, 0.5)
-
-                retrieve_result = get_retrieve_opensearch(opensearch_info, each_task_query, "query",
-                                                          selected_profile, 3, 0.5)
-            each_task_response = text_to_sql(database_profile['tables_info'],
-                                             database_profile['hints'],
-                                             database_profile['prompt_map'],
-                                             each_task_query,
-                                             model_id=model_type,
-                                             sql_examples=retrieve_result,
-                                             ner_example=entity_slot_retrieve,
-                                             dialect=database_profile['db_type'],
-                                             model_provider=None)
-            each_task_sql = get_generated_sql(each_task_response)
-            each_res_dict["response"] = each_task_response
-            each_res_dict["sql"] = each_task_sql
+        # sub-tasks are independent, generate their SQL in parallel and keep the task order
+        futures = [submit("agent", agent_task_text_search, agent_cot_task_result[each_task], model_type,
+                          database_profile, opensearch_info, selected_profile, use_rag)
+                   for each_task in agent_cot_task_result]
+        for future in futures:
+            each_res_dict = future.result()
             if each_res_dict["sql"] != "":
                 agent_search_results.append(each_res_dict)
         return agent_search_results
@@ -1,8 +1,12 @@
 import logging
+import re
 import time
 import random
 from datetime import datetime
 
+import sqlparse
+from sqlparse.tokens import Keyword
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -36,3 +40,70 @@ def get_generated_sql_explain(generated_sql_response):
         return generated_sql_response[index + len("</sql>"):]
     else:
         return generated_sql_response
+
+
+def replace_generated_sql(generated_sql_response, sql):
+    """
+    Replace the SQL of a text-to-SQL response, e.g. by the executed rewrite of the generated SQL, keeping its
+    explanation
+    """
+    index = generated_sql_response.find("</sql>")
+    if "<sql>" not in generated_sql_response or index == -1:
+        return generated_sql_response
+    return f"<sql>{sql}</sql>{generated_sql_response[index + len('</sql>'):]}"
+
+
+QUESTION_LITERAL_PATTERN = re.compile(r"(?<!\w)'([^']*)'(?!\w)|\"([^\"]*)\"|“([^”]*)”|(\d+(?:[.,]\d+)*)")
+
+
+def get_question_literals(question):
+    """
+    Get the literals of a question that a query filters on: the numbers, e.g. years, and the quoted strings
+    :return: sorted tuple of the lower-cased literals
+    """
+    return tuple(sorted(next(group for group in match.groups() if group is not None).strip().lower()
+                        for match in QUESTION_LITERAL_PATTERN.finditer(question)))
+
+
+class GeneratedSQLStreamParser:
+    """
+    Incrementally split a streamed text-to-SQL response into the SQL and the explanation that follows it
+    """
+
+    def __init__(self):
+        self.response = ""
+        self.sql = None
+
+    @property
+    def sql_ready(self):
+        return self.sql is not None
+
+    def feed(self, text):
+        """
+        Append a streamed chunk of the response
+        :return: True when this chunk completed the SQL, i.e. </sql> just arrived
+        """
+        self.response += text
+        if self.sql is None and "</sql>" in self.response:
+            self.sql = get_generated_sql(self.response)
+            return True
+        return False
+
+
+def limit_query(sql, max_rows):
+    """
+    Append a LIMIT to a single SELECT without a top-level LIMIT, so that the database stops after max_rows rows
+    :param sql:
+    :param max_rows: rows returned at most, one more row is requested to detect truncated results, 0 for no limit
+    :return: the SQL to execute
+    """
+    if max_rows <= 0:
+        return sql
+    statements = [statement for statement in sqlparse.parse(sql) if str(statement).strip().strip(';')]
+    if len(statements) != 1 or statements[0].get_type() != 'SELECT':
+        return sql
+    if any(token.ttype in Keyword and token.normalized in ('LIMIT', 'FETCH') for token in statements[0].tokens):
+        return sql
+    # the comments are stripped, a trailing line comment would comment the LIMIT out
+    limited_sql = sqlparse.format(sql, strip_comments=True).strip().rstrip(';').strip()
+    return f"{limited_sql}\nLIMIT {max_rows + 1}"
@@ -0,0 +1,139 @@
+import json
+import logging
+import numbers
+import re
+import sys
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+TIME_COLUMN_PATTERN = re.compile(r'(date|time|day|week|month|quarter|year|日期|时间|天|周|月|季度|年)', re.IGNORECASE)
+PROPORTION_QUESTION_PATTERN = re.compile(r'(proportion|percentage|percent|share|ratio|distribution|breakdown|'
+                                         r'占比|比例|比重|分布|构成)', re.IGNORECASE)
+MAX_PIE_CATEGORIES = 8
+MAX_BAR_CATEGORIES = 30
+
+
+def is_missing(value):
+    return value is None or value == "" or (isinstance(value, float) and value != value)
+
+
+def is_numeric_column(series):
+    if pd.api.types.is_bool_dtype(series):
+        return False
+    if pd.api.types.is_numeric_dtype(series):
+        return True
+    # e.g. DECIMAL columns are returned as objects, and missing values are filled with ""
+    values = [value for value in series if not is_missing(value)]
+    return len(values) > 0 and all(isinstance(value, numbers.Number) and not isinstance(value, bool)
+                                   for value in values)
+
+
+def is_time_column(series):
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return True
+    name = str(series.name)
+    if not TIME_COLUMN_PATTERN.search(name):
+        return False
+    if pd.api.types.is_integer_dtype(series):
+        # e.g. year or month numbers
+        return True
+    values = [value for value in series if not is_missing(value)]
+    if not values:
+        return False
+    parsed = pd.to_datetime(pd.Series([str(value) for value in values]), errors='coerce')
+    return bool(parsed.notna().all())
+
+
+def classify_chart_type(search_box, search_data):
+    """
+    Choose the chart type of a query result from its shape without calling the model
+    :param search_box: the user question
+    :param search_data: query result DataFrame
+    :return: dict in the format of select_data_visualization_type, None if the shape is ambiguous
+    """
+    columns = list(search_data.columns)
+    row_count = len(search_data)
+    if len(columns) != 2:
+        # a scalar or a single column list is shown as a table, wider results need the model to pick the columns
+        if len(columns) <= 1:
+            return {"show_type": "table", "format_data": [columns]}
+        return None
+    if row_count <= 1:
+        return {"show_type": "table", "format_data": [columns]}
+
+    first, second = search_data[columns[0]], search_data[columns[1]]
+    first_numeric, second_numeric = is_numeric_column(first), is_numeric_column(second)
+    if not first_numeric and not second_numeric:
+        return {"show_type": "table", "format_data": [columns]}
+
+    if first_numeric and second_numeric:
+        # only a numeric time axis, e.g. a year column, makes two numeric columns unambiguous
+        if is_time_column(first) and not is_time_column(second):
+            return {"show_type": "line", "format_data": [[columns[0], columns[1]]]}
+        if is_time_column(second) and not is_time_column(first):
+            return {"show_type": "line", "format_data": [[columns[1], columns[0]]]}
+        return None
+
+    x_column, y_column = (columns[1], columns[0]) if first_numeric else (columns[0], columns[1])
+    x_values, y_values = search_data[x_column], search_data[y_column]
+    if is_time_column(x_values):
+        return {"show_type": "line", "format_data": [[x_column, y_column]]}
+    category_count = x_values.nunique()
+    if category_count != row_count:
+        # repeated categories need an aggregation the model may know about
+        return None
+    if PROPORTION_QUESTION_PATTERN.search(search_box or ""):
+        if category_count <= MAX_PIE_CATEGORIES and all(is_missing(value) or value >= 0 for value in y_values):
+            return {"show_type": "pie", "format_data": [[x_column, y_column]]}
+        return None
+    if category_count <= MAX_BAR_CATEGORIES:
+        return {"show_type": "bar", "format_data": [[x_column, y_column]]}
+    return {"show_type": "table", "format_data": [columns]}
+
+
+def evaluate_chart_type_classifier(labelled_samples, model_id=None, prompt_map=None):
+    """
+    Evaluate classify_chart_type on a labelled benchmark set
+    :param labelled_samples: list of dict with question, data (a list of rows, the first row being the column names)
+    and the expected show_type
+    :param model_id: if set, also compare the fast path with the chart type selected by this model
+    :param prompt_map: prompt map of the model, the default prompts if None
+    :return: dict with the fast path rate, its accuracy against the labels and its agreement with the model
+    """
+    fast_path = 0
+    correct = 0
+    compared = 0
+    agreed = 0
+    for sample in labelled_samples:
+        rows = sample['data']
+        search_data = pd.DataFrame(rows[1:], columns=rows[0])
+        result = classify_chart_type(sample['question'], search_data)
+        if result is None:
+            continue
+        fast_path += 1
+        if result['show_type'] == sample['show_type']:
+            correct += 1
+        if model_id is not None:
+            from utils.llm import select_data_visualization_type
+            from utils.prompts.generate_prompt import prompt_map_dict
+            model_result = select_data_visualization_type(model_id, sample['question'], rows[:5],
+                                                          prompt_map or prompt_map_dict)
+            compared += 1
+            if model_result.get('show_type') == result['show_type']:
+                agreed += 1
+    total = len(labelled_samples)
+    return {
+        'samples': total,
+        'fast_path_rate': fast_path / total if total else 0.0,
+        'fast_path_accuracy': correct / fast_path if fast_path else 0.0,
+        'model_agreement': agreed / compared if compared else None,
+    }
+
+
+if __name__ == '__main__':
+    # python -m utils.visualization samples.json [model_id]
+    with open(sys.argv[1]) as f:
+        samples = json.load(f)
+    print(json.dumps(evaluate_chart_type_classifier(samples, sys.argv[2] if len(sys.argv) > 2 else None), indent=2))
@@ -2,9 +2,65 @@ import useWebSocket from "react-use-websocket";
 import { DEFAULT_QUERY_CONFIG } from "../constant/constants";
 import { SendJsonMessage } from "react-use-websocket/src/lib/types";
 import { Dispatch, SetStateAction } from "react";
-import { ChatBotHistoryItem, ChatBotMessageItem, ChatBotMessageType } from "../../components/chatbot-panel/types";
+import {
+  ChatBotAnswerItem,
+  ChatBotHistoryItem,
+  ChatBotMessageItem,
+  ChatBotMessageType
+} from "../../components/chatbot-panel/types";
 import { Global } from "../constant/global";
 
+const PARTIAL_CONTENT_TYPES = ["sql_stream", "sql", "data_analyse", "visualization", "suggested_question"];
+
+function emptyAnswer(query: string): ChatBotAnswerItem {
+  return {
+    query: query,
+    query_intent: "normal_search",
+    knowledge_search_result: {knowledge_response: ""},
+    sql_search_result: {
+      sql: "",
+      sql_data: [],
+      sql_data_chart: [],
+      data_show_type: "table",
+      sql_gen_process: "",
+      data_analyse: ""
+    },
+    agent_search_result: {agent_sql_search_result: [], agent_summary: ""},
+    suggested_question: []
+  };
+}
+
+/**
+ * Merge a partial result pushed while the question is being answered into the answer shown so far
+ */
+function mergePartialResult(answer: ChatBotAnswerItem, contentType: string, content: any): ChatBotAnswerItem {
+  const sqlSearchResult = {...answer.sql_search_result};
+  switch (contentType) {
+    case "sql":
+      sqlSearchResult.sql = content;
+      break;
+    case "data_analyse":
+      sqlSearchResult.data_analyse = content;
+      break;
+    case "visualization":
+      sqlSearchResult.sql_data = content.sql_data;
+      sqlSearchResult.data_show_type = content.data_show_type;
+      sqlSearchResult.sql_data_chart = content.chart_type !== "-1"
+        ? [{chart_type: content.chart_type, chart_data: content.chart_data}] : [];
+      break;
+    case "suggested_question":
+      return {...answer, suggested_question: content};
+    default:
+      // the streamed SQL tokens, the SQL is shown once it is complete
+      return answer;
+  }
+  return {...answer, sql_search_result: sqlSearchResult};
+}
+
+function isPartialAnswer(history: ChatBotHistoryItem[]) {
+  return history.length > 0 && history[history.length - 1].partial === true;
+}
+
 export function createWssClient(
   setStatusMessage: Dispatch<SetStateAction<ChatBotMessageItem[]>>,
   setMessageHistory: Dispatch<SetStateAction<ChatBotHistoryItem[]>>
@@ -27,10 +83,33 @@ export function createWssClient(
     if (messageJson.content_type === "state") {
       setStatusMessage((historyMessage) =>
         [...historyMessage, messageJson]);
+    } else if (PARTIAL_CONTENT_TYPES.includes(messageJson.content_type)) {
+      // partial results pushed while the question is being answered, shown at once and replaced by the complete
+      // answer that follows with content_type "end"
+      if (messageJson.content_type === "sql_stream") {
+        return;
+      }
+      setMessageHistory((history: ChatBotHistoryItem[]) => {
+        if (isPartialAnswer(history)) {
+          const answer = history[history.length - 1].content as ChatBotAnswerItem;
+          return [...history.slice(0, -1), {
+            type: ChatBotMessageType.AI,
+            content: mergePartialResult(answer, messageJson.content_type, messageJson.content),
+            partial: true
+          }];
+        }
+        const query = history.length > 0 ? history[history.length - 1].content.toString() : "";
+        return [...history, {
+          type: ChatBotMessageType.AI,
+          content: mergePartialResult(emptyAnswer(query), messageJson.content_type, messageJson.content),
+          partial: true
+        }];
+      });
     } else {
       setStatusMessage([]);
       setMessageHistory((history: ChatBotHistoryItem[]) => {
-        return [...history, {
+        const completeHistory = isPartialAnswer(history) ? history.slice(0, -1) : history;
+        return [...completeHistory, {
           type: ChatBotMessageType.AI,
           content: messageJson.content
         }];
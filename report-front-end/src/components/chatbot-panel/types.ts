@@ -10,6 +10,8 @@ export enum ChatBotMessageType {
 export interface ChatBotHistoryItem {
   type: ChatBotMessageType;
   content: string | ChatBotAnswerItem;
+  // an answer built from the partial results, replaced by the complete answer
+  partial?: boolean;
 }
 
 export interface ChatBotMessageItem {